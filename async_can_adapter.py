@@ -0,0 +1,361 @@
+import asyncio
+import time
+from collections import deque
+
+import can
+
+from can_adapter import CANAdapter
+from ecu import DEFAULT_SESSION, ECU, Session, SessionExplorer
+from utils.can_filters import exact_id_filters
+from utils.iso14229_1 import Iso14229_1, ServiceID, Services
+from utils.iso15765_2 import IsoTp
+from utils.scan_results import ServiceRecord, SessionRecord
+
+# Worst case length of a classic 8 byte frame with 11-bit ID, including stuff bits and inter-frame space
+MAX_FRAME_BITS = 135
+# Records buffered by scan_ecu_info_async() before the ECU scans wait for the consumer
+RECORD_QUEUE_SIZE = 256
+# Frames the bus load limiter lets through back to back - short bursts average out over the cap
+BUS_BURST_FRAMES = 16
+# Seconds the reader thread blocks on buses it cannot poll from the event loop - stopping it waits as long
+READER_TIMEOUT = 0.05
+
+
+class RateLimiter:
+    """
+    Token bucket limiting the callers of acquire() to 'rate' events per second, with bursts of up
+    to 'burst' events. Events that cannot wait, such as received frames, are charged with charge() and
+    delay the next acquire(). A rate of None disables the limit.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        if self.rate is None:
+            return
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def charge(self, events=1):
+        """Takes 'events' tokens at once, going into debt if the bucket holds fewer"""
+        if self.rate is None:
+            return
+        self._refill()
+        self.tokens -= events
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class AsyncEcuLink:
+    """Request/response channel to a single ECU, fed with its responses by the adapter's dispatcher"""
+
+    def __init__(self, ecu: ECU, bus, ecu_limiter: RateLimiter, bus_limiter: RateLimiter):
+        self.ecu = ecu
+        self.bus = bus
+        self.ecu_limiter = ecu_limiter
+        self.bus_limiter = bus_limiter
+        self.queue = asyncio.Queue()
+
+    async def request(self, data, timeout=None, on_unrelated=None):
+        """
+        Sends 'data' as a single frame request to the ECU and waits for the final response to it,
+        waiting P2* more after every response pending (NRC 0x78)
+
+        :param data: Request payload (up to 7 bytes, 62 with CAN FD), starting with the service ID
+        :param timeout: Seconds to wait for a response, or None to use the ECU's adaptive timeout
+        :param on_unrelated: Function called with responses to other services, or None
+        :return: PositiveResponse or NegativeResponse, or None on timeout
+        """
+        await self.ecu_limiter.acquire()
+        await self.bus_limiter.acquire()
+
+        # Drop late responses to earlier requests
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+        if timeout is None:
+            timeout = self.ecu.response_timeout()
+        service_id = data[0]
+        message = self.request_message(data)
+        self.ecu.touch()
+        sent_at = time.monotonic()
+        self.bus.send(message)
+
+        deadline = sent_at + timeout
+        response_pending = False
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            try:
+                msg = await asyncio.wait_for(self.queue.get(), remaining)
+            except asyncio.TimeoutError:
+                return None
+
+            response = self.parse_single_frame(msg.data)
+            if response is None:
+                continue
+            if response.service_id != service_id:
+                if on_unrelated is not None:
+                    on_unrelated(response)
+                continue
+            if Iso14229_1.is_response_pending(response, service_id):
+                # The ECU needs more time - the final response is due within P2*
+                response_pending = True
+                deadline = time.monotonic() + self.ecu.p2_star_server
+                continue
+
+            if response.positive and service_id == ServiceID.DIAGNOSTIC_SESSION_CONTROL:
+                timings = Iso14229_1.parse_timings(response)
+                if timings is not None:
+                    self.ecu.p2_server, self.ecu.p2_star_server = timings
+            if not response_pending and self.ecu.latency is not None:
+                self.ecu.latency.add_sample(
+                    msg.arbitration_id, time.monotonic() - sent_at)
+            return response
+
+    async def probe_services(self, session: Session, service_ids, timeout=None, window=1):
+        """
+        Sends a bare request for every SID of 'service_ids', keeping up to 'window' of them in flight, and adds
+        the available services to 'session', re-sending expired probes one at a time - see ECU.probe_services()
+
+        :param session: Session of the ECU receiving the available services, already switched to
+        :param service_ids: SIDs to probe, in order
+        :param timeout: Seconds to wait for each response, or None to use the ECU's adaptive timeout
+        :param window: Number of probes kept in flight
+        :return: Async generator of a ServiceRecord per service added to 'session'
+        """
+        # Drop late responses to earlier requests
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+        pending = deque(service_ids)
+        in_flight = {}  # SID -> [deadline, send time, response pending received]
+        expired = []  # SIDs to re-send one at a time
+        while pending or in_flight or expired:
+            if not pending and not in_flight:
+                pending.extend(expired)
+                expired = []
+                window = 1
+            while pending and len(in_flight) < window:
+                await self.ecu_limiter.acquire()
+                await self.bus_limiter.acquire()
+                service_id = pending.popleft()
+                self.ecu.touch()
+                self.bus.send(self.request_message([service_id]))
+                sent_at = time.monotonic()
+                in_flight[service_id] = [sent_at + (self.ecu.response_timeout() if timeout is None else timeout),
+                                         sent_at, False]
+
+            try:
+                # Responses queued while waiting for the rate limiters are handled before any probe expires
+                msg = self.queue.get_nowait() if not self.queue.empty() else await asyncio.wait_for(
+                    self.queue.get(), max(0.0, min(probe[0] for probe in in_flight.values()) - time.monotonic()))
+            except asyncio.TimeoutError:
+                now = time.monotonic()
+                for service_id in [service_id for service_id, probe in in_flight.items() if probe[0] <= now]:
+                    del in_flight[service_id]
+                    if window > 1:
+                        expired.append(service_id)
+                continue
+            response = self.parse_single_frame(msg.data)
+            if response is None:
+                continue
+            probe = in_flight.get(response.service_id)
+            if Iso14229_1.is_response_pending(response, response.service_id):
+                if probe is not None:
+                    probe[0] = time.monotonic() + self.ecu.p2_star_server
+                    probe[2] = True
+                continue
+            if response.service_id in expired:
+                expired.remove(response.service_id)
+            if self.ecu.record_service_response(session, response):
+                yield ServiceRecord(self.ecu, session.session_id, response.service_id, time.monotonic())
+            if probe is not None:
+                del in_flight[response.service_id]
+                if not probe[2] and self.ecu.latency is not None:
+                    self.ecu.latency.add_sample(msg.arbitration_id, time.monotonic() - probe[1])
+
+    def request_message(self, data):
+        """Returns the single frame can.Message carrying request 'data', framed like the ECU's IsoTp contexts"""
+        tx_dl = IsoTp.MAX_FRAME_LENGTH_FD if self.ecu.fd else IsoTp.MAX_FRAME_LENGTH
+        return IsoTp.get_cached_messages(bytes(data), self.ecu.client_id, tx_dl=tx_dl, fd=self.ecu.fd)[0]
+
+    @staticmethod
+    def parse_single_frame(frame):
+        """Returns the response carried by single frame (SF) 'frame', or None for other frames"""
+        if len(frame) == 0 or frame[0] >> 4 != IsoTp.SF_FRAME_ID:
+            return None
+        length = frame[0] & 0x0F
+        pci_length = IsoTp.SF_PCI_LENGTH
+        if length == 0 and len(frame) > IsoTp.MAX_FRAME_LENGTH:
+            # Escape sequence SF of a CAN FD frame
+            length = frame[1]
+            pci_length = IsoTp.SF_ESCAPE_PCI_LENGTH
+        return Iso14229_1.parse_response(frame[pci_length:pci_length + length])
+
+    async def switch_to_session(self, session_id, timeout=None):
+        response = await self.request([Services.DiagnosticSessionControl.service_id, session_id], timeout)
+        if response is None:
+            self.ecu.set_active_session(None)
+        elif response.positive:
+            self.ecu.set_active_session(session_id)
+        return response
+
+    async def enter_session(self, session: Session, current=None, timeout=None):
+        """Switches to 'session' along Session.route(), returns True if every switch succeeded"""
+        for session_id in session.route(current):
+            response = await self.switch_to_session(session_id, timeout)
+            if response is None or not response.positive:
+                return False
+        return True
+
+    async def explore_sessions(self, exhaustive=False, timeout=None):
+        """
+        Explores the session graph of the ECU like ECU.explore_sessions(), adding the sessions found to the ECU
+
+        :param exhaustive: Probe every session ID from every session found
+        :param timeout: Seconds to wait for each response, or None to use the ECU's adaptive timeout
+        :return: Async generator of a SessionRecord per transition, as soon as it is found
+        """
+        explorer = SessionExplorer(self.ecu.SESSION_IDS, exhaustive)
+        while True:
+            session_id = explorer.next_switch()
+            if session_id is None:
+                break
+            transition = explorer.record(await self.switch_to_session(session_id, timeout))
+            if transition is None:
+                continue
+            if transition.first:
+                self.ecu.sessions.append(transition.target)
+            yield SessionRecord(self.ecu, transition.source, transition.target.session_id, transition.first,
+                                time.monotonic())
+
+        # Switch back to default session
+        if explorer.current != DEFAULT_SESSION:
+            await self.switch_to_session(DEFAULT_SESSION, timeout)
+
+
+class AsyncCANAdapter(CANAdapter):
+    """
+    asyncio version of CANAdapter. Session and service discovery run for all found ECUs at once, the whole
+    scan limited to 'bus_load_cap' (fraction of the bitrate) of bus load, counting the frames sent and received,
+    and every ECU to 'ecu_request_rate' requests per second. Either limit is off when None; the probe windows
+    already keep each ECU from being flooded.
+    """
+
+    def __init__(self, *args, ecu_request_rate: float = None, bus_load_cap: float = 0.5, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ecu_request_rate = ecu_request_rate
+        self.bus_load_cap = bus_load_cap
+
+    def max_frame_rate(self):
+        """Returns the number of frames per second allowed by the bus load cap, or None without a cap"""
+        if self.bus_load_cap is None:
+            return None
+        return self.bus_load_cap * self.bitrate / MAX_FRAME_BITS
+
+    def gather_ecu_info(self, exhaustive=False, window=ECU.SERVICE_PROBE_WINDOW):
+        """Runs gather_ecu_info_async() in a new event loop, keeping the signature of CANAdapter.gather_ecu_info()"""
+        asyncio.run(self.gather_ecu_info_async(exhaustive=exhaustive, window=window))
+
+    async def gather_ecu_info_async(self, timeout: float = None, exhaustive=False,
+                                    window=ECU.SERVICE_PROBE_WINDOW):
+        async for _ in self.scan_ecu_info_async(timeout, exhaustive, window):
+            pass
+        for ecu in self.ECUs:
+            print(
+                f"ECU ID: 0x{ecu.client_id:04X}, Server ID: 0x{ecu.server_id:04X} - "
+                f"{len(ecu.sessions)} sessions discovered")
+        print("=" * 20)
+
+    async def scan_ecu_info_async(self, timeout: float = None, exhaustive=False, window=ECU.SERVICE_PROBE_WINDOW):
+        """
+        Discovers the sessions and services of all ECUs found at once. The records of all ECUs are merged as
+        they come; at most RECORD_QUEUE_SIZE wait for the consumer before the scans pause.
+
+        :param timeout: Seconds to wait for each response, or None to use the adaptive timeouts
+        :param exhaustive: Probe every session and service ID
+        :param window: Number of service probes kept in flight per ECU
+        :return: Async generator of SessionRecords and ServiceRecords, as soon as they are found
+        """
+        loop = asyncio.get_running_loop()
+        bus_limiter = RateLimiter(self.max_frame_rate(), burst=BUS_BURST_FRAMES)
+        links = {ecu.server_id: AsyncEcuLink(ecu, self.bus, RateLimiter(self.ecu_request_rate), bus_limiter)
+                 for ecu in self.ECUs}
+
+        # The async reader takes over the socket for the duration of the scan
+        restart_notifier = self.bus_pool.notifier is not None
+        self.bus_pool.stop_notifier()
+        self.bus.set_filters(exact_id_filters(links))
+        reader = can.AsyncBufferedReader()
+        notifier = can.Notifier(self.bus, [reader], timeout=READER_TIMEOUT, loop=loop)
+        dispatcher = asyncio.create_task(self._dispatch(reader, links, bus_limiter))
+        records = asyncio.Queue(RECORD_QUEUE_SIZE)
+        scans = [asyncio.create_task(self._gather_single_ecu_info(link, timeout, exhaustive, window, records))
+                 for link in links.values()]
+        getter = asyncio.ensure_future(records.get())
+        try:
+            running = set(scans)
+            while running or getter.done() or not records.empty():
+                done, _ = await asyncio.wait(running | {getter}, return_when=asyncio.FIRST_COMPLETED)
+                running -= done
+                if getter.done():
+                    yield getter.result()
+                    getter = asyncio.ensure_future(records.get())
+            for scan in scans:
+                # Raises the exception of a failed scan
+                scan.result()
+        finally:
+            getter.cancel()
+            for scan in scans:
+                scan.cancel()
+            dispatcher.cancel()
+            notifier.stop()
+            self.bus.set_filters(None)
+            if restart_notifier:
+                self.bus_pool.start_notifier()
+
+    @staticmethod
+    async def _dispatch(reader, links, bus_limiter):
+        async for msg in reader:
+            # Responses load the bus as much as the requests
+            bus_limiter.charge()
+            link = links.get(msg.arbitration_id)
+            if link is not None:
+                link.queue.put_nowait(msg)
+
+    async def _gather_single_ecu_info(self, link: AsyncEcuLink, timeout, exhaustive, window, records):
+        async for record in link.explore_sessions(exhaustive, timeout):
+            await records.put(record)
+        async for record in self._discover_services(link, timeout, exhaustive, window):
+            await records.put(record)
+
+    @staticmethod
+    async def _discover_services(link: AsyncEcuLink, timeout, exhaustive, window):
+        ecu = link.ecu
+        service_ids = ecu.service_probe_order(exhaustive)
+        current = ecu.current_session()
+        for session in ecu.sessions:
+            if not await link.enter_session(session, current, timeout):
+                current = None
+                continue
+            current = session.session_id
+            async for record in link.probe_services(session, service_ids, timeout, window):
+                yield record
+
+        # Switch back to default session
+        await link.switch_to_session(DEFAULT_SESSION, timeout)
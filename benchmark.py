@@ -0,0 +1,166 @@
+import argparse
+import contextlib
+import functools
+import io
+import json
+import time
+
+from async_can_adapter import AsyncCANAdapter
+from can_adapter import CANAdapter
+from multi_channel import ChannelJob, print_report, scan_channel, scan_channels
+from simulator import VirtualVehicle, example_vehicle_ecus
+
+STAGES = ("infer_protocol", "collect_ecus", "gather_ecu_info", "read_dids")
+
+
+class StageResult:
+    """Wall time and bus traffic of one benchmarked scan stage"""
+
+    def __init__(self, name, wall_time, frames):
+        self.name = name
+        self.wall_time = wall_time
+        self.frames = frames
+
+    @property
+    def frame_rate(self):
+        return self.frames / self.wall_time if self.wall_time > 0 else 0.0
+
+    def as_dict(self):
+        return {"stage": self.name, "wall_time": self.wall_time, "frames": self.frames,
+                "frames_per_second": self.frame_rate}
+
+
+def run_stage(name, vehicle, function, verbose=False):
+    """
+    Runs 'function' and measures its wall time and the number of frames exchanged with 'vehicle'
+
+    :param name: Name of the stage
+    :param vehicle: VirtualVehicle the scanner under test talks to
+    :param function: Function running the stage
+    :param verbose: Keep the scanner's output instead of discarding it
+    :return: StageResult
+    """
+    frames_before = vehicle.frame_count
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    start = time.perf_counter()
+    with output:
+        function()
+    wall_time = time.perf_counter() - start
+    # Let frames still in flight reach the vehicle
+    time.sleep(0.05)
+    return StageResult(name, wall_time, vehicle.frame_count - frames_before)
+
+
+def run_benchmark(args):
+    ecus = example_vehicle_ecus(args.ecus, latency=args.latency, jitter=args.jitter, extended=args.extended,
+                                fd=args.fd)
+    background = [(0x100 + index, args.background_period)
+                  for index in range(args.background_ids)]
+    with VirtualVehicle(ecus, channel=args.channel, seed=args.seed, background=background) as vehicle:
+        if args.async_scan:
+            adapter = AsyncCANAdapter(interface="virtual", channel=args.channel, bitrate=500000,
+                                      use_notifier=args.use_notifier, fd=args.fd,
+                                      ecu_request_rate=args.ecu_request_rate, bus_load_cap=args.bus_load_cap)
+        else:
+            adapter = CANAdapter(interface="virtual", channel=args.channel, bitrate=500000,
+                                 use_notifier=args.use_notifier, fd=args.fd)
+        stages = {
+            "infer_protocol": adapter.infer_protocol,
+            "collect_ecus": (lambda: adapter.collect_ecus_extended(window=args.window)) if args.extended
+            else lambda: adapter.collect_ecus(args.min_id, args.max_id, window=args.window),
+            "gather_ecu_info": adapter.gather_ecu_info,
+            "read_dids": adapter.read_data_from_ecus_by_identifier,
+        }
+        results = []
+        try:
+            for name in STAGES:
+                if name in args.skip:
+                    continue
+                results.append(run_stage(name, vehicle, stages[name], args.verbose))
+        finally:
+            adapter.shutdown()
+        found = len(adapter.ECUs)
+    return results, found
+
+
+def scan_simulated_channel(job, ecus):
+    """Runs scan_channel() in the worker process against a simulated vehicle of 'ecus' ECUs on the job's channel"""
+    with VirtualVehicle(example_vehicle_ecus(ecus, extended=job.extended, fd=job.fd), channel=job.channel):
+        return scan_channel(job)
+
+
+def print_results(results, found, expected):
+    print(f"{'Stage':<18}{'Wall time (s)':>15}{'Frames':>10}{'Frames/s':>12}")
+    for result in results:
+        print(f"{result.name:<18}{result.wall_time:>15.3f}{result.frames:>10}{result.frame_rate:>12.1f}")
+    total_time = sum(result.wall_time for result in results)
+    total_frames = sum(result.frames for result in results)
+    print(f"{'total':<18}{total_time:>15.3f}{total_frames:>10}"
+          f"{(total_frames / total_time if total_time > 0 else 0.0):>12.1f}")
+    print(f"ECUs found: {found}/{expected}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scan benchmark against a simulated vehicle")
+    parser.add_argument("--ecus", type=int, default=4,
+                        help="Number of simulated ECUs (default: 4)")
+    parser.add_argument("--latency", type=float, default=0.002,
+                        help="Response latency of the simulated ECUs in seconds (default: 0.002)")
+    parser.add_argument("--jitter", type=float, default=0.001,
+                        help="Maximum random extra latency in seconds (default: 0.001)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the simulated latency jitter (default: 0)")
+    parser.add_argument("--background-ids", type=int, default=0,
+                        help="Number of periodic non-diagnostic IDs on the bus (default: 0)")
+    parser.add_argument("--background-period", type=float, default=0.01,
+                        help="Period of the background frames in seconds (default: 0.01)")
+    parser.add_argument("--channel", default="benchmark",
+                        help="Virtual bus channel (default: benchmark)")
+    parser.add_argument("--min-id", type=lambda value: int(value, 0), default=0x700,
+                        help="First request ID scanned by collect_ecus (default: 0x700)")
+    parser.add_argument("--max-id", type=lambda value: int(value, 0), default=0x7FF,
+                        help="Last request ID scanned by collect_ecus (default: 0x7FF)")
+    parser.add_argument("--window", type=int, default=1,
+                        help="Number of ECU scan requests kept in flight (default: 1)")
+    parser.add_argument("--extended", action="store_true",
+                        help="Simulate and scan 29-bit normal fixed addressing instead of 11-bit IDs")
+    parser.add_argument("--fd", action="store_true",
+                        help="Simulate and scan with CAN FD frames")
+    parser.add_argument("--use-notifier", action="store_true",
+                        help="Receive frames on a notifier thread instead of polling the bus")
+    parser.add_argument("--async-scan", action="store_true",
+                        help="Discover sessions and services of all ECUs concurrently")
+    parser.add_argument("--ecu-request-rate", type=float, default=None,
+                        help="Requests per second to each ECU with --async-scan (default: unlimited)")
+    parser.add_argument("--bus-load-cap", type=lambda value: None if value == "none" else float(value), default=0.5,
+                        help="Bus load limit with --async-scan as a fraction of the bitrate, or 'none' (default: 0.5)")
+    parser.add_argument("--channels", type=int, default=0,
+                        help="Instead of the stages, scan this many simulated vehicles in parallel processes")
+    parser.add_argument("--skip", nargs="*", default=[], choices=STAGES,
+                        help="Stages not to run")
+    parser.add_argument("--json", help="Write the results to this JSON file (optional)")
+    parser.add_argument("--verbose", action="store_true",
+                        help="Show the scanner's output")
+    args = parser.parse_args()
+
+    if args.channels:
+        report = scan_channels([ChannelJob(f"{args.channel}{index}", interface="virtual", window=args.window,
+                                           extended=args.extended, fd=args.fd, use_notifier=args.use_notifier)
+                                for index in range(args.channels)],
+                               scan=functools.partial(scan_simulated_channel, ecus=args.ecus))
+        print_report(report)
+        if args.json:
+            with open(args.json, "w") as file:
+                json.dump(report, file, indent=2)
+        # Fail when a channel crashed or missed ECUs
+        raise SystemExit(1 if report["errors"] or any(len(channel["ecus"]) < args.ecus
+                                                      for channel in report["channels"]) else 0)
+
+    results, found = run_benchmark(args)
+    print_results(results, found, args.ecus)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({"ecus_found": found, "ecus": args.ecus, "window": args.window,
+                       "stages": [result.as_dict() for result in results]}, file, indent=2)
+    # Fail when ECUs were missed, unless the stage finding them was skipped
+    raise SystemExit(1 if "collect_ecus" not in args.skip and found < args.ecus else 0)
@@ -1,28 +1,50 @@
 
+import random
 import time
+from collections import deque
 from typing import List
 
-import can
 import cantools
 
-from ecu import ECU
+from ecu import ECU, Session
 from utils import constants
-from utils.can_actions import is_valid_response, send_and_receive, sniff_can
-from utils.iso14229_1 import ServiceID, Services
+from utils.bus_backends import get_backend
+from utils.bus_pool import BusPool
+from utils.can_actions import is_valid_response, recv_until, send_and_receive
+from utils.can_filters import discovery_filters, sniff_filters
+from utils.capture import Capture
+from utils.iso14229_1 import Iso14229_1, ServiceID, Services
 from utils.iso15765_2 import IsoTp
+from utils.keep_alive import KeepAliveScheduler
+from utils.latency import LatencyTable
 
-from utils.protocol_types import conclude_protocol, probe_uds_functional, probe_uds_physical
+from utils.protocol_types import ProtocolInference
+from utils.scan_results import EcuRecord, ScanResultStore
 
 
 class CANAdapter:
-    def __init__(self, interface: str, channel: str, bitrate: int, dbc_file: str = None):
-        self.interface = interface
+    def __init__(self, interface, channel: str, bitrate: int, dbc_file: str = None, use_notifier: bool = False,
+                 result_ttl: float = None, timeout_floor: float = constants.RESPONSE_TIMEOUT_FLOOR,
+                 timeout_ceiling: float = constants.RESPONSE_TIMEOUT_CEILING, fd: bool = False,
+                 tester_present_period: float = constants.TESTER_PRESENT_PERIOD):
+        # 'interface' is a BusBackend or the name of one, see utils.bus_backends.BACKENDS
+        self.backend = get_backend(interface)
+        self.interface = self.backend.NAME
         self.channel = channel
         self.bitrate = bitrate
+        # Open the bus in CAN FD mode and talk to the ECUs found with ISO-TP FD framing
+        self.fd = fd
         self.dbc_file = dbc_file
         self.dbc = None
 
         self.ECUs: List[ECU] = []
+        # Round-trip times per server, every request derives its deadline from them
+        self.latency = LatencyTable(
+            channel, floor=timeout_floor, ceiling=timeout_ceiling)
+        # DID read results of this run, shared by all printers and getters
+        self.results = ScanResultStore(ttl=result_ttl)
+        # InferenceResult of the last infer_protocol()
+        self.protocol_inference = None
 
         if dbc_file:
             try:
@@ -31,28 +53,120 @@ class CANAdapter:
             except Exception as e:
                 print(f"Failed to load DBC file: {e}")
 
-        self.bus = can.interface.Bus(
-            bustype=self.interface,
-            channel=self.channel,
-            bitrate=self.bitrate
-        )
-
-    def collect_ecus(self, min_id=constants.ARBITRATION_ID_MIN, max_id=constants.ARBITRATION_ID_MAX, delay=0.1, verify=True, print_results=True):
+        self.bus = self.backend.open(self.channel, self.bitrate, fd=fd)
+        # ISO-TP contexts borrow views of self.bus instead of opening sockets of their own
+        self.bus_pool = BusPool(self.bus, flush_on_borrow=self.backend.LIVE)
+        if use_notifier:
+            # Receive on a notifier thread blocking on the socket, views sleep on their queues
+            self.bus_pool.start_notifier()
+        # TesterPresent keep-alive of the ECUs in non-default sessions, shared by all ECUs (None: disabled)
+        self.keep_alive = KeepAliveScheduler(self.bus, tester_present_period, fd=fd) \
+            if tester_present_period else None
+
+    def collect_ecus(self, min_id=constants.ARBITRATION_ID_MIN, max_id=constants.ARBITRATION_ID_MAX, delay=None, verify=True, print_results=True, window=1,
+                     response_ids=constants.RESPONSE_ID_RANGE):
+        for _ in self.scan_ecus(min_id, max_id, delay, verify, print_results, window, response_ids):
+            pass
+
+    def scan_ecus(self, min_id=constants.ARBITRATION_ID_MIN, max_id=constants.ARBITRATION_ID_MAX, delay=None,
+                  verify=True, print_results=True, window=1, response_ids=constants.RESPONSE_ID_RANGE):
+        """
+        Scans 'min_id'..'max_id' for ECUs like collect_ecus(), adding them to self.ECUs
+
+        :return: Generator of an EcuRecord per ECU, as soon as it is found (and verified)
+        """
         diagnostic_session_control = Services.DiagnosticSessionControl
         service_id = diagnostic_session_control.service_id  # 0x10
         sub_function = diagnostic_session_control.DiagnosticSessionType.DEFAULT_SESSION  # 0x01
         session_control_data = [service_id, sub_function]
 
-        with IsoTp(None, None, channel=self.channel) as tp:
-            # Prepare session control frame
-            send_arb_id = min_id - 1
-            scanned_ids = 0
-
+        # Only replies on 'response_ids' from ECUs not found yet pass the filters
+        with IsoTp(None, None, bus=self.bus_pool.borrow(self._discovery_filters(response_ids))) as tp:
             if print_results:
                 print(
-                    f"Scanning for ECUs from 0x{(send_arb_id+1):04X} to 0x{max_id:04X}...")
+                    f"Scanning for ECUs from 0x{min_id:04X} to 0x{max_id:04X}...")
+
+            if window > 1:
+                yield from self._collect_ecus_pipelined(
+                    tp, session_control_data, min_id, max_id, delay, verify, print_results, window, response_ids)
+            else:
+                yield from self._collect_ecus_sequential(
+                    tp, session_control_data, min_id, max_id, delay, verify, print_results, response_ids)
+        if print_results:
+            print()
+
+    def _discovery_filters(self, response_ids):
+        """Returns the filters of the ECU scan: 'response_ids' without the response IDs of the ECUs found so far"""
+        return discovery_filters(response_ids, [ecu.server_id for ecu in self.ECUs])
+
+    def _collect_ecus_sequential(self, tp, session_control_data, min_id, max_id, delay, verify, print_results, response_ids):
+        # Prepare session control frame - one message, retargeted for every probed ID
+        probe = self._probe_message(tp, session_control_data)
+        send_arb_id = min_id - 1
+        scanned_ids = 0
 
-            while send_arb_id < max_id:
+        while send_arb_id < max_id:
+            send_arb_id += 1
+            scanned_ids += 1
+
+            # Print progress
+            progress = (scanned_ids / (max_id-min_id)) * 100
+            print(
+                f"\rProgress: {progress:.2f}% ({scanned_ids}/{(max_id-min_id)})", end="")
+            if send_arb_id == constants.UDS_BROADCAST_ID:
+                # Every ECU answers the functional broadcast ID, which would pair them with the wrong request ID
+                continue
+
+            response, response_arb_id = send_and_receive(
+                tp, session_control_data, send_arb_id, timeout=delay, latency=self.latency,
+                messages=[self._retarget(probe, send_arb_id)])
+
+            if response is None:
+                continue
+            if response.positive:
+                if print_results:
+                    print(
+                        f"\rSending Diagnostic Session Control to 0x{send_arb_id:04x}")
+                if verify:
+                    verified_arb_id = self._verify_ecu(
+                        tp, session_control_data, send_arb_id, response_arb_id, delay, 10, print_results)
+                    if verified_arb_id is None:
+                        tp.bus.set_filters(self._discovery_filters(response_ids))
+                        continue
+                    send_arb_id = verified_arb_id
+
+                record = self._add_ecu(send_arb_id, response_arb_id, print_results)
+                tp.bus.set_filters(self._discovery_filters(response_ids))
+                yield record
+
+    def _collect_ecus_pipelined(self, tp, session_control_data, min_id, max_id, delay, verify, print_results, window,
+                                response_ids):
+        """
+        Sweeps 'min_id'..'max_id' keeping up to 'window' requests in flight. Each request is retired from a
+        deadline queue once 'delay' (or, if None, the adaptive timeout of the channel) has passed without a reply.
+        A reply is attributed to the outstanding request whose ID is the conventional request ID for the response
+        ID (response - 8), or else to the newest outstanding request; the verification step then resolves the
+        request ID among the last 'window' IDs.
+        """
+        service_id = session_control_data[0]
+        probe = self._probe_message(tp, session_control_data)
+        in_flight = deque()  # (deadline, arbitration ID, send time) in send order
+        candidates = []  # (request arbitration ID, response message)
+        send_arb_id = min_id
+        scanned_ids = 0
+
+        while send_arb_id <= max_id or in_flight:
+            # Keep the window full
+            while send_arb_id <= max_id and len(in_flight) < window:
+                if send_arb_id == constants.UDS_BROADCAST_ID:
+                    # Every ECU answers the functional broadcast ID
+                    send_arb_id += 1
+                    scanned_ids += 1
+                    continue
+                timeout = self.latency.timeout() if delay is None else delay
+                sent_at = time.monotonic()
+                tp.bus.send(self._retarget(probe, send_arb_id))
+                in_flight.append((sent_at + timeout, send_arb_id, sent_at))
                 send_arb_id += 1
                 scanned_ids += 1
 
@@ -61,61 +175,323 @@ class CANAdapter:
                 print(
                     f"\rProgress: {progress:.2f}% ({scanned_ids}/{(max_id-min_id)})", end="")
 
-                response_msg = send_and_receive(
-                    tp, session_control_data, send_arb_id, timeout=delay)
-
-                if response_msg is None:
+            if not in_flight:
+                continue
+            # Wait for a reply until the oldest outstanding request times out
+            response_msg = tp.bus.recv(
+                max(0.0, in_flight[0][0] - time.monotonic()))
+            if response_msg is not None and is_valid_response(response_msg, service_id):
+                request_arb_id = self._match_pipelined_response(
+                    in_flight, response_msg.arbitration_id)
+                candidates.append((request_arb_id, response_msg))
+                # Further replies on this ID are resolved by the verification step - stop receiving them
+                tp.bus.set_filters(discovery_filters(
+                    response_ids, [ecu.server_id for ecu in self.ECUs] + [msg.arbitration_id for _, msg in candidates]))
+
+            # Retire timed out requests
+            now = time.monotonic()
+            while in_flight and in_flight[0][0] <= now:
+                in_flight.popleft()
+
+        response_arb_ids = set()
+        for request_arb_id, response_msg in candidates:
+            if response_msg.arbitration_id in response_arb_ids:
+                # Duplicate reply from an ECU that has already been resolved
+                continue
+            if print_results:
+                print(
+                    f"\rSending Diagnostic Session Control to 0x{request_arb_id:04x}")
+            if verify:
+                verified_arb_id = self._verify_ecu(
+                    tp, session_control_data, request_arb_id, response_msg.arbitration_id, delay, max(window, 10), print_results)
+                if verified_arb_id is None:
                     continue
-                if is_valid_response(response_msg, service_id):
-                    if print_results:
+                request_arb_id = verified_arb_id
+
+            response_arb_ids.add(response_msg.arbitration_id)
+            yield self._add_ecu(request_arb_id, response_msg.arbitration_id, print_results)
+
+    def _match_pipelined_response(self, in_flight, response_arb_id):
+        """
+        Returns the arbitration ID of the outstanding request most likely answered by 'response_arb_id'
+        and removes it from 'in_flight'
+        """
+        match = None
+        for entry in in_flight:
+            if entry[1] == response_arb_id - constants.RESPONSE_ID_OFFSET:
+                match = entry
+                # Only unambiguous matches give a usable round-trip time
+                self.latency.add_sample(
+                    response_arb_id, time.monotonic() - entry[2])
+                break
+        if match is None:
+            # The reply belongs to a request sent before it arrived - the newest one is the best guess
+            match = in_flight[-1]
+        in_flight.remove(match)
+        return match[1]
+
+    @staticmethod
+    def _probe_message(tp, request):
+        """
+        Returns a private can.Message carrying single frame 'request', for sweeps that send the same request to
+        many IDs. Unlike the messages cached by IsoTp, it is retargeted in place with _retarget() for every ID.
+        """
+        return tp.build_message(tp.get_frames_from_message(request)[0], constants.ARBITRATION_ID_MIN, tp.fd)
+
+    @staticmethod
+    def _retarget(message, arbitration_id):
+        """Sets the arbitration ID of sweep probe 'message' and returns it"""
+        message.arbitration_id = arbitration_id
+        message.is_extended_id = arbitration_id > constants.ARBITRATION_ID_MAX
+        return message
+
+    def _verify_ecu(self, tp, session_control_data, send_arb_id, response_arb_id, delay, depth, print_results):
+        """
+        Resends the request to 'send_arb_id' and the 'depth' - 1 IDs below it, listening only on
+        'response_arb_id'. Returns the first request ID that gets a valid reply, or None for a false match.
+        The filters of 'tp' are left on 'response_arb_id'.
+        """
+        verified_arb_id = None
+        tp.set_filter_single_arbitration_id(response_arb_id)
+        if print_results:
+            print(
+                f"Verifying response from 0x{send_arb_id:04x}")
+        for verify_arb_id in range(send_arb_id, send_arb_id - depth, -1):
+            if verify_arb_id == constants.UDS_BROADCAST_ID:
+                continue
+            if print_results:
+                print(
+                    f"Resending 0x{verify_arb_id:04x}...", end="")
+            verification, _ = send_and_receive(
+                tp, session_control_data, verify_arb_id, timeout=None if delay is None else delay + 0.1,
+                latency=self.latency)
+            if verification is not None and verification.positive:
+                verified_arb_id = verify_arb_id
+                break
+        if verified_arb_id is None and print_results:
+            print("False match - skipping")
+        return verified_arb_id
+
+    def collect_ecus_extended(self, target_addresses=range(0x00, 0x100), tester_address=constants.TESTER_ADDRESS,
+                              delay=None, print_results=True, window=16, sweep=True):
+        for _ in self.scan_ecus_extended(target_addresses, tester_address, delay, print_results, window, sweep):
+            pass
+
+    def scan_ecus_extended(self, target_addresses=range(0x00, 0x100), tester_address=constants.TESTER_ADDRESS,
+                           delay=None, print_results=True, window=16, sweep=True):
+        """
+        Scans for ECUs using 29-bit normal fixed addressing, i.e. requests on 0x18DA<target><tester> and
+        responses on 0x18DA<tester><target>. A functional request to 0x18DB33<tester> seeds the ECUs that
+        answer functionally, then the remaining 'target_addresses' are probed with up to 'window' physical
+        requests in flight. The response ID names the target address, so no verification step is needed.
+
+        :param target_addresses: Target (ECU) addresses to probe
+        :param tester_address: Source address of the scanner
+        :param delay: Seconds to wait for a reply, or None to use the adaptive timeout of the channel
+        :param print_results: Print the ECUs found
+        :param window: Number of physical requests kept in flight
+        :param sweep: Also probe the target addresses that did not answer the functional request
+        :return: Generator of an EcuRecord per ECU, yielded once no request is in flight, so the consumer
+                 may use the bus in between
+        """
+        diagnostic_session_control = Services.DiagnosticSessionControl
+        service_id = diagnostic_session_control.service_id
+        session_control_data = [
+            service_id, diagnostic_session_control.DiagnosticSessionType.DEFAULT_SESSION]
+        response_base = constants.NORMAL_FIXED_PHYSICAL_BASE | (tester_address << 8)
+        response_ids = [response_base | address for address in range(0x100)]
+        found = {ecu.server_id & 0xFF for ecu in self.ECUs if ecu.server_id in response_ids}
+
+        with IsoTp(None, None, bus=self.bus_pool.borrow(self._discovery_filters(response_ids))) as tp:
+            probe = self._probe_message(tp, session_control_data)
+            if print_results:
+                print(
+                    f"Scanning for ECUs with 29-bit normal fixed addressing (tester 0x{tester_address:02X})...")
+
+            # Seed with the ECUs answering a functional request - they reply within P2
+            functional_id = constants.NORMAL_FIXED_FUNCTIONAL_BASE | \
+                (constants.FUNCTIONAL_TARGET_ADDRESS << 8) | tester_address
+            timeout = self.latency.timeout() if delay is None else delay
+            tp.bus.send(self._retarget(probe, functional_id))
+            deadline = time.monotonic() + Iso14229_1.P2_SERVER + timeout
+            ready = []  # records held back until no request is in flight
+            while True:
+                response_msg = recv_until(
+                    tp.bus, deadline, lambda msg: is_valid_response(msg, service_id))
+                if response_msg is None:
+                    break
+                record = self._add_normal_fixed_ecu(
+                    response_msg.arbitration_id, tester_address, found, print_results)
+                if record is not None:
+                    ready.append(record)
+            yield from ready
+            ready = []
+
+            if sweep:
+                pending = deque(address for address in target_addresses
+                                if address not in found and address != tester_address)
+                in_flight = deque()  # (deadline, target address, send time) in send order
+                scanned_ids = 0
+                total_ids = len(pending)
+                while pending or in_flight:
+                    if ready and not in_flight:
+                        yield from ready
+                        ready = []
+                    # Keep the window full, unless records wait for the requests in flight to finish
+                    while pending and len(in_flight) < window and not ready:
+                        address = pending.popleft()
+                        timeout = self.latency.timeout() if delay is None else delay
+                        sent_at = time.monotonic()
+                        tp.bus.send(self._retarget(probe, constants.NORMAL_FIXED_PHYSICAL_BASE |
+                                                   (address << 8) | tester_address))
+                        in_flight.append((sent_at + timeout, address, sent_at))
+                        scanned_ids += 1
                         print(
-                            f"\rSending Diagnostic Session Control to 0x{send_arb_id:04x}")
-                    if verify:
-                        # Verification logic
-                        verified = False
-                        tp.set_filter_single_arbitration_id(
-                            response_msg.arbitration_id)
-                        if print_results:
-                            print(
-                                f"Verifying response from 0x{send_arb_id:04x}")
-                        for verify_arb_id in range(send_arb_id, send_arb_id - 10, -1):
-                            if print_results:
-                                print(
-                                    f"Resending 0x{verify_arb_id:04x}...", end="")
-                            verification_msg = send_and_receive(
-                                tp, session_control_data, verify_arb_id, timeout=delay + 0.1)
-                            if verification_msg and is_valid_response(verification_msg, service_id):
-                                verified = True
-                                send_arb_id = verify_arb_id
+                            f"\rProgress: {scanned_ids / total_ids * 100:.2f}% ({scanned_ids}/{total_ids})", end="")
+
+                    response_msg = tp.bus.recv(
+                        max(0.0, in_flight[0][0] - time.monotonic()))
+                    if response_msg is not None and is_valid_response(response_msg, service_id):
+                        address = response_msg.arbitration_id & 0xFF
+                        for entry in in_flight:
+                            if entry[1] == address:
+                                self.latency.add_sample(
+                                    response_msg.arbitration_id, time.monotonic() - entry[2])
+                                in_flight.remove(entry)
                                 break
-                        tp.clear_filters()
-                        if not verified:
-                            if print_results:
-                                print("False match - skipping")
-                            continue
+                        record = self._add_normal_fixed_ecu(
+                            response_msg.arbitration_id, tester_address, found, print_results)
+                        if record is not None:
+                            ready.append(record)
+
+                    # Retire timed out requests
+                    now = time.monotonic()
+                    while in_flight and in_flight[0][0] <= now:
+                        in_flight.popleft()
+                yield from ready
+        if print_results:
+            print()
 
-                    if print_results:
-                        print(
-                            f"Found diagnostics server at 0x{send_arb_id:04x}, response at 0x{response_msg.arbitration_id:04x}")
-                    self.ECUs.append(
-                        ECU(send_arb_id, response_msg.arbitration_id))
+    def _add_normal_fixed_ecu(self, response_arb_id, tester_address, found, print_results):
+        """
+        Adds the ECU replying on 0x18DA<tester><target> 'response_arb_id' unless its address is in 'found'
+
+        :return: EcuRecord of the ECU, or None if it was found before
+        """
+        address = response_arb_id & 0xFF
+        if address in found:
+            return None
+        found.add(address)
         if print_results:
             print()
+        return self._add_ecu(constants.NORMAL_FIXED_PHYSICAL_BASE | (address << 8) | tester_address,
+                      response_arb_id, print_results)
 
-    def gather_ecu_info(self):
+    def _add_ecu(self, client_id, server_id, print_results):
+        if print_results:
+            print(
+                f"Found diagnostics server at 0x{client_id:04x}, response at 0x{server_id:04x}")
+        ecu = ECU(client_id, server_id, bus_pool=self.bus_pool, latency=self.latency, backend=self.backend,
+                  fd=self.fd, keep_alive=self.keep_alive)
+        self.ECUs.append(ecu)
+        return EcuRecord(ecu, time.monotonic())
+
+    def restore_ecus_from_cache(self, cache, vin=None, samples=3):
+        """
+        Replaces the discovery of sessions and services with the entry of a known vehicle in 'cache'.
+        The vehicle is looked up by 'vin' if given, otherwise by the ECUs found by collect_ecus. Before
+        the entry is trusted, every cached ECU must answer and 'samples' randomly chosen cached services
+        must still be available.
+
+        :param cache: FingerprintCache
+        :param vin: VIN of the vehicle, if known
+        :param samples: Number of cached services to verify
+        :return: True if self.ECUs was restored from the cache, False otherwise
+        """
+        if vin is not None:
+            records = cache.lookup(vin=vin)
+        else:
+            records = cache.lookup(
+                id_pairs=[(ecu.client_id, ecu.server_id) for ecu in self.ECUs])
+        if records is None:
+            return False
+
+        ecus = []
+        for record in records:
+            ecu = ECU(record["client_id"], record["server_id"],
+                      bus_pool=self.bus_pool, latency=self.latency, backend=self.backend, fd=self.fd,
+                      keep_alive=self.keep_alive)
+            for session_id, services in record["sessions"].items():
+                session = Session(session_id, record["session_paths"].get(session_id))
+                for service_id in services:
+                    session.add_service(service_id)
+                ecu.sessions.append(session)
+            ecus.append(ecu)
+
+        print("Verifying cached ECUs...", end="", flush=True)
+        if not self._verify_cached_ecus(ecus, samples):
+            print("mismatch - rediscovering")
+            return False
+        print("done!")
+        self.ECUs = ecus
+        return True
+
+    def _verify_cached_ecus(self, ecus, samples):
+        default_session = Services.DiagnosticSessionControl.DiagnosticSessionType.DEFAULT_SESSION
+        for ecu in ecus:
+            with ecu.open_tp(ecu.client_id, ecu.server_id, channel=self.channel) as tp:
+                response = ecu.switch_to_session(default_session, tp)
+                if response is None or not response.positive:
+                    return False
+
+        cached_services = [(ecu, session.session_id, service_id)
+                           for ecu in ecus
+                           for session in ecu.sessions
+                           for service_id in session.services]
+        for ecu, session_id, service_id in random.sample(cached_services, min(samples, len(cached_services))):
+            if not ecu.probe_service(session_id, service_id, channel=self.channel):
+                return False
+        return True
+
+    def save_ecus_to_cache(self, cache):
+        """Stores self.ECUs in 'cache', together with the VIN if it has been read"""
+        vin = None
+        for result in self.results.by_did(constants.VIN_DID):
+            if result.data is not None:
+                vin = bytes(result.data).decode("utf-8", errors="replace")
+                break
+        cache.store(self.ECUs, vin=vin)
+
+    def gather_ecu_info(self, exhaustive=False, window=ECU.SERVICE_PROBE_WINDOW):
         for ecu in self.ECUs:
             print(
                 f"ECU ID: 0x{ecu.client_id:04X}, Server ID: 0x{ecu.server_id:04X}")
             print("Discovering sessions...", end="", flush=True)
-            ecu.discover_sessions(channel=self.channel)
-            print("done!")
+            for record in ecu.explore_sessions(channel=self.channel, exhaustive=exhaustive):
+                if record.first:
+                    print(f" 0x{record.session_id:02X}", end="", flush=True)
+            print(" done!")
 
             print("Discovering services...", end="", flush=True)
-            ecu.discover_services(channel=self.channel)
+            for _ in ecu.explore_services(channel=self.channel, exhaustive=exhaustive, window=window):
+                pass
             print("done!")
             print("-" * 20)
         print("=" * 20)
 
+    def scan_ecu_info(self, exhaustive=False, window=ECU.SERVICE_PROBE_WINDOW):
+        """
+        Discovers the sessions and services of the ECUs found, one ECU after the other, like gather_ecu_info()
+        without printing
+
+        :param exhaustive: Probe every session and service ID, see ECU.explore_sessions() and ECU.explore_services()
+        :param window: Number of service probes kept in flight
+        :return: Generator of SessionRecords and ServiceRecords, as soon as they are found
+        """
+        for ecu in self.ECUs:
+            yield from ecu.explore_sessions(channel=self.channel, exhaustive=exhaustive)
+            yield from ecu.explore_services(channel=self.channel, exhaustive=exhaustive, window=window)
+
     def print_ecu_info(self):
         for ecu in self.ECUs:
             print(
@@ -125,7 +501,37 @@ class CANAdapter:
                     f"\tSession ID: 0x{session.session_id:02X}\tServices: {[hex(service) for service in session.services]}")
             print("-" * 20)
 
+    def read_data_from_ecus_by_identifier(self, first_session_only=False):
+        """
+        Reads constants.DID_IDENTIFIERS from every ECU session supporting ReadDataByIdentifier into
+        self.results. DIDs already in the store are not read again.
+
+        :param first_session_only: Only read in the first session of each ECU supporting the service
+        :return: None
+        """
+        for _ in self.scan_dids(first_session_only):
+            pass
+
+    def scan_dids(self, first_session_only=False):
+        """
+        Reads the DIDs like read_data_from_ecus_by_identifier()
+
+        :param first_session_only: Only read in the first session of each ECU supporting the service
+        :return: Generator of the ScanResult of every DID read, as soon as its response is in
+        """
+        for ecu in self.ECUs:
+            for session in ecu.sessions:
+                if ServiceID.READ_DATA_BY_IDENTIFIER in session.services:
+                    missing_dids = [did for did in constants.DID_IDENTIFIERS
+                                    if self.results.get(ecu, session.session_id, did) is None]
+                    if missing_dids:
+                        for did, data in ecu.iter_data_by_identifiers(missing_dids, self.channel, session.session_id):
+                            yield self.results.put(ecu, session.session_id, did, data)
+                    if first_session_only:
+                        break
+
     def print_data_from_ecus_by_identifer(self):
+        self.read_data_from_ecus_by_identifier(first_session_only=True)
         for ecu in self.ECUs:
             print(
                 f"ECU ID: 0x{ecu.client_id:04X}, Server ID: 0x{ecu.server_id:04X}")
@@ -133,24 +539,22 @@ class CANAdapter:
                 if ServiceID.READ_DATA_BY_IDENTIFIER in session.services:
                     print(f"\tSession ID: 0x{session.session_id:02X}")
                     for did in constants.DID_IDENTIFIERS:
-                        data = ecu.get_data_from_ecu_by_identifier(
-                            did, self.channel, session.session_id)
+                        data = self.results.get_data(
+                            ecu, session.session_id, did)
                         if data is not None:
                             print(f"\t\tDID {hex(did)}: {data}")
                     break
             print("-" * 20)
 
     def get_data_from_ecus_by_identifer(self):
+        self.read_data_from_ecus_by_identifier()
         ecu_data_list = []
         for ecu in self.ECUs:
             ecu_sessions_data = []
             for session in ecu.sessions:
                 if ServiceID.READ_DATA_BY_IDENTIFIER in session.services:
-                    session_data = []
-                    for did in constants.DID_IDENTIFIERS:
-                        data = ecu.get_data_from_ecu_by_identifier(
-                            did, self.channel, session.session_id)
-                        session_data.append((did, data))
+                    session_data = [(did, self.results.get_data(ecu, session.session_id, did))
+                                    for did in constants.DID_IDENTIFIERS]
                     ecu_sessions_data.append(
                         (session.session_id, session_data))
             ecu_data_list.append((ecu, ecu_sessions_data))
@@ -175,6 +579,9 @@ class CANAdapter:
 
     def shutdown(self):
         if self.bus:
+            if self.keep_alive is not None:
+                self.keep_alive.stop()
+            self.bus_pool.stop_notifier()
             self.bus.shutdown()
             print("CAN bus shutdown.")
         else:
@@ -191,7 +598,7 @@ class CANAdapter:
         for ecu in self.ECUs:
             print(ecu)
 
-    def decode_messages(self, messages=[]):
+    def decode_messages(self, messages=()):
         if not self.dbc:
             print("No DBC file provided. Skipping decoding.")
             return []
@@ -206,38 +613,93 @@ class CANAdapter:
         return decoded_messages
 
     def save_messages(self, output_file: str, decoded: bool = True, duration=10):
-        messages = self.listen(duration, False)
-        with open(output_file, 'w') as f:
-            if decoded and self.dbc:
-                decoded_messages = self.decode_messages()
-                for arbitration_id, data in decoded_messages:
-                    f.write(f"ID={arbitration_id}, Data={data}\n")
-            else:
-                for message in messages:
-                    f.write(f"{message}\n")
+        # With a DBC file, the decoded signals are saved instead of the frames
+        if decoded and self.dbc:
+            self.capture(None, duration, decoded_file=output_file)
+        else:
+            self.capture(output_file, duration)
         print(f"Messages saved to {output_file}")
 
+    def capture(self, output_file, duration=None, decoded_file=None, filters=None, print_messages=False):
+        """
+        Streams the frames on the bus to 'output_file' from a writer thread, keeping memory flat on long captures.
+        The format follows the extension: .rec for fixed-size records (see utils.capture), or any python-can log
+        format (.asc, .blf, .csv, .log, .mf4, .trc, .txt). With 'decoded_file' and a DBC file, the frames are
+        also decoded on a separate thread.
+
+        :param output_file: Path of the raw capture, or None to only decode
+        :param duration: Capture duration in seconds, or None to capture until interrupted (Ctrl+C)
+        :param decoded_file: Path of the decoded signals, or None
+        :param filters: Filters of the captured IDs (format of set_filters()), or None to capture everything
+        :param print_messages: Print every received frame
+        :return: CaptureStats
+        """
+        if decoded_file is not None and not self.dbc:
+            print("No DBC file provided. Skipping decoding.")
+            decoded_file = None
+            if output_file is None:
+                return None
+        print(
+            f"Capturing on {self.channel} {'until interrupted' if duration is None else f'for {duration} seconds'}...")
+        view = self.bus_pool.borrow(filters)
+        try:
+            capture = Capture(view, output_file, decoded_file=decoded_file, dbc=self.dbc, fd=self.fd)
+            stats = capture.run(duration, on_message=(lambda message: print(
+                f"Received message: {message}")) if print_messages else None)
+        finally:
+            view.shutdown()
+        print(f"Captured {stats.received} frames in {stats.elapsed:.1f} s ({stats.frame_rate:.1f} frames/s), "
+              f"{stats.written} written, {stats.decoded} decoded")
+        if stats.stalls:
+            print(f"Writer fell behind {stats.stalls} times - frames waited in the socket buffer")
+        return stats
+
     def listen(self, duration: int, print_messages: bool = False):
+        # Keeps every frame in memory - use capture() for long captures
         messages = []
         print(f"Listening on {self.channel} for {duration} seconds...")
-        start_time = time.time()
-        while time.time() - start_time < duration:
-            message = self.bus.recv(timeout=1)
-            if message:
-                messages.append(message)
-                if print_messages:
-                    print(f"Received message: {message}")
+        end_time = time.monotonic() + duration
+        view = self.bus_pool.borrow()
+        try:
+            while time.monotonic() < end_time:
+                message = view.recv(timeout=1)
+                if message:
+                    messages.append(message)
+                    if print_messages:
+                        print(f"Received message: {message}")
+        finally:
+            view.shutdown()
         return messages
 
-    def infer_protocol(self):
-        print(f"Starting protocol detection on {self.channel}...")
-
-        iso_tp, diag_ids = sniff_can(self.bus, duration=6)
+    def infer_protocol(self, threshold=0.95, max_duration=10.0, window=16):
+        """
+        Sniffs and probes at the same time until one protocol reaches 'threshold' confidence, see
+        utils.protocol_types.ProtocolInference
 
-        uds_func = probe_uds_functional(self.bus)
-        uds_phys = probe_uds_physical(self.bus)
+        :param threshold: Confidence at which detection stops
+        :param max_duration: Seconds after which the most likely protocol is taken whatever its confidence
+        :param window: Physical probes kept in flight
+        :return: PossibleProtocol
+        """
+        print(f"Starting protocol detection on {self.channel}...")
 
-        result = conclude_protocol(iso_tp, uds_func, uds_phys, diag_ids)
-        print(f"\n[RESULT] Most likely protocol: {result.value}")
+        # Sniff the diagnostic ID ranges and the possible response IDs while probing
+        view = self.bus_pool.borrow(sniff_filters())
+        try:
+            inference = ProtocolInference(view, latency=self.latency, threshold=threshold,
+                                          max_duration=max_duration, window=window).run()
+        finally:
+            view.shutdown()
+
+        inference.summary.print()
+        if inference.functional_responses:
+            print(f"[+] Functional probe answered by "
+                  f"{', '.join(hex(aid) for aid in sorted(inference.functional_responses))}")
+        for request_id, response_id in sorted(inference.physical_responses.items()):
+            print(f"[+] Physical probe {hex(request_id)} answered by {hex(response_id)}")
+        result = inference.protocol
+        print(f"\n[RESULT] Most likely protocol: {result.value} (confidence {inference.confidence:.2f}, "
+              f"decided after {inference.decision_time:.2f} s, {inference.probed_ids} physical probes)")
+        self.protocol_inference = inference
 
         return result
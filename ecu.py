@@ -1,97 +1,520 @@
-from utils.can_actions import is_valid_response, send_and_receive
+import time
+from collections import deque
+
+from utils.can_filters import exact_id_filters
 from utils.common import convert_to_byte_list
-from utils.constants import NRC_FOR_AVAILABLE_SERVICE
-from utils.iso14229_1 import Iso14229_1, ServiceID, Services
+from utils.constants import DEFAULT_RESPONSE_TIMEOUT, NEGATIVE_RESPONSE_CODE, NRC_FOR_AVAILABLE_SERVICE, \
+    TESTER_PRESENT_PERIOD, UDS_SERVICE_NAMES
+from utils.iso14229_1 import Iso14229_1, NegativeResponseCodes, ServiceID, Services
 from utils.iso15765_2 import IsoTp
+from utils.scan_results import ServiceRecord, SessionRecord
+
+
+DEFAULT_SESSION = Services.DiagnosticSessionControl.DiagnosticSessionType.DEFAULT_SESSION
 
 
 class Session:
-    def __init__(self, session_id):
+    def __init__(self, session_id, path=None):
         self.session_id = session_id
         self.services = []
+        # Sessions switched to, in order, to enter this one from the default session
+        if path is None:
+            path = [] if session_id == DEFAULT_SESSION else [session_id]
+        self.path = path
+        # Sessions this one has been entered from directly
+        self.entered_from = set()
 
     def add_service(self, service_id):
-        if service_id not in self.services:
-            self.services.append(service_id)
+        """Adds 'service_id' to the available services, returns True if it was not known yet"""
+        if service_id in self.services:
+            return False
+        self.services.append(service_id)
+        return True
+
+    def route(self, current=None):
+        """
+        Returns the sessions to switch to, in order, to enter this session from session 'current' with the
+        fewest transitions known
+
+        :param current: Active session, or None if it is not known
+        :return: List of session IDs, empty if 'current' is this session
+        """
+        if current == self.session_id:
+            return []
+        if current in self.entered_from:
+            return [self.session_id]
+        steps = [DEFAULT_SESSION] + self.path
+        if current in steps:
+            return steps[steps.index(current) + 1:]
+        return steps
+
+
+class SessionTransition:
+    """Successful DiagnosticSessionControl from session 'source' (None: the session the ECU was in) to 'target'"""
+
+    def __init__(self, source, target: Session, first):
+        self.source = source
+        self.target = target
+        # 'target' was found with this transition
+        self.first = first
+
+
+class SessionExplorer:
+    """
+    Breadth-first exploration of the session graph of an ECU, independent of how requests are sent: the caller
+    switches to next_switch() and hands the response to record() until next_switch() returns None.
+
+    Every session found is probed with DiagnosticSessionControl to every candidate session, so sessions only
+    reachable from another non-default session are found as well and every transition is recorded in
+    Session.entered_from. To keep the transitions low, a successful probe is followed by a probe back to the
+    source session, which tests the reverse transition and returns to the source at once. Sessions refused with
+    NRC 0x12 (sub-function not supported) are not probed again from other sessions, unless 'exhaustive'. A switch
+    without a response is sent once more before it counts as failed, as a late reply is no refusal.
+
+    :param session_ids: Candidate session IDs
+    :param exhaustive: Probe every candidate from every session
+    """
+
+    def __init__(self, session_ids, exhaustive=False):
+        self.session_ids = session_ids
+        self.exhaustive = exhaustive
+        # Session ID -> Session, in discovery order
+        self.sessions = {}
+        self.current = None
+        self.source = None
+        self.sources = deque()
+        self.targets = deque()
+        self.tested = set()
+        self.unsupported = set()
+        # (kind, active session, session ID) of the switches repeated after a timeout
+        self.repeated = set()
+        # Planned (kind, session ID) switches - "enter" moves to the source, "probe" tests a transition
+        self.steps = deque([("probe", DEFAULT_SESSION)])
+
+    def next_switch(self):
+        """Returns the session to switch to next, or None once the exploration is complete"""
+        while not self.steps:
+            target = self._next_target()
+            if target is None:
+                if not self.sources:
+                    return None
+                self.source = self.sources.popleft()
+                self.targets = deque(self.session_ids)
+                continue
+            if self.current != self.source:
+                self.steps.extend(("enter", session_id)
+                                  for session_id in self.sessions[self.source].route(self.current))
+            self.steps.append(("probe", target))
+        return self.steps[0][1]
+
+    def _next_target(self):
+        while self.targets:
+            target = self.targets.popleft()
+            if target != self.source and (self.source, target) not in self.tested and \
+                    target not in self.unsupported:
+                return target
+        return None
+
+    def record(self, response):
+        """
+        Records the response to the switch to next_switch()
+
+        :param response: PositiveResponse or NegativeResponse, or None on timeout
+        :return: SessionTransition if the switch succeeded as a probe, else None
+        """
+        kind, target = self.steps.popleft()
+        positive = response is not None and response.positive
+        if response is None and (kind, self.current, target) not in self.repeated:
+            self.repeated.add((kind, self.current, target))
+            self.steps.appendleft((kind, target))
+            return None
+        if kind == "enter":
+            if positive:
+                self.current = target
+            else:
+                # The source cannot be entered any more - skip its remaining probes
+                self.current = None
+                self.steps.clear()
+                self.targets.clear()
+            return None
+
+        source = self.current
+        self.tested.add((source, target))
+        if not positive:
+            # A negative response leaves the active session unchanged
+            if response is not None and response.nrc == NegativeResponseCodes.SUB_FUNCTION_NOT_SUPPORTED \
+                    and not self.exhaustive:
+                self.unsupported.add(target)
+            return None
+
+        self.current = target
+        session = self.sessions.get(target)
+        first = session is None
+        if first:
+            session = Session(target, [] if source is None else self.sessions[source].path + [target])
+            self.sessions[target] = session
+            self.sources.append(target)
+        if source is not None:
+            session.entered_from.add(source)
+            if (target, source) not in self.tested:
+                # Switching back to the source tests the reverse transition on the way
+                self.steps.appendleft(("probe", source))
+        return SessionTransition(source, session, first)
 
 
 class ECU:
-    def __init__(self, client_id, setver_id):
+    # Sessions probed by discover_sessions: ISO 14229-1, vehicle manufacturer (0x40-0x5F) and system supplier
+    # (0x60-0x7E) sessions
+    SESSION_IDS = range(0x01, 0x7F)
+
+    # Request SIDs probed by discover_services, in this order: the services of ISO-14229-1, the rest of its
+    # request ranges, then the ranges left to vehicle manufacturers (0xA0-0xB9) and system suppliers (0xBA-0xBE).
+    # Response SIDs (0x40-0x7F, 0xC0-0xFF) and OBD services (0x01-0x0F) are only probed in exhaustive mode.
+    KNOWN_SERVICE_IDS = tuple(service_id for service_id in UDS_SERVICE_NAMES if service_id != NEGATIVE_RESPONSE_CODE)
+    SERVICE_ID_RANGES = (range(0x10, 0x3F), range(0x83, 0x89), range(0xA0, 0xBF))
+    ALL_SERVICE_IDS = range(0x00, 0xFF)
+    # Service probes kept in flight - their responses are told apart by the SID they carry
+    SERVICE_PROBE_WINDOW = 8
+
+    # Negative responses telling that a multi-DID request has to be split
+    NRC_FOR_SPLIT_REQUEST = (NegativeResponseCodes.INCORRECT_MESSAGE_LENGTH_OR_INVALID_FORMAT,
+                             NegativeResponseCodes.RESPONSE_TOO_LONG)
+
+    def __init__(self, client_id, setver_id, bus_pool=None, max_dids_per_request=8, latency=None, backend=None,
+                 fd=False, keep_alive=None):
         self.client_id = client_id
         self.server_id = setver_id
         self.sessions: list[Session] = []
+        self.bus_pool = bus_pool
+        # BusBackend (or its name) used to open a bus of its own when there is no pool
+        self.backend = backend
+        # Talk to the ECU with CAN FD frames (ISO-TP FD framing)
+        self.fd = fd
+        # LatencyTable of the channel, response timeouts are derived from the measured round-trip times
+        self.latency = latency
+        # Number of DIDs packed into one ReadDataByIdentifier request, halved when the ECU objects
+        self.max_dids_per_request = max_dids_per_request
+        # Record lengths of DIDs that have been read on their own
+        self.did_lengths = {}
+        # Server timings, updated from DiagnosticSessionControl responses
+        self.p2_server = Iso14229_1.P2_SERVER
+        self.p2_star_server = Iso14229_1.P2_STAR_SERVER
+        # utils.keep_alive.KeepAliveScheduler holding the ECU in its non-default sessions, or None
+        self.keep_alive = keep_alive
+        # Session the ECU was last switched to, None if not known
+        self.active_session = None
+        # time.monotonic() time of the last request sent to the ECU
+        self.last_request = 0.0
+
+    def open_tp(self, arb_id_request=None, arb_id_response=None, channel=None):
+        """
+        Returns an IsoTp context on a view of the shared bus, or on a bus of its own without a pool.
+        With 'arb_id_response' given, only frames on that ID pass the filters of the context.
+        """
+        filters = None if arb_id_response is None else exact_id_filters([arb_id_response])
+        if self.bus_pool is not None:
+            return IsoTp(arb_id_request, arb_id_response, bus=self.bus_pool.borrow(filters), fd=self.fd)
+        tp = IsoTp(arb_id_request, arb_id_response, channel=channel, backend=self.backend, fd=self.fd)
+        tp.bus.set_filters(filters)
+        return tp
+
+    def response_timeout(self):
+        """
+        Returns the number of seconds to wait for a response from this ECU: the adaptive timeout, but never less
+        than the P2 the ECU reported, as it may take that long to answer however fast it answered before
+        """
+        if self.latency is None:
+            return max(self.p2_server, DEFAULT_RESPONSE_TIMEOUT)
+        return max(self.p2_server, self.latency.timeout(self.server_id))
 
-    def discover_sessions(self, channel=None):
-        diagnostic_session_control = Services.DiagnosticSessionControl
-        service_id = diagnostic_session_control.service_id
+    def uds_request(self, tp: IsoTp, data, timeout: float = None, on_unrelated=None):
+        """
+        Sends 'data' through the UDS request layer, keeping the P2/P2* timings reported by the ECU and
+        feeding the round-trip time of immediate responses to the latency estimator
 
-        with IsoTp(None, None, channel=channel) as tp:
-            for session in range(0x01, 0x05):  # Check sessions from 0x01 to 0x0F
-                resp = self.switch_to_session(session, tp)
+        :param tp: IsoTp to send the request on
+        :param data: Request payload, starting with the service ID
+        :param timeout: Seconds to wait for the first response, or None to use response_timeout()
+        :param on_unrelated: Function called with responses to other services, or None
+        :return: PositiveResponse or NegativeResponse, or None on timeout
+        """
+        if timeout is None:
+            timeout = self.response_timeout()
+        uds = Iso14229_1(tp, self.p2_server, self.p2_star_server)
+        self.touch()
+        sent_at = time.monotonic()
+        response = uds.request(data, timeout, on_unrelated)
+        self.p2_server = uds.p2_server
+        self.p2_star_server = uds.p2_star_server
+        if response is not None and uds.response_pending_count == 0 and self.latency is not None:
+            self.latency.add_sample(self.server_id, time.monotonic() - sent_at)
+        return response
 
-                # TODO: Check invalid response codes
-                if resp:
-                    if is_valid_response(resp, service_id):
-                        self.sessions.append(Session(session))
+    def discover_sessions(self, channel=None, exhaustive=False):
+        for _ in self.explore_sessions(channel, exhaustive):
+            pass
+
+    def explore_sessions(self, channel=None, exhaustive=False):
+        """
+        Explores the session graph of the ECU with a SessionExplorer over SESSION_IDS, adding the sessions found
+        to self.sessions
+
+        :param channel: Channel to open a bus on when there is no bus pool
+        :param exhaustive: Probe every session ID from every session found
+        :return: Generator of a SessionRecord per transition, as soon as it is found
+        """
+        explorer = SessionExplorer(self.SESSION_IDS, exhaustive)
+        with self.open_tp(self.client_id, self.server_id, channel=channel) as tp:
+            while True:
+                session_id = explorer.next_switch()
+                if session_id is None:
+                    break
+                transition = explorer.record(self.switch_to_session(session_id, tp))
+                if transition is None:
+                    continue
+                if transition.first:
+                    self.sessions.append(transition.target)
+                yield SessionRecord(self, transition.source, transition.target.session_id, transition.first,
+                                    time.monotonic())
 
             # Switch back to default session
-            self.switch_to_session(
-                Services.DiagnosticSessionControl.DiagnosticSessionType.DEFAULT_SESSION, tp)
+            if explorer.current != DEFAULT_SESSION:
+                self.switch_to_session(DEFAULT_SESSION, tp)
+
+    @classmethod
+    def service_probe_order(cls, exhaustive=False):
+        """Returns the SIDs probed by discover_services(), known services first"""
+        ranges = cls.SERVICE_ID_RANGES + ((cls.ALL_SERVICE_IDS,) if exhaustive else ())
+        order = list(cls.KNOWN_SERVICE_IDS)
+        for service_ids in ranges:
+            order.extend(service_id for service_id in service_ids if service_id not in order)
+        return order
+
+    def discover_services(self, timeout: float = None, channel=None, exhaustive=False, window=SERVICE_PROBE_WINDOW):
+        for _ in self.explore_services(timeout, channel, exhaustive, window):
+            pass
 
-    def discover_services(self, timeout: int = 0.1, channel=None):
-        with IsoTp(arb_id_request=self.client_id, arb_id_response=self.server_id, channel=channel) as tp:
-            tp.set_filter_single_arbitration_id(self.server_id)
+    def explore_services(self, timeout: float = None, channel=None, exhaustive=False, window=SERVICE_PROBE_WINDOW):
+        """
+        Probes the SIDs of service_probe_order() in every session with bare requests
 
+        :param timeout: Seconds to wait for each response, or None to use response_timeout()
+        :param channel: Channel to open a bus on when there is no bus pool
+        :param exhaustive: Probe every SID 0x00-0xFE, for research runs
+        :param window: Number of probes kept in flight
+        :return: Generator of a ServiceRecord per available service, as soon as it is found
+        """
+        service_ids = self.service_probe_order(exhaustive)
+        with self.open_tp(self.client_id, self.server_id, channel=channel) as tp:
+            # Sessions are visited in discovery order, each entered from the previous one where possible
+            current = self.current_session()
             for session in self.sessions:
-                # print(f"Discovering services for session {session.session_id}...")
-                # Iterate through all sessions
-                self.switch_to_session(session.session_id, tp)
-
-                for service_id in range(0, 0xff):
-                    # print(f"Requesting service {service_id}...")
-                    tp.send_request([service_id])
-
-                    # Get response
-                    msg = tp.bus.recv(timeout)
-                    if msg is None:
-                        # No response received
-                        continue
-                    # Parse response
-                    if len(msg.data) > 3:
-                        # Since service ID is included in the response, mapping is correct even if response is delayed
-                        response_id = msg.data[1]
-                        # print(f"Response ID: {response_id}")
-                        if is_valid_response(msg, service_id) or response_id in NRC_FOR_AVAILABLE_SERVICE:
-                            request_id = Iso14229_1.get_service_request_id(
-                                response_id)
-                            session.add_service(request_id)
+                if not self.enter_session(tp, session, current):
+                    current = None
+                    continue
+                current = session.session_id
+                yield from self.probe_services(tp, session, service_ids, timeout, window)
 
             # Switch back to default session
-            self.switch_to_session(
-                Services.DiagnosticSessionControl.DiagnosticSessionType.DEFAULT_SESSION, tp)
+            self.switch_to_session(DEFAULT_SESSION, tp)
 
-    def get_data_from_ecu_by_identifier(self, did: int, channel=None):
-        needed_session = self.find_session_with_service(
-            Services.ReadDataByIdentifier.service_id)
+    def probe_services(self, tp: IsoTp, session: Session, service_ids, timeout: float = None, window=1):
+        """
+        Sends a bare request for every SID of 'service_ids', keeping up to 'window' of them in flight, and adds
+        the available services to 'session'. A probe is retired as soon as its response arrives, or once
+        'timeout' (P2* after a response pending) has passed without one. A busy server may drop requests sent
+        back-to-back, so probes expired while others were in flight are re-sent one at a time at the end.
+        Records are only yielded while no probe is in flight, so the consumer may use the bus in between.
 
-        with IsoTp(None, None, channel=channel) as tp:
-            self.switch_to_session(needed_session, tp)
+        :param tp: IsoTp to the ECU, already in the session
+        :param session: Session receiving the available services
+        :param service_ids: SIDs to probe, in order
+        :param timeout: Seconds to wait for each response, or None to use response_timeout()
+        :param window: Number of probes kept in flight
+        :return: Generator of a ServiceRecord per service added to 'session'
+        """
+        pending = deque(service_ids)
+        in_flight = {}  # SID -> [deadline, send time, response pending received]
+        expired = []  # SIDs to re-send one at a time
+        ready = []  # records held back until no probe is in flight
+        while pending or in_flight or expired:
+            if ready and not in_flight:
+                yield from ready
+                ready = []
+            if not pending and not in_flight:
+                pending.extend(expired)
+                expired = []
+                window = 1
+            while pending and len(in_flight) < window and not ready:
+                service_id = pending.popleft()
+                self.touch()
+                tp.send_request([service_id])
+                sent_at = time.monotonic()
+                in_flight[service_id] = [sent_at + (self.response_timeout() if timeout is None else timeout),
+                                         sent_at, False]
 
-        # Send request to ECU
-        request = [ServiceID.READ_DATA_BY_IDENTIFIER]
-        request.extend(convert_to_byte_list(did))
+            payload = tp.receive_message(max(0.0, min(probe[0] for probe in in_flight.values()) - time.monotonic()))
+            if payload is None:
+                # Responses already received are handled first, so only probes without one expire
+                now = time.monotonic()
+                for service_id in [service_id for service_id, probe in in_flight.items() if probe[0] <= now]:
+                    del in_flight[service_id]
+                    if window > 1:
+                        expired.append(service_id)
+                continue
+            response = Iso14229_1.parse_response(payload)
+            if response is None:
+                continue
+            probe = in_flight.get(response.service_id)
+            if Iso14229_1.is_response_pending(response, response.service_id):
+                if probe is not None:
+                    # The server needs more time - the final response is due within P2*
+                    probe[0] = time.monotonic() + self.p2_star_server
+                    probe[2] = True
+                continue
+            # Late responses to retired probes still tell which service is available
+            if response.service_id in expired:
+                expired.remove(response.service_id)
+            if self.record_service_response(session, response):
+                ready.append(ServiceRecord(self, session.session_id, response.service_id, time.monotonic()))
+            if probe is not None:
+                del in_flight[response.service_id]
+                if not probe[2] and self.latency is not None:
+                    self.latency.add_sample(self.server_id, time.monotonic() - probe[1])
+        yield from ready
 
-        with IsoTp(arb_id_request=self.client_id, arb_id_response=self.server_id) as tp:
-            tp.send_request(request)
-            # Get response
-            msg = tp.bus.recv(0.1)
-            if msg is None:
-                return None
-            # Parse response
-            if len(msg.data) > 3:
-                data_length = msg.data[2]
-                data = msg.data[3:3 + data_length]
-                return data
+    def probe_service(self, session_id: int, service_id: int, timeout: float = None, channel=None):
+        """Returns True if 'service_id' is answered as available in session 'session_id'"""
+        session = Session(session_id, self.get_session(session_id).path)
+        with self.open_tp(self.client_id, self.server_id, channel=channel) as tp:
+            self.enter_session(tp, session, self.current_session())
+            response = self.uds_request(tp, [service_id], timeout)
+            if response is not None:
+                self.record_service_response(session, response)
+
+            # Switch back to default session
+            self.switch_to_session(DEFAULT_SESSION, tp)
+        return service_id in session.services
+
+    def record_service_response(self, session: Session, response):
+        """
+        Adds the service answered by 'response' to 'session' if the response shows it is available
+
+        :return: True if the service was added, False if it is not available or already known
+        """
+        if response.positive or response.nrc in NRC_FOR_AVAILABLE_SERVICE:
+            return session.add_service(response.service_id)
+        return False
+
+    def get_data_from_ecu_by_identifier(self, did: int, channel=None, session_id=None):
+        return self.read_data_by_identifiers([did], channel, session_id).get(did)
+
+    def read_data_by_identifiers(self, dids, channel=None, session_id=None):
+        """
+        Reads 'dids' packing as many DIDs into each ReadDataByIdentifier request as the ECU accepts.
+        The batch size is halved whenever the ECU rejects a request as too long (NRC 0x13/0x14) and
+        the reduced size is kept for later reads.
+
+        :param dids: Data identifiers to read
+        :param channel: CAN channel, used when the ECU has no bus pool
+        :param session_id: Session to read in, defaults to the first session supporting the service
+        :return: Dict mapping each DID to its data, or None if the ECU did not return it
+        """
+        return dict(self.iter_data_by_identifiers(dids, channel, session_id))
+
+    def iter_data_by_identifiers(self, dids, channel=None, session_id=None):
+        """
+        Reads 'dids' like read_data_by_identifiers(), yielding the DIDs of every request as soon as its
+        response is in
+
+        :return: Generator of (DID, data) tuples, data being None if the ECU did not return the DID
+        """
+        if session_id is None:
+            session_id = self.find_session_with_service(
+                Services.ReadDataByIdentifier.service_id)
+
+        pending = list(dids)
+
+        with self.open_tp(self.client_id, self.server_id, channel=channel) as tp:
+            self.enter_session(tp, self.get_session(session_id), self.current_session())
+            while pending:
+                batch = pending[:self.max_dids_per_request]
+
+                # Send request to ECU
+                request = [ServiceID.READ_DATA_BY_IDENTIFIER]
+                for did in batch:
+                    request.extend(convert_to_byte_list(did))
+
+                # Get response
+                response = self.uds_request(tp, request)
+                if response is not None and not response.positive \
+                        and response.nrc in self.NRC_FOR_SPLIT_REQUEST and len(batch) > 1:
+                    # Too many DIDs for the ECU - retry with half the batch
+                    self.max_dids_per_request = max(1, len(batch) // 2)
+                    continue
+                pending = pending[len(batch):]
+
+                # Parse response
+                results = {}
+                if response is not None and response.positive:
+                    guessed = []
+                    results = self.parse_data_by_identifiers(batch, response.data, guessed)
+                    while guessed:
+                        # The next DID may also occur inside binary data - read the DID alone to learn its length
+                        did = guessed[0]
+                        single = self.uds_request(
+                            tp, [ServiceID.READ_DATA_BY_IDENTIFIER] + convert_to_byte_list(did))
+                        if single is not None and single.positive:
+                            self.parse_data_by_identifiers([did], single.data)
+                        if did not in self.did_lengths:
+                            break
+                        guessed = []
+                        results = self.parse_data_by_identifiers(batch, response.data, guessed)
+                for did in batch:
+                    yield did, results.get(did)
+
+    def parse_data_by_identifiers(self, dids, response, guessed=None):
+        """
+        Splits a positive ReadDataByIdentifier response into the records of 'dids'. The response has no
+        length fields: records come in request order (unsupported DIDs are left out) and a record ends
+        at its known length or, for DIDs not read alone before, at the next requested DID.
+
+        :param dids: DIDs of the request, in request order
+        :param response: Data of the positive response, following the response SID
+        :param guessed: List receiving the DIDs whose record end was taken from the next requested DID
+                        found in the response, in response order, or None
+        :return: Dict mapping the DIDs found in the response to their data
+        """
+        results = {}
+        remaining = list(dids)
+        position = 0
+        while position + 2 <= len(response) and remaining:
+            did = (response[position] << 8) | response[position + 1]
+            if did not in remaining:
+                # Malformed response
+                break
+            remaining = remaining[remaining.index(did) + 1:]
+            start = position + 2
+
+            if len(dids) == 1:
+                # The whole response belongs to a single DID
+                end = len(response)
+                self.did_lengths[did] = end - start
+            elif did in self.did_lengths:
+                end = start + self.did_lengths[did]
+            else:
+                end = len(response)
+                for next_did in remaining:
+                    next_position = response.find(
+                        bytes(convert_to_byte_list(next_did)), start)
+                    if next_position != -1:
+                        end = min(end, next_position)
+                if end != len(response) and guessed is not None:
+                    guessed.append(did)
+
+            results[did] = response[start:end]
+            position = end
+        return results
 
     def request_seed_security_access(self, level: int, channel=None):
         needed_session = self.find_session_with_service(
@@ -102,22 +525,76 @@ class ECU:
         # Send request to ECU
         request = [ServiceID.SECURITY_ACCESS, level]
 
-        with IsoTp(None, None, channel=channel) as tp:
-            self.switch_to_session(needed_session, tp)
-            tp.send_request(request)
+        with self.open_tp(self.client_id, self.server_id, channel=channel) as tp:
+            self.enter_session(tp, self.get_session(needed_session), self.current_session())
             # Get response
-            msg = tp.bus.recv(0.1)
-            if msg is None:
+            response = self.uds_request(tp, request)
+            if response is None or not response.positive:
                 return None
             # Parse response
-            if len(msg.data) > 3:
-                data_length = msg.data[2]
-                data = msg.data[3:3 + data_length]
-                return data
+            if len(response.data) >= 1 and response.data[0] == level:
+                return response.data[1:]
+            return None
 
     def switch_to_session(self, session_id: int, tp: IsoTp):
-        return send_and_receive(
-            tp, [Services.DiagnosticSessionControl.service_id, session_id], self.client_id, timeout=0.1)
+        response = self.uds_request(tp, [Services.DiagnosticSessionControl.service_id, session_id])
+        if response is None:
+            # The switch may or may not have happened
+            self.set_active_session(None)
+        elif response.positive:
+            self.set_active_session(session_id)
+        return response
+
+    def set_active_session(self, session_id):
+        """Records the session the ECU is in (None if not known) and holds it there with the keep-alive"""
+        self.active_session = session_id
+        if self.keep_alive is None:
+            return
+        if session_id is None:
+            self.keep_alive.release(self.client_id)
+        else:
+            self.keep_alive.hold(self.client_id, session_id)
+
+    def current_session(self):
+        """
+        Returns the session the ECU is in, or None if it is not known. Without a keep-alive, a non-default
+        session is only trusted for TESTER_PRESENT_PERIOD after the last request, well within S3.
+        """
+        if self.active_session is None or self.active_session == DEFAULT_SESSION:
+            return self.active_session
+        if self.keep_alive is not None and self.keep_alive.is_held(self.client_id):
+            return self.active_session
+        if time.monotonic() - self.last_request < TESTER_PRESENT_PERIOD:
+            return self.active_session
+        return None
+
+    def touch(self):
+        """Notes a request sent to the ECU, postponing its TesterPresent"""
+        self.last_request = time.monotonic()
+        if self.keep_alive is not None:
+            self.keep_alive.touch(self.client_id)
+
+    def enter_session(self, tp: IsoTp, session: Session, current=None):
+        """
+        Switches to 'session' along Session.route()
+
+        :param tp: IsoTp to the ECU
+        :param session: Session to enter
+        :param current: Active session, or None if it is not known
+        :return: True if every switch succeeded
+        """
+        for session_id in session.route(current):
+            response = self.switch_to_session(session_id, tp)
+            if response is None or not response.positive:
+                return False
+        return True
+
+    def get_session(self, session_id: int):
+        """Returns the discovered Session 'session_id', or a Session entered directly from the default session"""
+        for session in self.sessions:
+            if session.session_id == session_id:
+                return session
+        return Session(session_id)
 
     def find_session_with_service(self, service_id: int):
         for session in self.sessions:
@@ -1,63 +1,166 @@
 import argparse
+import json
+import os
+
+from async_can_adapter import AsyncCANAdapter
 from can_adapter import CANAdapter
+from multi_channel import ChannelJob, print_report, scan_channels
+from utils.bus_backends import BACKENDS, DEFAULT_BACKEND, ReplayBackend, get_backend
 from utils.common import get_car_type
+from utils.constants import PART_NUMBER_DID, TESTER_PRESENT_PERIOD, VIN_DID
+from utils.fingerprint_cache import FingerprintCache
+from utils.protocol_types import infer_protocol_offline
 
 
-def get_part_type(data):
-    for ecu, ecu_data_list in data:
-        for did, data in ecu_data_list:
-            if did == 0xF187:
-                print(
-                    f"ECU ID: 0x{ecu.client_id:04X}, Server ID: 0x{ecu.server_id:04X}")
-                print(f"DID: {hex(did)}, Data: {data.hex()}")
-                car_type = get_car_type(data)
-                print(
-                    f"Part Type: {'Unknown' if car_type is None else car_type}")
+def get_part_type(results):
+    for result in results:
+        if result.data is None:
+            continue
+        print(
+            f"ECU ID: 0x{result.ecu.client_id:04X}, Server ID: 0x{result.ecu.server_id:04X}")
+        print(f"DID: {hex(result.did)}, Data: {result.data.hex()}")
+        car_type = get_car_type(result.data)
+        print(
+            f"Part Type: {'Unknown' if car_type is None else car_type}")
 
 
-def get_vin_number(data):
-    for ecu, ecu_data_list in data:
-        for did, data in ecu_data_list:
-            if did == 0xF190:
-                print(
-                    f"ECU ID: 0x{ecu.client_id:04X}, Server ID: 0x{ecu.server_id:04X}")
-                print(f"DID: {hex(did)}, Data: {data.hex()}")
-                vin_number = data.decode('utf-8')
-                print(f"VIN Number: {vin_number}")
+def get_vin_number(results):
+    for result in results:
+        if result.data is None:
+            continue
+        print(
+            f"ECU ID: 0x{result.ecu.client_id:04X}, Server ID: 0x{result.ecu.server_id:04X}")
+        print(f"DID: {hex(result.did)}, Data: {result.data.hex()}")
+        vin_number = result.data.decode('utf-8', errors='replace')
+        print(f"VIN Number: {vin_number}")
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="CAN UDS Prober")
     parser.add_argument("--dbc-file", help="Path to the DBC file (optional)")
+    parser.add_argument("--interface", default=DEFAULT_BACKEND, choices=BACKENDS,
+                        help=f"Bus backend (default: {DEFAULT_BACKEND})")
+    parser.add_argument("--replay-file",
+                        help="Log file replayed by the replay backend")
+    parser.add_argument("--replay-speed", type=float,
+                        help="Replay speed relative to the recording (default: as fast as possible)")
+    parser.add_argument("--replay-start", type=float,
+                        help="Timestamp to start the replay (or the --analyse window) at (optional)")
+    parser.add_argument("--replay-end", type=float,
+                        help="Timestamp to end the --analyse window at (optional)")
+    parser.add_argument("--analyse", nargs="+", metavar="CAPTURE",
+                        help="Only infer the protocol of these .rec captures offline, without a bus")
     parser.add_argument("--channel", default="can0",
                         help="CAN interface channel (default: can0)")
+    parser.add_argument("--channels", nargs="+",
+                        help="Scan these channels in parallel, one process each, instead of --channel")
+    parser.add_argument("--log-dir",
+                        help="Directory receiving the output of each --channels scan (optional)")
+    parser.add_argument("--report",
+                        help="Write the merged report of a --channels scan to this JSON file (optional)")
+    parser.add_argument("--window", type=int, default=1,
+                        help="Number of ECU scan requests kept in flight (default: 1)")
+    parser.add_argument("--extended", action="store_true",
+                        help="Scan for ECUs with 29-bit normal fixed addressing instead of 11-bit IDs")
+    parser.add_argument("--fd", action="store_true",
+                        help="Use CAN FD frames (ISO-TP FD framing) towards the ECUs")
+    parser.add_argument("--use-notifier", action="store_true",
+                        help="Receive frames on a notifier thread instead of polling the bus")
+    parser.add_argument("--exhaustive-services", action="store_true",
+                        help="Probe every service ID 0x00-0xFE instead of the UDS and OEM request ranges, and every "
+                             "session ID from every session found")
+    parser.add_argument("--async-scan", action="store_true",
+                        help="Discover sessions and services of all ECUs concurrently")
+    parser.add_argument("--tester-present-period", type=float, default=TESTER_PRESENT_PERIOD,
+                        help="Seconds between the TesterPresent keep-alives of ECUs held in non-default sessions "
+                             f"(default: {TESTER_PRESENT_PERIOD}, 0 disables them)")
+    parser.add_argument("--cache",
+                        help="Path to the ECU fingerprint cache of known vehicles (optional)")
+    parser.add_argument("--vin",
+                        help="VIN of the vehicle, to look it up in the cache before scanning (optional)")
+    parser.add_argument("--capture",
+                        help="Only capture the bus to this file (.rec, .blf, .asc, .log, ...) instead of scanning")
+    parser.add_argument("--capture-duration", type=float,
+                        help="Capture duration in seconds (default: until Ctrl+C)")
+    parser.add_argument("--decoded-file",
+                        help="Also write the capture decoded with the DBC file to this file (optional)")
     args = parser.parse_args()
 
-    adapter = CANAdapter(
-        interface="socketcan",
+    if args.analyse:
+        for capture_file in args.analyse:
+            result = infer_protocol_offline(
+                capture_file, start=args.replay_start, end=args.replay_end)
+            print(f"{capture_file}: {result.value}")
+        raise SystemExit(0)
+
+    if args.channels:
+        jobs = [ChannelJob(channel, interface=args.interface, window=args.window, extended=args.extended,
+                           fd=args.fd, use_notifier=args.use_notifier, exhaustive_services=args.exhaustive_services,
+                           log_file=os.path.join(args.log_dir, f"{channel}.log") if args.log_dir else None)
+                for channel in args.channels]
+        report = scan_channels(jobs)
+        print_report(report)
+        if args.report:
+            with open(args.report, "w") as file:
+                json.dump(report, file, indent=2)
+        raise SystemExit(0)
+
+    if args.interface == ReplayBackend.NAME:
+        if not args.replay_file:
+            parser.error("--replay-file is required by the replay backend")
+        backend = ReplayBackend(
+            args.replay_file, speed=args.replay_speed, start=args.replay_start)
+    else:
+        backend = get_backend(args.interface)
+
+    adapter_class = AsyncCANAdapter if args.async_scan else CANAdapter
+    adapter = adapter_class(
+        interface=backend,
         channel=args.channel,
         bitrate=500000,
-        dbc_file=args.dbc_file
+        dbc_file=args.dbc_file,
+        use_notifier=args.use_notifier,
+        fd=args.fd,
+        tester_present_period=args.tester_present_period
     )
 
+    if args.capture:
+        adapter.capture(args.capture, args.capture_duration,
+                        decoded_file=args.decoded_file)
+        adapter.shutdown()
+        raise SystemExit(0)
+
     result = adapter.infer_protocol()
     print(f"Inferred Protocol: {result}")
 
-    adapter.collect_ecus()
-    print("=" * 20)
-    adapter.gather_ecu_info()
+    cache = FingerprintCache(args.cache) if args.cache else None
+    restored = False
+    if cache and args.vin:
+        restored = adapter.restore_ecus_from_cache(cache, vin=args.vin)
+    if not restored:
+        if args.extended:
+            adapter.collect_ecus_extended(window=args.window)
+        else:
+            adapter.collect_ecus(window=args.window)
+        print("=" * 20)
+        if cache:
+            restored = adapter.restore_ecus_from_cache(cache)
+    if not restored:
+        adapter.gather_ecu_info(exhaustive=args.exhaustive_services)
     adapter.print_ecu_info()
     print("=" * 20)
 
     adapter.print_data_from_ecus_by_identifer()
     print("=" * 20)
 
-    # type list of List[(ecu, List(did, data))]
-    data_by_identifier = adapter.get_data_from_ecus_by_identifer()
-    get_part_type(data_by_identifier)
+    # DIDs were read once by the printer above, lookups go to the result store
+    get_part_type(adapter.results.by_did(PART_NUMBER_DID))
     print("=" * 20)
-    get_vin_number(data_by_identifier)
+    get_vin_number(adapter.results.by_did(VIN_DID))
     print("=" * 20)
+    if cache:
+        adapter.save_ecus_to_cache(cache)
+        cache.close()
     sec_seed = adapter.get_security_access(sec_level=1)
     print(f"Level 1 Security Seed: {sec_seed}")
 
@@ -0,0 +1,161 @@
+import contextlib
+import io
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from can_adapter import CANAdapter
+from utils import constants
+from utils.bus_backends import DEFAULT_BACKEND
+
+
+class ChannelJob:
+    """
+    Scan of one channel, run in a worker process. Only plain values, so the job pickles.
+
+    :param channel: CAN interface channel, e.g. can0
+    :param interface: Name of the bus backend, see utils.bus_backends.BACKENDS
+    :param cpu: CPU the worker is pinned to, or None to leave its affinity alone
+    :param window: Number of ECU scan requests kept in flight
+    :param extended: Scan for ECUs with 29-bit normal fixed addressing
+    :param fd: Use CAN FD frames towards the ECUs
+    :param use_notifier: Receive frames on a notifier thread
+    :param read_dids: Read the identification DIDs of the ECUs found
+    :param exhaustive_services: Probe every service ID 0x00-0xFE and every session ID from every session found
+    :param log_file: File receiving the output of the scan, or None to discard it
+    """
+
+    def __init__(self, channel, interface=DEFAULT_BACKEND, cpu=None, window=16, extended=False, fd=False,
+                 use_notifier=False, read_dids=True, exhaustive_services=False, log_file=None):
+        self.channel = channel
+        self.interface = interface
+        self.cpu = cpu
+        self.window = window
+        self.extended = extended
+        self.fd = fd
+        self.use_notifier = use_notifier
+        self.read_dids = read_dids
+        self.exhaustive_services = exhaustive_services
+        self.log_file = log_file
+
+
+def available_cpus():
+    """Returns the CPUs this process may run on"""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def pin_to_cpu(cpu):
+    """Pins the calling process to 'cpu' where the platform supports it"""
+    if cpu is not None and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, {cpu})
+
+
+def channel_report(adapter, protocol):
+    """Returns the ECUs, sessions, services and DIDs found by 'adapter' as a JSON serialisable dict"""
+    ecus = []
+    for ecu in adapter.ECUs:
+        dids = {}
+        for did in constants.DID_IDENTIFIERS:
+            for result in adapter.results.by_did(did):
+                if result.ecu is ecu and result.data is not None:
+                    dids[f"0x{did:04X}"] = result.data.hex()
+        ecus.append({
+            "client_id": ecu.client_id,
+            "server_id": ecu.server_id,
+            "sessions": {str(session.session_id): session.services for session in ecu.sessions},
+            "dids": dids,
+        })
+    return {"protocol": protocol.value, "ecus": ecus}
+
+
+def scan_channel(job):
+    """
+    Scans one channel: protocol detection, ECU discovery, sessions and services, and DIDs. Runs in a worker
+    process with its own bus socket and scan state.
+
+    :param job: ChannelJob
+    :return: Report dict of the channel
+    """
+    pin_to_cpu(job.cpu)
+    start = time.monotonic()
+    report = {"channel": job.channel, "cpu": job.cpu, "pid": os.getpid()}
+    with contextlib.ExitStack() as stack:
+        output = stack.enter_context(open(job.log_file, "w")) if job.log_file else io.StringIO()
+        stack.enter_context(contextlib.redirect_stdout(output))
+        try:
+            adapter = CANAdapter(job.interface, job.channel, 500000, use_notifier=job.use_notifier, fd=job.fd)
+        except Exception as e:
+            report.update(error=f"Failed to open {job.channel}: {e}", ecus=[],
+                          wall_time=time.monotonic() - start)
+            return report
+        try:
+            protocol = adapter.infer_protocol()
+            if job.extended:
+                adapter.collect_ecus_extended(window=job.window)
+            else:
+                adapter.collect_ecus(window=job.window)
+            adapter.gather_ecu_info(exhaustive=job.exhaustive_services)
+            if job.read_dids:
+                adapter.read_data_from_ecus_by_identifier()
+            report.update(channel_report(adapter, protocol))
+        except Exception as e:
+            report.update(error=str(e), ecus=[])
+        finally:
+            adapter.shutdown()
+    report["wall_time"] = time.monotonic() - start
+    return report
+
+
+def scan_channels(jobs, processes=None, scan=scan_channel):
+    """
+    Scans the channels of 'jobs' in parallel, one worker process per channel. Jobs without a CPU are spread
+    round robin over the CPUs available to this process.
+
+    :param jobs: List of ChannelJob
+    :param processes: Number of worker processes, or None for one per job
+    :param scan: Picklable function run with each job in its worker, scan_channel() or a wrapper of it
+    :return: Merged report, see merge_reports()
+    """
+    cpus = available_cpus()
+    for index, job in enumerate(jobs):
+        if job.cpu is None:
+            job.cpu = cpus[index % len(cpus)]
+    start = time.monotonic()
+    with ProcessPoolExecutor(max_workers=processes or len(jobs)) as executor:
+        reports = list(executor.map(scan, jobs))
+    return merge_reports(reports, time.monotonic() - start)
+
+
+def merge_reports(reports, wall_time):
+    """
+    Merges the reports of the channels into one
+
+    :param reports: List of channel report dicts
+    :param wall_time: Wall time of the whole run
+    :return: Dict with the channel reports, the totals and the speedup over scanning the channels one by one
+    """
+    channel_time = sum(report["wall_time"] for report in reports)
+    return {
+        "channels": sorted(reports, key=lambda report: report["channel"]),
+        "ecus": sum(len(report["ecus"]) for report in reports),
+        "errors": sum(1 for report in reports if "error" in report),
+        "wall_time": wall_time,
+        "channel_time": channel_time,
+        "speedup": channel_time / wall_time if wall_time > 0 else 0.0,
+    }
+
+
+def print_report(report):
+    for channel in report["channels"]:
+        print(f"{channel['channel']} (CPU {channel['cpu']}, PID {channel['pid']}): "
+              f"{channel.get('protocol', 'no protocol')}, {len(channel['ecus'])} ECUs "
+              f"in {channel['wall_time']:.1f} s")
+        if "error" in channel:
+            print(f"  Error: {channel['error']}")
+        for ecu in channel["ecus"]:
+            print(f"  ECU 0x{ecu['client_id']:X} -> 0x{ecu['server_id']:X}: "
+                  f"{len(ecu['sessions'])} sessions, {len(ecu['dids'])} DIDs")
+    print(f"{report['ecus']} ECUs on {len(report['channels'])} channels in {report['wall_time']:.1f} s "
+          f"({report['speedup']:.1f}x faster than one channel after the other)")
@@ -0,0 +1,362 @@
+import heapq
+import random
+import threading
+import time
+
+import can
+
+from utils import constants
+from utils.bus_backends import get_backend
+from utils.iso14229_1 import Iso14229_1, NegativeResponseCodes, ServiceID, Services
+from utils.iso15765_2 import IsoTp
+
+
+class VirtualEcu:
+    """
+    Configuration and UDS state of a simulated ECU
+
+    :param client_id: Arbitration ID the ECU receives requests on
+    :param server_id: Arbitration ID the ECU responds on
+    :param sessions: Dict mapping session IDs to the service IDs available in them
+    :param transitions: Dict mapping session IDs to the sessions they can be entered from, refused with NRC 0x7E
+                        from other sessions. Sessions not in it can be entered from any session.
+    :param dids: Dict mapping DIDs to their data (bytes), readable in every session offering 0x22
+    :param latency: Seconds between a complete request and the response
+    :param jitter: Maximum number of seconds randomly added to 'latency'
+    :param nrc: Dict mapping service IDs to the NRC a request without parameters is answered with,
+                instead of NRC 0x13 (incorrect message length)
+    :param response_pending: Service IDs answered with NRC 0x78 before the final response
+    :param pending_delay: Seconds between the NRC 0x78 and the final response
+    :param max_dids_per_request: Number of DIDs accepted per ReadDataByIdentifier request
+    :param p2_server: P2 reported in DiagnosticSessionControl responses (seconds)
+    :param p2_star_server: P2* reported in DiagnosticSessionControl responses (seconds)
+    :param s3_timeout: Seconds without requests after which the ECU falls back to the default session
+    :param functional: The ECU answers functional (broadcast) requests
+    :param fd: The ECU responds with CAN FD frames of up to 64 bytes (ISO-TP FD framing)
+    """
+
+    def __init__(self, client_id, server_id, sessions=None, transitions=None, dids=None, latency=0.002, jitter=0.0, nrc=None,
+                 response_pending=(), pending_delay=0.2, max_dids_per_request=8, p2_server=0.05,
+                 p2_star_server=5.0, s3_timeout=5.0, functional=True, fd=False):
+        default_session = Services.DiagnosticSessionControl.DiagnosticSessionType.DEFAULT_SESSION
+        self.client_id = client_id
+        self.server_id = server_id
+        self.sessions = sessions if sessions is not None else {
+            default_session: {ServiceID.DIAGNOSTIC_SESSION_CONTROL, ServiceID.TESTER_PRESENT}}
+        self.transitions = transitions if transitions is not None else {}
+        self.dids = dids if dids is not None else {}
+        self.latency = latency
+        self.jitter = jitter
+        self.nrc = nrc if nrc is not None else {}
+        self.response_pending = set(response_pending)
+        self.pending_delay = pending_delay
+        self.max_dids_per_request = max_dids_per_request
+        self.p2_server = p2_server
+        self.p2_star_server = p2_star_server
+        self.s3_timeout = s3_timeout
+        self.functional = functional
+        self.fd = fd
+
+        self.session = default_session
+        self.last_request = 0.0
+        # Reassembly state of a multi-frame request
+        self.rx_buffer = None
+        self.rx_length = 0
+        # Consecutive frames (CF) of a multi-frame response waiting for flow control (FC)
+        self.tx_frames = []
+
+    def response_delay(self, rng):
+        return self.latency + rng.uniform(0, self.jitter)
+
+    def handle_request(self, request, now):
+        """
+        Processes a complete request
+
+        :param request: Request payload
+        :param now: Current time on the time.monotonic() clock
+        :return: List of (delay in seconds, response payload) tuples, the delays being cumulative
+        """
+        default_session = Services.DiagnosticSessionControl.DiagnosticSessionType.DEFAULT_SESSION
+        if self.session != default_session and now - self.last_request > self.s3_timeout:
+            # S3 expired - fall back to the default session
+            self.session = default_session
+        self.last_request = now
+
+        service_id = request[0]
+        if service_id == ServiceID.TESTER_PRESENT and len(request) > 1 and request[1] & 0x80:
+            # Positive response suppressed
+            return []
+        response = self._response(request)
+        if service_id in self.response_pending:
+            pending = [Iso14229_1.NEGATIVE_RESPONSE_ID, service_id,
+                       NegativeResponseCodes.REQUEST_CORRECTLY_RECEIVED_RESPONSE_PENDING]
+            return [(0.0, pending), (self.pending_delay, response)]
+        return [(0.0, response)]
+
+    def _response(self, request):
+        service_id = request[0]
+        available_services = self.sessions.get(self.session, set())
+
+        if service_id not in available_services:
+            if any(service_id in services for services in self.sessions.values()):
+                return self._negative(service_id, NegativeResponseCodes.SERVICE_NOT_SUPPORTED_IN_ACTIVE_SESSION)
+            return self._negative(service_id, NegativeResponseCodes.SERVICE_NOT_SUPPORTED)
+        if service_id in self.nrc and len(request) == 1:
+            return self._negative(service_id, self.nrc[service_id])
+
+        if service_id == ServiceID.DIAGNOSTIC_SESSION_CONTROL:
+            return self._session_control(request)
+        if service_id == ServiceID.TESTER_PRESENT and len(request) == 2:
+            return [Iso14229_1.get_service_response_id(service_id), request[1]]
+        if service_id == ServiceID.READ_DATA_BY_IDENTIFIER:
+            return self._read_data_by_identifier(request)
+        if service_id == ServiceID.SECURITY_ACCESS and len(request) == 2 and request[1] % 2 == 1:
+            seed = [(request[1] * 0x11 + i) & 0xFF for i in range(4)]
+            return [Iso14229_1.get_service_response_id(service_id), request[1]] + seed
+        return self._negative(service_id, NegativeResponseCodes.INCORRECT_MESSAGE_LENGTH_OR_INVALID_FORMAT)
+
+    def _session_control(self, request):
+        service_id = request[0]
+        if len(request) != 2:
+            return self._negative(service_id, NegativeResponseCodes.INCORRECT_MESSAGE_LENGTH_OR_INVALID_FORMAT)
+        session_id = request[1] & 0x7F
+        if session_id not in self.sessions:
+            return self._negative(service_id, NegativeResponseCodes.SUB_FUNCTION_NOT_SUPPORTED)
+        if session_id != self.session and self.session not in self.transitions.get(session_id, self.sessions):
+            return self._negative(service_id, NegativeResponseCodes.SUB_FUNCTION_NOT_SUPPORTED_IN_ACTIVE_SESSION)
+        self.session = session_id
+        p2 = int(self.p2_server * 1000)
+        p2_star = int(self.p2_star_server * 100)
+        return [Iso14229_1.get_service_response_id(service_id), session_id,
+                p2 >> 8, p2 & 0xFF, p2_star >> 8, p2_star & 0xFF]
+
+    def _read_data_by_identifier(self, request):
+        service_id = request[0]
+        if len(request) < 3 or len(request) % 2 != 1:
+            return self._negative(service_id, NegativeResponseCodes.INCORRECT_MESSAGE_LENGTH_OR_INVALID_FORMAT)
+        dids = [(request[i] << 8) | request[i + 1]
+                for i in range(1, len(request), 2)]
+        if len(dids) > self.max_dids_per_request:
+            return self._negative(service_id, NegativeResponseCodes.INCORRECT_MESSAGE_LENGTH_OR_INVALID_FORMAT)
+        response = [Iso14229_1.get_service_response_id(service_id)]
+        for did in dids:
+            if did in self.dids:
+                response.extend([did >> 8, did & 0xFF])
+                response.extend(self.dids[did])
+        if len(response) == 1:
+            return self._negative(service_id, NegativeResponseCodes.REQUEST_OUT_OF_RANGE)
+        if len(response) > (IsoTp.MAX_MESSAGE_LENGTH_FD if self.fd else IsoTp.MAX_MESSAGE_LENGTH):
+            return self._negative(service_id, NegativeResponseCodes.RESPONSE_TOO_LONG)
+        return response
+
+    @staticmethod
+    def _negative(service_id, nrc):
+        return [Iso14229_1.NEGATIVE_RESPONSE_ID, service_id, nrc]
+
+
+class VirtualVehicle:
+    """
+    Deterministic simulated vehicle on a bus backend (by default python-can's in-process virtual bus).
+    A background thread answers diagnostic requests of the configured VirtualEcus over ISO-TP, including
+    multi-frame requests and responses, and optionally generates periodic background traffic.
+
+    :param ecus: List of VirtualEcu
+    :param channel: Channel of the bus the scanner under test uses
+    :param interface: BusBackend or its name, e.g. "virtual" or "udp_multicast"
+    :param seed: Seed of the jitter generator
+    :param background: List of (arbitration ID, period in seconds) of periodic non-diagnostic frames
+    :param functional_ids: Arbitration IDs of functional (broadcast) requests
+    """
+
+    def __init__(self, ecus, channel="vcan0", interface="virtual", seed=0, background=(),
+                 functional_ids=(constants.UDS_BROADCAST_ID, constants.UDS_BROADCAST_ID_EXTENDED)):
+        self.ecus = {ecu.client_id: ecu for ecu in ecus}
+        self.functional_ids = set(functional_ids)
+        self.background = list(background)
+        self.rng = random.Random(seed)
+        self.bus = get_backend(interface).open(channel)
+        self.frames_received = 0
+        self.frames_sent = 0
+        self.background_frames_sent = 0
+        self._scheduled = []  # heap of (due time, sequence number, can.Message, period or None)
+        self._sequence = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        now = time.monotonic()
+        for arbitration_id, period in self.background:
+            self._schedule_background(arbitration_id, period, now)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self.bus.shutdown()
+
+    @property
+    def frame_count(self):
+        """Number of diagnostic frames sent and received by the vehicle, without background traffic"""
+        return self.frames_received + self.frames_sent
+
+    def _run(self):
+        while not self._stopped.is_set():
+            now = time.monotonic()
+            while self._scheduled and self._scheduled[0][0] <= now:
+                _, _, msg, period = heapq.heappop(self._scheduled)
+                self.bus.send(msg)
+                if period is not None:
+                    # Background frame - reschedule
+                    self._schedule_background(
+                        msg.arbitration_id, period, now + period)
+                    self.background_frames_sent += 1
+                else:
+                    self.frames_sent += 1
+            timeout = 0.05
+            if self._scheduled:
+                timeout = min(timeout, max(
+                    0.0, self._scheduled[0][0] - time.monotonic()))
+            msg = self.bus.recv(timeout)
+            if msg is not None:
+                self.frames_received += 1
+                self._on_frame(msg, time.monotonic())
+
+    def _schedule(self, due, msg, period=None):
+        self._sequence += 1
+        heapq.heappush(self._scheduled, (due, self._sequence, msg, period))
+
+    def _schedule_background(self, arbitration_id, period, due):
+        msg = can.Message(arbitration_id=arbitration_id, data=[self.rng.randrange(0x100) for _ in range(8)],
+                          is_extended_id=arbitration_id > constants.ARBITRATION_ID_MAX)
+        self._schedule(due, msg, period)
+
+    def _message(self, ecu, data):
+        return can.Message(arbitration_id=ecu.server_id, data=data,
+                           is_extended_id=ecu.server_id > constants.ARBITRATION_ID_MAX,
+                           is_fd=ecu.fd, bitrate_switch=ecu.fd)
+
+    def _on_frame(self, msg, now):
+        if msg.arbitration_id in self.functional_ids:
+            # Functional requests are single frames, answered by every ECU listening to them
+            frame = msg.data
+            if len(frame) > 1 and frame[0] >> 4 == IsoTp.SF_FRAME_ID:
+                request = frame[1:1 + (frame[0] & 0x0F)]
+                for ecu in self.ecus.values():
+                    if ecu.functional and (ecu.client_id > constants.ARBITRATION_ID_MAX) == msg.is_extended_id:
+                        self._respond(ecu, request, now)
+            return
+        ecu = self.ecus.get(msg.arbitration_id)
+        if ecu is None or len(msg.data) == 0:
+            return
+        frame = msg.data
+        frame_type = frame[0] >> 4
+        if frame_type == IsoTp.SF_FRAME_ID:
+            length = frame[0] & 0x0F
+            if 0 < length < len(frame):
+                self._respond(ecu, frame[1:1 + length], now)
+            elif length == 0 and len(frame) > IsoTp.MAX_FRAME_LENGTH:
+                # Escape sequence SF
+                self._respond(ecu, frame[2:2 + frame[1]], now)
+        elif frame_type == IsoTp.FF_FRAME_ID:
+            ecu.rx_length = ((frame[0] & 0x0F) << 8) | frame[1]
+            pci_length = IsoTp.FF_PCI_LENGTH
+            if ecu.rx_length == 0:
+                # Escape sequence FF
+                ecu.rx_length = int.from_bytes(frame[2:6], "big")
+                pci_length = IsoTp.FF_ESCAPE_PCI_LENGTH
+            ecu.rx_buffer = bytearray(frame[pci_length:])
+            self._schedule(now, self._message(
+                ecu, [IsoTp.FC_FRAME_ID << 4, 0, 0, 0, 0, 0, 0, 0]))
+        elif frame_type == IsoTp.CF_FRAME_ID and ecu.rx_buffer is not None:
+            ecu.rx_buffer.extend(frame[1:])
+            if len(ecu.rx_buffer) >= ecu.rx_length:
+                request = ecu.rx_buffer[:ecu.rx_length]
+                ecu.rx_buffer = None
+                self._respond(ecu, request, now)
+        elif frame_type == IsoTp.FC_FRAME_ID and ecu.tx_frames:
+            # Flow control (FC) from the tester - send the rest of the response, honouring STmin
+            st_min = frame[2] / 1000 if len(frame) > 2 and frame[2] <= 0x7F else 0
+            for index, cf in enumerate(ecu.tx_frames):
+                self._schedule(now + index * st_min, self._message(ecu, cf))
+            ecu.tx_frames = []
+
+    def _respond(self, ecu, request, now):
+        delay = ecu.response_delay(self.rng)
+        for response_delay, response in ecu.handle_request(bytes(request), now):
+            delay += response_delay
+            frames = IsoTp.get_frames_from_message(
+                response, tx_dl=IsoTp.MAX_FRAME_LENGTH_FD if ecu.fd else IsoTp.MAX_FRAME_LENGTH)
+            self._schedule(now + delay, self._message(ecu, frames[0]))
+            # Consecutive frames wait for the tester's flow control
+            ecu.tx_frames = frames[1:]
+
+
+def example_vehicle_ecus(count=4, latency=0.002, jitter=0.001, extended=False, fd=False):
+    """
+    Returns 'count' VirtualEcus modelled on a typical passenger car: physical IDs 0x7E0.. / 0x7E8..,
+    default, programming and extended sessions, identification DIDs including a 17 byte VIN, one
+    ECU answering ReadDataByIdentifier with response pending and one accepting only 2 DIDs per request.
+    The programming session is entered from the extended session only; the first ECU also has a system
+    supplier session (0x60), entered from the extended session only.
+    With 'extended', the ECUs use 29-bit normal fixed addressing (0x18DA<ECU>F1 / 0x18DAF1<ECU>) and
+    the last one does not answer functional requests. With 'fd', the ECUs respond with CAN FD frames.
+    Every ECU also holds a 1 KiB ODX file DID (0xF19E), so DID reads include a large transfer.
+    """
+    session_types = Services.DiagnosticSessionControl.DiagnosticSessionType
+    ecus = []
+    for index in range(count):
+        if extended:
+            address = index * 0x0B
+            client_id = constants.NORMAL_FIXED_PHYSICAL_BASE | (
+                address << 8) | constants.TESTER_ADDRESS
+            server_id = constants.NORMAL_FIXED_PHYSICAL_BASE | (
+                constants.TESTER_ADDRESS << 8) | address
+        else:
+            client_id = 0x7E0 + index if index < 8 else 0x700 + index
+            server_id = client_id + constants.RESPONSE_ID_OFFSET
+        default_services = {ServiceID.DIAGNOSTIC_SESSION_CONTROL, ServiceID.TESTER_PRESENT,
+                            ServiceID.READ_DATA_BY_IDENTIFIER, ServiceID.READ_DTC_INFORMATION}
+        extended_services = default_services | {ServiceID.SECURITY_ACCESS, ServiceID.ROUTINE_CONTROL,
+                                                ServiceID.WRITE_DATA_BY_IDENTIFIER, ServiceID.ECU_RESET}
+        dids = {
+            0xF187: f"5Q0907530{index:02d}".encode(),
+            0xF189: b"0001",
+            0xF18C: f"SN{index:010d}".encode(),
+            0xF190: b"WVWZZZ1JZXW000001",
+            0xF197: f"ECU{index}".encode(),
+            0xF19E: bytes((index + i) & 0xFF for i in range(1024)),
+        }
+        sessions = {
+            session_types.DEFAULT_SESSION: default_services,
+            session_types.PROGRAMMING_SESSION: {ServiceID.DIAGNOSTIC_SESSION_CONTROL, ServiceID.TESTER_PRESENT,
+                                                ServiceID.REQUEST_DOWNLOAD, ServiceID.TRANSFER_DATA},
+            session_types.EXTENDED_DIAGNOSTIC_SESSION: extended_services,
+        }
+        transitions = {session_types.PROGRAMMING_SESSION: {session_types.EXTENDED_DIAGNOSTIC_SESSION}}
+        if index == 0:
+            sessions[session_types.SYSTEM_SUPPLIER_SESSION_MIN] = {
+                ServiceID.DIAGNOSTIC_SESSION_CONTROL, ServiceID.TESTER_PRESENT, ServiceID.ROUTINE_CONTROL,
+                ServiceID.INPUT_OUTPUT_CONTROL_BY_IDENTIFIER}
+            transitions[session_types.SYSTEM_SUPPLIER_SESSION_MIN] = {session_types.EXTENDED_DIAGNOSTIC_SESSION}
+        ecus.append(VirtualEcu(
+            client_id, server_id,
+            sessions=sessions,
+            transitions=transitions,
+            dids=dids,
+            # Bare service requests are refused with "conditions not correct", marking the services available
+            nrc={service_id: NegativeResponseCodes.CONDITIONS_NOT_CORRECT for service_id in extended_services},
+            latency=latency,
+            jitter=jitter,
+            response_pending=(ServiceID.READ_DATA_BY_IDENTIFIER,) if index == 1 else (),
+            max_dids_per_request=2 if index == 2 else 8,
+            functional=not (extended and index == count - 1),
+            fd=fd,
+        ))
+    return ecus
@@ -0,0 +1,31 @@
+import contextlib
+import io
+import os
+import sys
+
+import pytest
+
+# The modules live in the repository root, next to main.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from can_adapter import CANAdapter  # noqa: E402
+from simulator import VirtualVehicle, example_vehicle_ecus  # noqa: E402
+
+VEHICLE_ECUS = 2
+
+
+@pytest.fixture(scope="module")
+def vehicle():
+    """Simulated vehicle of VEHICLE_ECUS example ECUs on a virtual bus of its own"""
+    with VirtualVehicle(example_vehicle_ecus(VEHICLE_ECUS), channel="pytest") as vehicle:
+        yield vehicle
+
+
+@pytest.fixture(scope="module")
+def adapter(vehicle):
+    """CANAdapter on the simulated vehicle, with the ECUs already collected"""
+    adapter = CANAdapter(interface="virtual", channel="pytest", bitrate=500000)
+    with contextlib.redirect_stdout(io.StringIO()):
+        adapter.collect_ecus(0x700, 0x7FF, window=16)
+    yield adapter
+    adapter.shutdown()
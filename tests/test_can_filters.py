@@ -0,0 +1,41 @@
+from utils.can_filters import discovery_filters, id_set_filters, range_filters
+from utils.constants import ARBITRATION_ID_MAX
+
+
+def matched_ids(filters, candidates, extended=False):
+    """Returns the IDs of 'candidates' passing 'filters' the way SocketCAN matches them"""
+    return {can_id for can_id in candidates
+            if any(f["extended"] == extended and can_id & f["can_mask"] == f["can_id"] & f["can_mask"]
+                   for f in filters)}
+
+
+def test_range_filters_match_exactly_the_range():
+    for first, last in ((0x700, 0x7FF), (0x7E0, 0x7EF), (0x123, 0x456), (0x000, 0x7FF), (0x7FF, 0x7FF)):
+        filters = range_filters(first, last)
+        assert matched_ids(filters, range(ARBITRATION_ID_MAX + 1)) == set(range(first, last + 1))
+
+
+def test_range_filters_use_aligned_blocks():
+    assert range_filters(0x700, 0x7FF) == [{"can_id": 0x700, "can_mask": 0x700, "extended": False}]
+    # 0x7E8-0x7EF and 0x7F0-0x7F7
+    assert len(range_filters(0x7E8, 0x7F7)) == 2
+    extended = range_filters(0x18DAF100, 0x18DAF1FF)
+    assert extended == [{"can_id": 0x18DAF100, "can_mask": 0x1FFFFF00, "extended": True}]
+
+
+def test_id_set_filters_match_exactly_the_set():
+    ids = {0x7E8, 0x7E9, 0x7EA, 0x7F0, 0x100}
+    filters = id_set_filters(ids)
+    assert matched_ids(filters, range(ARBITRATION_ID_MAX + 1)) == ids
+    assert len(filters) == 4
+
+
+def test_id_set_filters_split_11_and_29_bit_ids():
+    filters = id_set_filters([0x7FF, 0x800, 0x18DAF101])
+    assert matched_ids(filters, [0x7FF, 0x800, 0x18DAF101]) == {0x7FF}
+    assert matched_ids(filters, [0x7FF, 0x800, 0x18DAF101], extended=True) == {0x800, 0x18DAF101}
+
+
+def test_discovery_filters_leave_out_known_ecus():
+    filters = discovery_filters(range(0x7E8, 0x7F0), known_ids=[0x7E8, 0x7EB])
+    assert matched_ids(filters, range(ARBITRATION_ID_MAX + 1)) == set(range(0x7E8, 0x7F0)) - {0x7E8, 0x7EB}
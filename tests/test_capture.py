@@ -0,0 +1,62 @@
+import can
+
+from utils.capture import CAPTURE_INDEX_STRIDE, RECORD_FILE_HEADER, RECORD_FLAG_EXTENDED, RECORD_FLAG_RX, \
+    RECORD_MAGIC, Capture, RecordReader, RecordWriter, record_struct
+
+CHANNEL = "pytest-capture"
+
+
+def test_capture_streams_records_to_disk(tmp_path):
+    path = tmp_path / "capture.rec"
+    with can.Bus(interface="virtual", channel=CHANNEL) as sender, \
+            can.Bus(interface="virtual", channel=CHANNEL) as receiver:
+        for index in range(1000):
+            sender.send(can.Message(arbitration_id=0x18DAF100 | (index & 0xFF), data=index.to_bytes(4, "big")))
+        # Batches smaller than the capture, so several of them go through the writer thread
+        stats = Capture(receiver, output_file=str(path), batch_size=64).run(duration=0.5)
+    assert stats.received == stats.written == 1000
+    assert stats.decoded == 0
+
+    record = record_struct(8)
+    raw = path.read_bytes()
+    assert RECORD_FILE_HEADER.unpack_from(raw)[:2] == (RECORD_MAGIC, 8)
+    assert len(raw) == RECORD_FILE_HEADER.size + 1000 * record.size
+    _, arbitration_id, flags, length, data = record.unpack_from(raw, RECORD_FILE_HEADER.size + 999 * record.size)
+    assert (arbitration_id, length, data[:length]) == (0x18DAF1E7, 4, (999).to_bytes(4, "big"))
+    assert flags == RECORD_FLAG_EXTENDED | RECORD_FLAG_RX
+
+
+def test_record_round_trip_and_find(tmp_path):
+    path = str(tmp_path / "replay.rec")
+    count = 3 * CAPTURE_INDEX_STRIDE + 10
+    messages = [can.Message(timestamp=index * 0.001, arbitration_id=0x7E8, data=[index & 0xFF] * 8)
+                for index in range(count)]
+    messages.append(can.Message(timestamp=count * 0.001, arbitration_id=0x18DAF110, is_fd=True,
+                                bitrate_switch=True, data=bytes(range(48))))
+    writer = RecordWriter(path, fd=True)
+    writer.write_batch(messages[:1000])
+    writer.write_batch(messages[1000:])
+    writer.stop()
+
+    with RecordReader(path) as reader:
+        assert len(reader) == len(messages)
+        assert all(message.equals(replayed) for message, replayed in zip(messages, reader))
+        # Within a stride of the index, at a stride boundary, before the first and after the last record
+        for index in (0, 5, CAPTURE_INDEX_STRIDE, 2 * CAPTURE_INDEX_STRIDE + 17, len(messages) - 1):
+            assert reader.find(messages[index].timestamp) == index
+            assert reader.find(messages[index].timestamp - 0.0005) == index
+        assert reader.find(-1.0) == 0
+        assert reader.find(10.0) == len(messages)
+        window = list(reader.messages(start=0.5, end=0.6))
+        assert [message.timestamp for message in window] == [message.timestamp for message in messages[500:600]]
+        fd_message = list(reader.messages(start=count * 0.001))[0]
+        assert fd_message.is_fd and fd_message.bitrate_switch and fd_message.is_extended_id
+        assert fd_message.data == bytes(range(48))
+
+
+def test_record_reader_of_empty_capture(tmp_path):
+    path = str(tmp_path / "empty.rec")
+    RecordWriter(path).stop()
+    with RecordReader(path) as reader:
+        assert len(reader) == 0
+        assert list(reader) == []
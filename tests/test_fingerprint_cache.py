@@ -0,0 +1,65 @@
+import sqlite3
+
+from ecu import ECU, Session
+from utils.fingerprint_cache import FingerprintCache
+
+EXTENDED_SESSION = 0x03
+
+
+def vehicle_ecus():
+    engine, gearbox = ECU(0x7E0, 0x7E8), ECU(0x7E1, 0x7E9)
+    for ecu, services in ((engine, [0x10, 0x22, 0x27]), (gearbox, [0x10, 0x3E])):
+        ecu.sessions = [Session(0x01), Session(EXTENDED_SESSION)]
+        for service_id in services:
+            ecu.sessions[1].add_service(service_id)
+    return [engine, gearbox]
+
+
+def test_lookup_by_id_pairs_and_vin(tmp_path):
+    cache = FingerprintCache(str(tmp_path / "fingerprints.db"))
+    try:
+        cache.store(vehicle_ecus(), vin="WVWZZZ1JZXW000001")
+        records = cache.lookup([(0x7E1, 0x7E9), (0x7E0, 0x7E8)])
+        assert [(record["client_id"], record["server_id"]) for record in records] == [(0x7E0, 0x7E8),
+                                                                                       (0x7E1, 0x7E9)]
+        assert records[0]["sessions"] == {0x01: [], EXTENDED_SESSION: [0x10, 0x22, 0x27]}
+        assert records[1]["session_paths"] == {0x01: [], EXTENDED_SESSION: [EXTENDED_SESSION]}
+        assert cache.lookup(vin="WVWZZZ1JZXW000001") == records
+        assert cache.lookup([(0x7E0, 0x7E8)]) is None
+        assert cache.lookup(vin="WVWZZZ1JZXW000002") is None
+    finally:
+        cache.close()
+
+
+def test_store_replaces_and_persists(tmp_path):
+    path = str(tmp_path / "fingerprints.db")
+    cache = FingerprintCache(path)
+    ecus = vehicle_ecus()
+    cache.store(ecus)
+    ecus[0].sessions[1].add_service(0x31)
+    cache.store(ecus)
+    cache.close()
+    cache = FingerprintCache(path)
+    try:
+        records = cache.lookup([(0x7E0, 0x7E8), (0x7E1, 0x7E9)])
+        assert records[0]["sessions"][EXTENDED_SESSION] == [0x10, 0x22, 0x27, 0x31]
+    finally:
+        cache.close()
+
+
+def test_entries_of_older_schema_are_dropped(tmp_path):
+    path = str(tmp_path / "fingerprints.db")
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE vehicles (fingerprint TEXT PRIMARY KEY, vin TEXT, ecus TEXT NOT NULL, "
+                       "updated REAL NOT NULL)")
+    connection.execute("INSERT INTO vehicles VALUES (?, ?, ?, ?)",
+                       ("7E0:7E8", None, '[{"client_id": 2016, "server_id": 2024, "sessions": {"1": []}}]', 0.0))
+    connection.commit()
+    connection.close()
+    cache = FingerprintCache(path)
+    try:
+        assert cache.lookup([(0x7E0, 0x7E8)]) is None
+        cache.store(vehicle_ecus()[:1])
+        assert cache.lookup([(0x7E0, 0x7E8)])[0]["session_paths"][EXTENDED_SESSION] == [EXTENDED_SESSION]
+    finally:
+        cache.close()
@@ -0,0 +1,68 @@
+import can
+import numpy as np
+
+from utils.frame_analysis import ANALYSED_BYTES, FrameBatch, analyse_frames
+
+
+def frames(*rows):
+    """Returns the analyse_frames() arrays of (timestamp, arbitration ID, data) 'rows'"""
+    data = np.zeros((len(rows), ANALYSED_BYTES), dtype=np.uint8)
+    for index, (_, _, payload) in enumerate(rows):
+        data[index, :min(len(payload), ANALYSED_BYTES)] = list(payload[:ANALYSED_BYTES])
+    return (np.array([row[0] for row in rows], dtype=np.float64),
+            np.array([row[1] for row in rows], dtype=np.uint32),
+            np.array([len(row[2]) for row in rows], dtype=np.uint8),
+            data)
+
+
+def test_analyse_frames_pairs_uds_requests():
+    summary = analyse_frames(*frames(
+        (0.000, 0x7DF, bytes([0x02, 0x10, 0x01, 0, 0, 0, 0, 0])),
+        (0.002, 0x7E8, bytes([0x06, 0x50, 0x01, 0x00, 0x32, 0x01, 0xF4, 0])),
+        (0.010, 0x7E0, bytes([0x02, 0x3E, 0x00, 0, 0, 0, 0, 0])),
+        (0.014, 0x7E8, bytes([0x03, 0x7F, 0x3E, 0x11, 0, 0, 0, 0])),
+    ))
+    assert summary.frames == 4
+    assert summary.frame_types["SF"] == 4
+    assert set(summary.pairs) == {(0x7DF, 0x7E8), (0x7E0, 0x7E8)}
+    assert summary.uds_functional and summary.uds_physical
+    assert abs(summary.pairs[(0x7E0, 0x7E8)].mean_latency - 0.004) < 1e-9
+
+
+def test_analyse_frames_detects_iso_tp_transfers():
+    summary = analyse_frames(*frames(
+        (0.000, 0x7E0, bytes([0x03, 0x22, 0xF1, 0x90, 0, 0, 0, 0])),
+        (0.001, 0x123, bytes([0xFF, 0x00, 0x12, 0x34])),
+        (0.002, 0x7E8, bytes([0x10, 0x14, 0x62, 0xF1, 0x90, 0x57, 0x56, 0x57])),
+        (0.003, 0x7E0, bytes([0x30, 0x00, 0x00, 0, 0, 0, 0, 0])),
+        (0.004, 0x7E8, bytes([0x21, 0x5A, 0x5A, 0x5A, 0x31, 0x4A, 0x5A, 0x58])),
+        (0.005, 0x7E8, bytes([0x22, 0x57, 0x30, 0x30, 0x30, 0x30, 0x30, 0x31])),
+        (0.011, 0x123, bytes([0xFE, 0x00, 0x12, 0x34])),
+    ))
+    assert summary.iso_tp_ids == {0x7E0, 0x7E8}
+    assert summary.ids[0x7E8].type_counts["FF"] == 1
+    assert summary.ids[0x7E8].type_counts["CF"] == 2
+    assert summary.ids[0x123].type_counts["other"] == 2
+    assert abs(summary.ids[0x123].mean_period - 0.010) < 1e-9
+    assert summary.pairs[(0x7E0, 0x7E8)].count == 1
+
+
+def test_frame_batch_analyses_received_frames():
+    batch = FrameBatch()
+    for timestamp, arbitration_id, data in ((0.000, 0x7E0, [0x02, 0x10, 0x03]),
+                                            (0.003, 0x7E8, [0x06, 0x50, 0x03, 0x00, 0x32, 0x01, 0xF4]),
+                                            (0.005, 0x321, [0x01])):
+        batch.append(can.Message(timestamp=timestamp, arbitration_id=arbitration_id, data=data))
+    assert len(batch) == 3
+    summary = batch.analyse()
+    assert summary.frames == 3
+    assert summary.frame_types["SF"] == 2
+    assert summary.uds_physical and not summary.uds_functional
+    assert summary.diagnostic_ids == {0x7E0, 0x7E8}
+    assert abs(summary.duration - 0.005) < 1e-9
+
+
+def test_frame_batch_without_frames():
+    summary = FrameBatch().analyse()
+    assert summary.frames == 0
+    assert summary.pairs == {}
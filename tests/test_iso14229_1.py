@@ -0,0 +1,80 @@
+from collections import deque
+
+import pytest
+
+from utils import iso14229_1
+from utils.iso14229_1 import Iso14229_1, NegativeResponseCodes, ServiceID
+
+RESPONSE_PENDING = bytes([0x7F, ServiceID.READ_DATA_BY_IDENTIFIER,
+                          NegativeResponseCodes.REQUEST_CORRECTLY_RECEIVED_RESPONSE_PENDING])
+VIN_RESPONSE = bytes([0x62, 0xF1, 0x90]) + b"VIN"
+
+
+class ScriptedTp:
+    """
+    IsoTp stand-in answering every request with 'responses', a list of (seconds after the previous one,
+    payload). Waiting moves the clock of the module under test instead of sleeping.
+    """
+
+    def __init__(self, responses):
+        self.now = 0.0
+        self.responses = deque()
+        self.script = responses
+        self.requests = []
+
+    def monotonic(self):
+        return self.now
+
+    def send_request(self, data):
+        self.requests.append(bytes(data))
+        self.responses = deque(self.script)
+
+    def receive_message(self, timeout):
+        if not self.responses or self.responses[0][0] > timeout:
+            if self.responses:
+                self.responses[0] = (self.responses[0][0] - timeout, self.responses[0][1])
+            self.now += timeout
+            return None
+        delay, payload = self.responses.popleft()
+        self.now += delay
+        return bytearray(payload)
+
+
+@pytest.fixture
+def scripted(monkeypatch):
+    def scripted(responses):
+        tp = ScriptedTp(responses)
+        monkeypatch.setattr(iso14229_1.time, "monotonic", tp.monotonic)
+        return tp
+    return scripted
+
+
+def test_response_pending_extends_to_p2_star(scripted):
+    # Each response pending is followed by the next response later than P2, but within P2*
+    tp = scripted([(0.01, RESPONSE_PENDING), (2.0, RESPONSE_PENDING), (4.5, VIN_RESPONSE)])
+    uds = Iso14229_1(tp)
+    response = uds.request([0x22, 0xF1, 0x90])
+    assert response.positive and response.data == VIN_RESPONSE[1:]
+    assert uds.response_pending_count == 2
+
+
+def test_no_final_response_within_p2_star(scripted):
+    tp = scripted([(0.01, RESPONSE_PENDING), (5.5, VIN_RESPONSE)])
+    uds = Iso14229_1(tp)
+    assert uds.request([0x22, 0xF1, 0x90]) is None
+    assert tp.now == pytest.approx(0.01 + Iso14229_1.P2_STAR_SERVER)
+
+
+def test_first_response_due_within_p2(scripted):
+    tp = scripted([(0.06, VIN_RESPONSE)])
+    uds = Iso14229_1(tp)
+    assert uds.request([0x22, 0xF1, 0x90]) is None
+    assert uds.request([0x22, 0xF1, 0x90], timeout=0.1).positive
+
+
+def test_session_control_response_sets_timings(scripted):
+    # P2 of 25 ms and P2* of 2 s (in units of 10 ms)
+    tp = scripted([(0.01, bytes([0x50, 0x03, 0x00, 0x19, 0x00, 0xC8]))])
+    uds = Iso14229_1(tp)
+    assert uds.request([0x10, 0x03]).positive
+    assert (uds.p2_server, uds.p2_star_server) == (0.025, 2.0)
@@ -0,0 +1,121 @@
+import can
+import pytest
+
+from utils.iso15765_2 import IsoTp
+
+REQUEST_ID = 0x7E0
+RESPONSE_ID = 0x7E8
+CHANNEL = "pytest-isotp"
+
+
+@pytest.fixture
+def peer():
+    """Bus of the other node, sending the frames the IsoTp under test receives"""
+    with can.Bus(interface="virtual", channel=CHANNEL) as bus:
+        yield bus
+
+
+def open_tp(**kwargs):
+    return IsoTp(REQUEST_ID, RESPONSE_ID, bus=can.Bus(interface="virtual", channel=CHANNEL), **kwargs)
+
+
+def send_frames(bus, frames, fd=False):
+    for frame in frames:
+        bus.send(IsoTp.build_message(frame, RESPONSE_ID, fd))
+
+
+def test_segmentation_layout():
+    message = bytes(range(19))
+    assert [bytes(frame) for frame in IsoTp.get_frames_from_message(message, padding_value=0xAA)] == [
+        bytes([0x10, 19]) + message[:6],
+        bytes([0x21]) + message[6:13],
+        bytes([0x22]) + message[13:19] + bytes([0xAA]),
+    ]
+    frames = IsoTp.get_frames_from_message(message, padding_value=None)
+    assert [len(frame) for frame in frames] == [8, 8, 7]
+    assert bytes(IsoTp.get_frames_from_message(bytes(3), padding_value=None)[0]) == bytes([0x03, 0, 0, 0])
+
+
+def test_segmentation_sequence_numbers_wrap():
+    frames = IsoTp.get_frames_from_message(bytes(6 + 7 * 17))
+    assert [frame[0] for frame in frames[1:]] == [0x20 | (sn % 16) for sn in range(1, 18)]
+
+
+def test_segmentation_fd_pads_last_frame_to_fd_length():
+    frames = IsoTp.get_frames_from_message(bytes(100), padding_value=None, tx_dl=64)
+    # FF with 62 payload bytes, CF with the remaining 38 bytes padded to a 48 byte frame
+    assert [len(frame) for frame in frames] == [64, 48]
+
+
+def test_segmentation_rejects_too_long_messages():
+    with pytest.raises(ValueError):
+        IsoTp.get_frames_from_message(bytes(IsoTp.MAX_MESSAGE_LENGTH + 1))
+
+
+def test_cached_messages_are_reused():
+    with open_tp() as tp:
+        messages = tp.get_messages([0x22, 0xF1, 0x90], REQUEST_ID)
+        assert tp.get_messages(bytearray([0x22, 0xF1, 0x90]), REQUEST_ID) is messages
+        assert messages[0].arbitration_id == REQUEST_ID
+        assert bytes(messages[0].data) == bytes([0x03, 0x22, 0xF1, 0x90, 0, 0, 0, 0])
+
+
+def test_multi_frame_reassembly(peer):
+    message = bytes(i & 0xFF for i in range(300))
+    frames = IsoTp.get_frames_from_message(message)
+    with open_tp(block_size=8) as tp:
+        send_frames(peer, frames)
+        assert tp.receive_message(0.5) == message
+    # A flow control (FC) after the FF and after every complete block of 8 CFs but the last
+    flow_controls = []
+    msg = peer.recv(0.05)
+    while msg is not None:
+        flow_controls.append(bytes(msg.data))
+        msg = peer.recv(0.05)
+    consecutive_frames = len(frames) - 1
+    assert len(flow_controls) == 1 + (consecutive_frames - 1) // 8
+    assert all(frame[:3] == bytes([0x30, 8, 0]) for frame in flow_controls)
+
+
+def test_sequence_number_error_aborts(peer):
+    frames = [bytes(frame) for frame in IsoTp.get_frames_from_message(bytes(20))]
+    frames[2] = bytes([0x23]) + frames[2][1:]
+    with open_tp() as tp:
+        send_frames(peer, frames)
+        assert tp.receive_message(0.5) is None
+
+
+def test_consecutive_frame_timeout(peer):
+    frames = IsoTp.get_frames_from_message(bytes(20))
+    with open_tp() as tp:
+        tp.N_CR_TIMEOUT = 0.05
+        send_frames(peer, frames[:2])
+        assert tp.receive_message(0.5) is None
+
+
+def test_fd_escape_single_frame(peer):
+    message = bytes(range(40))
+    frames = IsoTp.get_frames_from_message(message, tx_dl=64)
+    assert len(frames) == 1 and frames[0][:2] == bytes([0x00, len(message)])
+    with open_tp(fd=True) as tp:
+        send_frames(peer, frames, fd=True)
+        assert tp.receive_message(0.5) == message
+
+
+def test_fd_escape_first_frame(peer):
+    message = bytes(i & 0xFF for i in range(5000))
+    frames = IsoTp.get_frames_from_message(message, tx_dl=64)
+    assert frames[0][:6] == bytes([0x10, 0x00]) + len(message).to_bytes(4, "big")
+    with open_tp(fd=True) as tp:
+        # Block size 0: the whole message follows a single flow control (FC)
+        send_frames(peer, frames, fd=True)
+        assert tp.receive_message(0.5) == message
+
+
+def test_overflow_before_allocating(peer):
+    with open_tp(fd=True, max_rx_length=4096) as tp:
+        send_frames(peer, [bytes([0x10, 0x00]) + (0xFFFFFFF0).to_bytes(4, "big") + bytes(58)], fd=True)
+        assert tp.receive_message(0.5) is None
+    flow_control = peer.recv(0.5)
+    assert flow_control.arbitration_id == REQUEST_ID
+    assert flow_control.data[0] == (IsoTp.FC_FRAME_ID << 4) | IsoTp.FC_FS_OVFLW
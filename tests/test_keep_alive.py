@@ -0,0 +1,71 @@
+import time
+
+import can
+
+from utils.keep_alive import KeepAliveScheduler, TimerWheel
+
+CHANNEL = "pytest-keep-alive"
+
+
+def test_timer_wheel_fires_in_order():
+    wheel = TimerWheel(tick=0.1, slots=8)
+    start = wheel.start
+    wheel.schedule("a", 0.25, start)
+    wheel.schedule("b", 0.05, start)
+    assert len(wheel) == 2
+    assert wheel.advance(start + 0.1) == ["b"]
+    assert wheel.advance(start + 0.2) == []
+    assert wheel.advance(start + 0.3) == ["a"]
+    assert len(wheel) == 0
+
+
+def test_timer_wheel_reschedule_and_cancel():
+    wheel = TimerWheel(tick=0.1, slots=8)
+    start = wheel.start
+    wheel.schedule("a", 0.1, start)
+    wheel.schedule("a", 0.5, start)
+    wheel.schedule("b", 0.1, start)
+    wheel.cancel("b")
+    assert "b" not in wheel
+    assert wheel.advance(start + 0.4) == []
+    assert wheel.advance(start + 0.5) == ["a"]
+
+
+def test_timer_wheel_timers_beyond_one_revolution():
+    wheel = TimerWheel(tick=0.1, slots=4)
+    start = wheel.start
+    wheel.schedule("late", 1.0, start)
+    assert wheel.advance(start + 0.9) == []
+    assert "late" in wheel
+    assert wheel.advance(start + 1.0) == ["late"]
+
+
+def received(bus, duration):
+    """Returns the (arbitration ID, data) of the frames received on 'bus' within 'duration' seconds"""
+    frames = []
+    deadline = time.monotonic() + duration
+    while True:
+        msg = bus.recv(max(0.0, deadline - time.monotonic()))
+        if msg is None:
+            return frames
+        frames.append((msg.arbitration_id, bytes(msg.data)))
+
+
+def test_keep_alive_sends_tester_present_to_held_ecus():
+    with can.Bus(interface="virtual", channel=CHANNEL) as bus, \
+            can.Bus(interface="virtual", channel=CHANNEL) as ecu_bus:
+        scheduler = KeepAliveScheduler(bus, period=0.2)
+        try:
+            scheduler.hold(0x7E0, 0x03)
+            # The default session needs no keep-alive
+            scheduler.hold(0x7E1, 0x01)
+            assert scheduler.is_held(0x7E0) and not scheduler.is_held(0x7E1)
+            frames = received(ecu_bus, 0.9)
+            assert len(frames) >= 2
+            assert set(frames) == {(0x7E0, bytes([0x02, 0x3E, 0x80, 0, 0, 0, 0, 0]))}
+            scheduler.release(0x7E0)
+            received(ecu_bus, 0.05)
+            assert received(ecu_bus, 0.4) == []
+        finally:
+            scheduler.stop()
+    assert scheduler.sent >= 2
@@ -0,0 +1,57 @@
+from ecu import ECU
+from utils.constants import DEFAULT_RESPONSE_TIMEOUT, RESPONSE_TIMEOUT_CEILING, RESPONSE_TIMEOUT_FLOOR
+from utils.iso14229_1 import Iso14229_1
+from utils.latency import LatencyEstimator, LatencyTable
+
+
+def test_estimator_initial_timeout():
+    assert LatencyEstimator().timeout() == DEFAULT_RESPONSE_TIMEOUT
+
+
+def test_estimator_converges_and_is_bounded():
+    estimator = LatencyEstimator()
+    for _ in range(50):
+        estimator.add_sample(0.02)
+    assert abs(estimator.srtt - 0.02) < 1e-6
+    assert 0.02 <= estimator.timeout() < 0.03
+
+    fast = LatencyEstimator()
+    fast.add_sample(0.0001)
+    assert fast.timeout() == RESPONSE_TIMEOUT_FLOOR
+    slow = LatencyEstimator()
+    slow.add_sample(10.0)
+    assert slow.timeout() == RESPONSE_TIMEOUT_CEILING
+
+
+def test_estimator_widens_with_jitter():
+    steady, jittery = LatencyEstimator(), LatencyEstimator()
+    for index in range(20):
+        steady.add_sample(0.1)
+        jittery.add_sample(0.05 if index % 2 else 0.15)
+    assert jittery.timeout() > steady.timeout()
+
+
+def test_table_unknown_servers_wait_at_least_p2():
+    table = LatencyTable("test")
+    for _ in range(20):
+        table.add_sample(0x7E8, 0.002)
+    assert table.timeout(0x7E8) == RESPONSE_TIMEOUT_FLOOR
+    assert table.timeout() == Iso14229_1.P2_SERVER
+    assert table.timeout(0x7E9) == Iso14229_1.P2_SERVER
+
+
+def test_table_slow_unknown_servers_use_channel_estimate():
+    table = LatencyTable("test")
+    for _ in range(20):
+        table.add_sample(0x7E8, 0.2)
+    assert table.timeout(0x7E9) == table.channel_estimator.timeout() > Iso14229_1.P2_SERVER
+
+
+def test_ecu_never_waits_less_than_its_p2():
+    table = LatencyTable("test")
+    ecu = ECU(0x7E0, 0x7E8, latency=table)
+    for _ in range(20):
+        table.add_sample(0x7E8, 0.002)
+    assert ecu.response_timeout() == ecu.p2_server
+    ecu.p2_server = 0.2
+    assert ecu.response_timeout() == 0.2
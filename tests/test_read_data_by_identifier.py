@@ -0,0 +1,56 @@
+import contextlib
+import io
+
+from can_adapter import CANAdapter
+from ecu import ECU
+from simulator import VirtualEcu, VirtualVehicle
+
+
+def test_parse_data_by_identifiers_known_lengths():
+    ecu = ECU(0x7E0, 0x7E8)
+    ecu.did_lengths = {0xF190: 3, 0xF191: 2}
+    response = bytes([0xF1, 0x90, 0xF1, 0x91, 0x00, 0xF1, 0x91, 0xAA, 0xBB])
+    assert ecu.parse_data_by_identifiers([0xF190, 0xF191], response) == {0xF190: bytes([0xF1, 0x91, 0x00]),
+                                                                          0xF191: bytes([0xAA, 0xBB])}
+
+
+def test_parse_data_by_identifiers_guessed_boundaries():
+    ecu = ECU(0x7E0, 0x7E8)
+    guessed = []
+    response = bytes([0xF1, 0x90, 0x01, 0xF1, 0x91, 0x02, 0x03])
+    results = ecu.parse_data_by_identifiers([0xF190, 0xF191], response, guessed)
+    assert results == {0xF190: bytes([0x01]), 0xF191: bytes([0x02, 0x03])}
+    assert guessed == [0xF190]
+
+
+def test_parse_data_by_identifiers_single_did_learns_length():
+    ecu = ECU(0x7E0, 0x7E8)
+    response = bytes([0xF1, 0x90, 0x01, 0xF1, 0x91, 0x02])
+    assert ecu.parse_data_by_identifiers([0xF190], response) == {0xF190: response[2:]}
+    assert ecu.did_lengths == {0xF190: 4}
+
+
+def test_parse_data_by_identifiers_unsupported_did_left_out():
+    ecu = ECU(0x7E0, 0x7E8)
+    guessed = []
+    response = bytes([0xF1, 0x91, 0x41, 0x42])
+    assert ecu.parse_data_by_identifiers([0xF190, 0xF191], response, guessed) == {0xF191: b"AB"}
+    assert guessed == []
+
+
+def test_read_data_by_identifiers_rereads_guessed_dids():
+    # The data of 0xF190 and 0xF192 contains the identifier of the DID after it
+    dids = {0xF190: bytes([0x01, 0xF1, 0x91, 0x02, 0x03]), 0xF191: b"ABC", 0xF192: b"\xf1\x93xy", 0xF193: b"Z"}
+    sessions = {0x01: {0x10, 0x22, 0x3E}}
+    with VirtualVehicle([VirtualEcu(0x7E0, 0x7E8, sessions=sessions, dids=dids)], channel="pytest-did"):
+        adapter = CANAdapter(interface="virtual", channel="pytest-did", bitrate=500000)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                adapter.collect_ecus(0x7E0, 0x7E7, window=16)
+            ecu = adapter.ECUs[0]
+            assert ecu.read_data_by_identifiers(list(dids), session_id=0x01) == dids
+            # The lengths learned from the single reads split later batches correctly at once
+            assert all(ecu.did_lengths[did] == len(dids[did]) for did in ecu.did_lengths)
+            assert ecu.read_data_by_identifiers(list(dids), session_id=0x01) == dids
+        finally:
+            adapter.shutdown()
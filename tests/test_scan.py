@@ -0,0 +1,77 @@
+import contextlib
+import io
+
+from can_adapter import CANAdapter
+from conftest import VEHICLE_ECUS
+from ecu import DEFAULT_SESSION
+from utils.protocol_types import PossibleProtocol
+from simulator import VirtualVehicle, example_vehicle_ecus
+from utils.iso14229_1 import ServiceID, Services
+
+SESSION_TYPES = Services.DiagnosticSessionControl.DiagnosticSessionType
+
+
+def test_collect_ecus(vehicle, adapter):
+    assert sorted((ecu.client_id, ecu.server_id) for ecu in adapter.ECUs) == \
+        sorted((ecu.client_id, ecu.server_id) for ecu in vehicle.ecus.values())
+    assert len(adapter.ECUs) == VEHICLE_ECUS
+
+
+def test_gather_ecu_info(vehicle, adapter):
+    with contextlib.redirect_stdout(io.StringIO()):
+        adapter.gather_ecu_info()
+    for ecu in adapter.ECUs:
+        virtual_ecu = vehicle.ecus[ecu.client_id]
+        sessions = {session.session_id: session for session in ecu.sessions}
+        assert set(sessions) == set(virtual_ecu.sessions)
+        # The programming session is only entered from the extended session
+        assert sessions[SESSION_TYPES.PROGRAMMING_SESSION].route(DEFAULT_SESSION) == \
+            [SESSION_TYPES.EXTENDED_DIAGNOSTIC_SESSION, SESSION_TYPES.PROGRAMMING_SESSION]
+        assert ServiceID.READ_DATA_BY_IDENTIFIER in sessions[DEFAULT_SESSION].services
+        assert ServiceID.SECURITY_ACCESS in sessions[SESSION_TYPES.EXTENDED_DIAGNOSTIC_SESSION].services
+
+
+def test_read_dids(vehicle, adapter):
+    with contextlib.redirect_stdout(io.StringIO()):
+        adapter.read_data_from_ecus_by_identifier(first_session_only=True)
+    for ecu in adapter.ECUs:
+        virtual_ecu = vehicle.ecus[ecu.client_id]
+        session_id = ecu.find_session_with_service(ServiceID.READ_DATA_BY_IDENTIFIER)
+        for did, data in virtual_ecu.dids.items():
+            assert adapter.results.get_data(ecu, session_id, did) == data
+
+
+def test_read_single_did(vehicle, adapter):
+    ecu = adapter.ECUs[0]
+    assert ecu.get_data_from_ecu_by_identifier(0xF190) == vehicle.ecus[ecu.client_id].dids[0xF190]
+
+
+def test_scan_ecus_extended_consumer_uses_bus():
+    # ECUs only reachable by the sweep, read by the consumer while the scan is still running
+    ecus = example_vehicle_ecus(6, extended=True)
+    for ecu in ecus:
+        ecu.functional = False
+    with VirtualVehicle(ecus, channel="pytest-extended") as vehicle:
+        adapter = CANAdapter(interface="virtual", channel="pytest-extended", bitrate=500000)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                data = {record.ecu.client_id: record.ecu.get_data_from_ecu_by_identifier(0xF190, session_id=1)
+                        for record in adapter.scan_ecus_extended()}
+        finally:
+            adapter.shutdown()
+    assert data == {client_id: ecu.dids[0xF190] for client_id, ecu in vehicle.ecus.items()}
+
+
+def test_infer_protocol_on_29_bit_vehicle():
+    with VirtualVehicle(example_vehicle_ecus(4, extended=True), channel="pytest-inference"):
+        adapter = CANAdapter(interface="virtual", channel="pytest-inference", bitrate=500000)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                protocol = adapter.infer_protocol()
+        finally:
+            adapter.shutdown()
+    assert protocol == PossibleProtocol.UDS
+    inference = adapter.protocol_inference
+    # Decided on the answers to the 29-bit functional probe, long before the 11-bit sweep is through
+    assert inference.functional_responses and all(aid >> 8 == 0x18DAF1 for aid in inference.functional_responses)
+    assert inference.decision_time < 1.0
@@ -0,0 +1,58 @@
+from ecu import ECU
+from utils import scan_results
+from utils.scan_results import ScanResultStore
+
+
+class Clock:
+    """Stand-in for time.monotonic() that only moves when told to"""
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_results_expire_after_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(scan_results.time, "monotonic", clock)
+    store = ScanResultStore(ttl=10)
+    ecu = ECU(0x7E0, 0x7E8)
+    store.put(ecu, 0x01, 0xF190, b"VIN")
+    clock.now += 10
+    assert store.get_data(ecu, 0x01, 0xF190) == b"VIN"
+    assert len(store.by_did(0xF190)) == 1
+    clock.now += 0.1
+    assert store.get(ecu, 0x01, 0xF190) is None
+    assert store.by_did(0xF190) == []
+
+
+def test_results_kept_for_the_run_without_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(scan_results.time, "monotonic", clock)
+    store = ScanResultStore()
+    ecu = ECU(0x7E0, 0x7E8)
+    store.put(ecu, 0x01, 0xF190, None)
+    clock.now += 1e6
+    result = store.get(ecu, 0x01, 0xF190)
+    assert result is not None and result.data is None
+
+
+def test_invalidate_matches_all_given_arguments():
+    store = ScanResultStore()
+    engine, gearbox = ECU(0x7E0, 0x7E8), ECU(0x7E1, 0x7E9)
+    for ecu in (engine, gearbox):
+        for session_id in (0x01, 0x03):
+            for did in (0xF190, 0xF191):
+                store.put(ecu, session_id, did, bytes([session_id]))
+    store.invalidate(ecu=engine, session_id=0x03)
+    assert len(store) == 6
+    assert store.get(engine, 0x03, 0xF190) is None
+    assert store.get(engine, 0x01, 0xF190) is not None
+    store.invalidate(did=0xF191)
+    assert len(store) == 3
+    assert {(result.ecu, result.session_id) for result in store.by_did(0xF190)} == \
+        {(engine, 0x01), (gearbox, 0x01), (gearbox, 0x03)}
+    assert store.by_did(0xF191) == []
+    store.invalidate()
+    assert len(store) == 0
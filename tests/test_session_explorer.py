@@ -0,0 +1,99 @@
+import contextlib
+import io
+
+from can_adapter import CANAdapter
+from ecu import DEFAULT_SESSION, ECU, SessionExplorer
+from simulator import VirtualEcu, VirtualVehicle
+from utils.iso14229_1 import NegativeResponse, NegativeResponseCodes, PositiveResponse, ServiceID
+
+EXTENDED_SESSION = 0x03
+PROGRAMMING_SESSION = 0x02
+SUPPLIER_SESSION = 0x60
+
+
+def explore(graph, session_ids, exhaustive=False):
+    """
+    Runs a SessionExplorer against 'graph', a dict of session ID -> sessions it can be entered from
+
+    :return: Tuple of the SessionExplorer and the number of switches it sent
+    """
+    explorer = SessionExplorer(session_ids, exhaustive)
+    active = DEFAULT_SESSION
+    switches = 0
+    while True:
+        target = explorer.next_switch()
+        if target is None:
+            return explorer, switches
+        switches += 1
+        if target not in graph:
+            response = NegativeResponse(ServiceID.DIAGNOSTIC_SESSION_CONTROL,
+                                        NegativeResponseCodes.SUB_FUNCTION_NOT_SUPPORTED)
+        elif target != active and active not in graph[target]:
+            response = NegativeResponse(ServiceID.DIAGNOSTIC_SESSION_CONTROL,
+                                        NegativeResponseCodes.SUB_FUNCTION_NOT_SUPPORTED_IN_ACTIVE_SESSION)
+        else:
+            active = target
+            response = PositiveResponse(ServiceID.DIAGNOSTIC_SESSION_CONTROL, bytes([target]))
+        explorer.record(response)
+
+
+GRAPH = {
+    DEFAULT_SESSION: {EXTENDED_SESSION, PROGRAMMING_SESSION, SUPPLIER_SESSION},
+    EXTENDED_SESSION: {DEFAULT_SESSION, PROGRAMMING_SESSION, SUPPLIER_SESSION},
+    PROGRAMMING_SESSION: {EXTENDED_SESSION},
+    SUPPLIER_SESSION: {EXTENDED_SESSION},
+}
+
+
+def test_session_explorer_finds_nested_sessions():
+    explorer, _ = explore(GRAPH, ECU.SESSION_IDS)
+    assert set(explorer.sessions) == set(GRAPH)
+    assert explorer.sessions[PROGRAMMING_SESSION].path == [EXTENDED_SESSION, PROGRAMMING_SESSION]
+    assert explorer.sessions[SUPPLIER_SESSION].route(DEFAULT_SESSION) == [EXTENDED_SESSION, SUPPLIER_SESSION]
+    assert explorer.sessions[PROGRAMMING_SESSION].entered_from == {EXTENDED_SESSION}
+    assert explorer.sessions[EXTENDED_SESSION].entered_from == {DEFAULT_SESSION, PROGRAMMING_SESSION,
+                                                                SUPPLIER_SESSION}
+
+
+def test_session_explorer_skips_unsupported_sessions():
+    _, switches = explore(GRAPH, ECU.SESSION_IDS)
+    _, exhaustive_switches = explore(GRAPH, ECU.SESSION_IDS, exhaustive=True)
+    # Sessions refused with NRC 0x12 are probed from the default session only
+    assert switches < 2 * len(ECU.SESSION_IDS)
+    assert exhaustive_switches >= len(GRAPH) * (len(ECU.SESSION_IDS) - 1)
+
+
+def test_session_explorer_repeats_switches_without_response():
+    explorer = SessionExplorer([EXTENDED_SESSION])
+    responses = {DEFAULT_SESSION: PositiveResponse(ServiceID.DIAGNOSTIC_SESSION_CONTROL, bytes([DEFAULT_SESSION])),
+                 EXTENDED_SESSION: PositiveResponse(ServiceID.DIAGNOSTIC_SESSION_CONTROL, bytes([EXTENDED_SESSION]))}
+    timed_out = False
+    while True:
+        target = explorer.next_switch()
+        if target is None:
+            break
+        if target == EXTENDED_SESSION and not timed_out:
+            # The first reply comes too late
+            timed_out = True
+            explorer.record(None)
+            continue
+        explorer.record(responses[target])
+    assert set(explorer.sessions) == {DEFAULT_SESSION, EXTENDED_SESSION}
+
+
+def test_explore_sessions_on_virtual_ecu():
+    sessions = {session_id: {ServiceID.DIAGNOSTIC_SESSION_CONTROL, ServiceID.TESTER_PRESENT} for session_id in GRAPH}
+    with VirtualVehicle([VirtualEcu(0x7E0, 0x7E8, sessions=sessions, transitions=GRAPH)], channel="pytest-sessions"):
+        adapter = CANAdapter(interface="virtual", channel="pytest-sessions", bitrate=500000)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                adapter.collect_ecus(0x7E0, 0x7E7, window=16)
+            ecu = adapter.ECUs[0]
+            ecu.sessions = []
+            first_transitions = [(record.source, record.session_id) for record in ecu.explore_sessions()
+                                 if record.first]
+        finally:
+            adapter.shutdown()
+    assert {session.session_id for session in ecu.sessions} == set(GRAPH)
+    assert (EXTENDED_SESSION, PROGRAMMING_SESSION) in first_transitions
+    assert ecu.get_session(SUPPLIER_SESSION).path == [EXTENDED_SESSION, SUPPLIER_SESSION]
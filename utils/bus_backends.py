@@ -0,0 +1,196 @@
+import os
+import time
+
+import can
+
+from utils.capture import RECORD_EXTENSION, RecordReader
+
+
+class BusBackend:
+    """
+    A way of opening the CAN bus, chosen once and handed down from CANAdapter to every ECU and IsoTp.
+    Subclasses declare the capabilities of their bus:
+
+    HARDWARE_FILTERING: Filters set with set_filters() are applied before frames reach user space
+    TIMESTAMPS: Received frames carry reliable receive timestamps
+    CAN_FD: The bus can carry CAN FD frames
+    LIVE: The bus is connected to real or simulated nodes that answer requests
+    """
+
+    NAME = None
+    INTERFACE = None
+    HARDWARE_FILTERING = False
+    TIMESTAMPS = False
+    CAN_FD = False
+    LIVE = True
+
+    def open(self, channel, bitrate=None, fd=False):
+        """
+        Opens a bus on 'channel'
+
+        :param channel: Channel of the bus
+        :param bitrate: Bitrate, for backends that configure it
+        :param fd: Open the bus in CAN FD mode
+        :return: can.BusABC
+        """
+        if fd and not self.CAN_FD:
+            raise ValueError(f"The {self.NAME} backend does not support CAN FD")
+        kwargs = self.bus_arguments(bitrate, fd)
+        return can.Bus(channel=channel, interface=self.INTERFACE, **kwargs)
+
+    def bus_arguments(self, bitrate, fd):
+        """Returns the interface specific keyword arguments of can.Bus()"""
+        return {}
+
+    def capabilities(self):
+        """Returns the capabilities of the backend as a dict"""
+        return {
+            "hardware_filtering": self.HARDWARE_FILTERING,
+            "timestamps": self.TIMESTAMPS,
+            "can_fd": self.CAN_FD,
+            "live": self.LIVE,
+        }
+
+
+class SocketCanBackend(BusBackend):
+    """Linux SocketCAN - filters run in the kernel and frames are timestamped by the driver"""
+
+    NAME = "socketcan"
+    INTERFACE = "socketcan"
+    HARDWARE_FILTERING = True
+    TIMESTAMPS = True
+    CAN_FD = True
+
+    def bus_arguments(self, bitrate, fd):
+        # The bitrate of a SocketCAN interface is configured with 'ip link', not through the socket
+        return {"fd": fd}
+
+
+class VirtualBackend(BusBackend):
+    """python-can's in-process virtual bus, e.g. for the simulator in simulator.py"""
+
+    NAME = "virtual"
+    INTERFACE = "virtual"
+    TIMESTAMPS = True
+    CAN_FD = True
+
+
+class UdpMulticastBackend(BusBackend):
+    """python-can's UDP multicast bus, connecting processes or hosts over IP"""
+
+    NAME = "udp_multicast"
+    INTERFACE = "udp_multicast"
+    TIMESTAMPS = True
+    CAN_FD = True
+
+    def bus_arguments(self, bitrate, fd):
+        return {"fd": fd}
+
+
+class ReplayBus(can.BusABC):
+    """
+    Receive-only bus replaying a .rec capture (memory-mapped, see utils.capture) or a log file readable by
+    can.LogReader (.asc, .blf, .csv, .log, ...). Sent frames are dropped. At the end of the file the bus stays silent.
+
+    :param channel: Channel name reported by the bus
+    :param path: Path to the log file
+    :param speed: Replay speed relative to the recorded timestamps, or None to replay as fast as possible
+    :param start: Timestamp to start the replay at, or None to start at the beginning
+    """
+
+    def __init__(self, channel, path, speed=None, start=None, **kwargs):
+        self.path = path
+        self.speed = speed
+        self.channel_info = f"Replay of {path}"
+        if os.path.splitext(path)[1].lower() == RECORD_EXTENSION:
+            # Seeks through the timestamp index of the capture
+            self._reader = RecordReader(path)
+            self._messages = self._reader.messages(start)
+        else:
+            self._reader = can.LogReader(path)
+            self._messages = iter(self._reader) if start is None else \
+                (msg for msg in self._reader if msg.timestamp >= start)
+        self._pending = None
+        self._started = None
+        self._first_timestamp = None
+        super().__init__(channel=channel, **kwargs)
+
+    def _recv_internal(self, timeout):
+        msg = self._pending if self._pending is not None else next(self._messages, None)
+        self._pending = None
+        if msg is None:
+            # End of the recording - behave like a silent bus
+            time.sleep(0.1 if timeout is None else timeout)
+            return None, False
+
+        if self.speed is not None:
+            now = time.monotonic()
+            if self._started is None:
+                self._started = now
+                self._first_timestamp = msg.timestamp
+            due = self._started + \
+                (msg.timestamp - self._first_timestamp) / self.speed
+            if timeout is not None and due - now > timeout:
+                self._pending = msg
+                time.sleep(timeout)
+                return None, False
+            time.sleep(max(0.0, due - now))
+        return msg, False
+
+    def send(self, msg, timeout=None):
+        pass
+
+    def shutdown(self):
+        if isinstance(self._reader, RecordReader):
+            self._messages.close()
+            self._reader.close()
+        else:
+            self._reader.stop()
+        super().shutdown()
+
+
+class ReplayBackend(BusBackend):
+    """
+    Replay of a recorded log file, for running the analysis paths at high rates without a vehicle
+
+    :param path: Path to the log file
+    :param speed: Replay speed relative to the recorded timestamps, or None to replay as fast as possible
+    :param start: Timestamp to start the replay at, or None to start at the beginning
+    """
+
+    NAME = "replay"
+    TIMESTAMPS = True
+    CAN_FD = True
+    LIVE = False
+
+    def __init__(self, path, speed=None, start=None):
+        self.path = path
+        self.speed = speed
+        self.start = start
+
+    def open(self, channel, bitrate=None, fd=False):
+        return ReplayBus(channel, self.path, speed=self.speed, start=self.start)
+
+
+BACKENDS = {backend.NAME: backend for backend in (
+    SocketCanBackend, VirtualBackend, UdpMulticastBackend, ReplayBackend)}
+
+DEFAULT_BACKEND = SocketCanBackend.NAME
+
+
+def get_backend(backend=None, **kwargs):
+    """
+    Returns a BusBackend
+
+    :param backend: BusBackend (returned as is), name of a backend in BACKENDS, or None for DEFAULT_BACKEND
+    :param kwargs: Arguments of the backend, e.g. 'path' of the replay backend
+    :return: BusBackend
+    """
+    if isinstance(backend, BusBackend):
+        return backend
+    if backend is None:
+        backend = DEFAULT_BACKEND
+    if backend not in BACKENDS:
+        raise ValueError(
+            f"Unknown bus backend '{backend}', expected one of {', '.join(BACKENDS)}")
+    return BACKENDS[backend](**kwargs)
@@ -0,0 +1,188 @@
+import queue
+import time
+
+import can
+
+
+class BusView:
+    """
+    A borrowed view of the bus owned by a BusPool. The view behaves like a bus towards its borrower
+    (send, recv, set_filters, shutdown), but shares the underlying socket with every other view.
+    Each view keeps its own filters, which are installed on the socket while the view is in use.
+    """
+
+    def __init__(self, pool, filters=None):
+        self.pool = pool
+        self.filters = filters
+        self.closed = False
+        # Filled by the pool's notifier thread when running in notifier mode
+        self.queue = queue.Queue()
+
+    @property
+    def channel_info(self):
+        return self.pool.bus.channel_info
+
+    def set_filters(self, filters=None):
+        """
+        Sets the filters of this view - same format as
+        https://python-can.readthedocs.io/en/stable/bus.html#can.BusABC.set_filters
+
+        :param filters: List of dicts specifying "can_id", "can_mask" and (optional) "extended" flag, or None
+        :return: None
+        """
+        self.filters = filters
+        self.pool.invalidate(self)
+
+    def send(self, msg, timeout=None):
+        self.pool.bus.send(msg, timeout)
+
+    def recv(self, timeout=None):
+        """
+        Receives the next message matching the filters of this view
+
+        :param timeout: Seconds to wait for a message, or None to wait indefinitely
+        :return: can.Message if a matching message was received in time, None otherwise
+        """
+        if self.pool.notifier is not None:
+            # Frames are dispatched to this view already filtered
+            try:
+                return self.queue.get(timeout=timeout)
+            except queue.Empty:
+                return None
+
+        self.pool.activate(self)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(
+                0.0, deadline - time.monotonic())
+            msg = self.pool.bus.recv(remaining)
+            if msg is None:
+                return None
+            # Frames queued on the socket before the filters were installed still need to be checked
+            if self.matches(msg):
+                return msg
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+
+    def matches(self, msg):
+        """Returns True if 'msg' passes the filters of this view"""
+        if not self.filters:
+            return True
+        for can_filter in self.filters:
+            if "extended" in can_filter and can_filter["extended"] != msg.is_extended_id:
+                continue
+            can_mask = can_filter["can_mask"]
+            if (msg.arbitration_id & can_mask) == (can_filter["can_id"] & can_mask):
+                return True
+        return False
+
+    def shutdown(self):
+        """Returns the view to its pool. The shared bus stays open."""
+        if not self.closed:
+            self.closed = True
+            self.pool.release(self)
+
+
+class _Dispatcher(can.Listener):
+    """Notifier listener handing every received frame to the open views whose filters it matches"""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def on_message_received(self, msg):
+        for view in list(self.pool.views):
+            if view.matches(msg):
+                view.queue.put(msg)
+
+
+class BusPool:
+    """
+    Lends out views of a single, already open bus, so that ISO-TP contexts do not open and close a
+    socket each. Borrowers get their own filter view; the filters of the view currently in use are
+    kept installed on the socket, so the kernel keeps dropping irrelevant frames.
+
+    In notifier mode a python-can Notifier thread owns the socket instead. It blocks on the socket
+    and dispatches frames to the queues of the open views, whose recv() then sleeps on the queue.
+    The kernel filters are the union of the filters of all open views.
+    """
+
+    def __init__(self, bus, flush_on_borrow=True):
+        self.bus = bus
+        # Frames left on a live bus by a previous borrower are stale, frames of a replay are not
+        self.flush_on_borrow = flush_on_borrow
+        self.views = set()
+        self.notifier = None
+        self._active_view = None
+
+    def borrow(self, filters=None):
+        """
+        Returns a new view of the shared bus
+
+        :param filters: Initial filters of the view, or None to receive everything
+        :return: BusView
+        """
+        view = BusView(self, filters)
+        if self.notifier is None and self.flush_on_borrow:
+            self._flush()
+        self.views.add(view)
+        self.activate(view)
+        return view
+
+    def activate(self, view):
+        """Installs the filters of 'view' on the shared bus, unless they already are"""
+        if self.notifier is not None:
+            self._install_union_filters()
+        elif self._active_view is not view:
+            self.bus.set_filters(view.filters)
+            self._active_view = view
+
+    def invalidate(self, view):
+        """Marks the filters of 'view' as changed"""
+        if self._active_view is view:
+            self._active_view = None
+        self.activate(view)
+
+    def release(self, view):
+        self.views.discard(view)
+        if self.notifier is not None:
+            self._install_union_filters()
+        elif self._active_view is view:
+            self.bus.set_filters(None)
+            self._active_view = None
+
+    def start_notifier(self, timeout=1.0):
+        """
+        Switches the pool to notifier mode
+
+        :param timeout: Seconds the notifier thread blocks on the socket per wait
+        :return: None
+        """
+        if self.notifier is None:
+            self._active_view = None
+            self.notifier = can.Notifier(
+                self.bus, [_Dispatcher(self)], timeout=timeout)
+            self._install_union_filters()
+
+    def stop_notifier(self):
+        if self.notifier is not None:
+            self.notifier.stop()
+            self.notifier = None
+            self.bus.set_filters(None)
+
+    def _install_union_filters(self):
+        filters = []
+        for view in list(self.views):
+            if not view.filters:
+                # At least one view wants everything
+                filters = None
+                break
+            filters.extend(view.filters)
+        self.bus.set_filters(filters)
+
+    def _flush(self):
+        """Drops frames left on the socket by a previous borrower"""
+        try:
+            while self.bus.recv(0) is not None:
+                pass
+        except can.CanError:
+            pass
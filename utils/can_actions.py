@@ -4,75 +4,69 @@ import can
 import utils.constants as constants
 
 from sys import stdout
+from utils.iso14229_1 import Iso14229_1
 from utils.iso15765_2 import IsoTp
 
 
 def send_request(bus, arbitration_id, data):
     msg = can.Message(arbitration_id=arbitration_id,
                       data=data,
-                      is_extended_id=False)
+                      is_extended_id=arbitration_id > constants.ARBITRATION_ID_MAX)
     try:
         bus.send(msg)
     except can.CanError:
         print("[-] CAN send error")
 
 
-def listen_for_response(bus, expected_ids, timeout=0.1):
-    start = time.time()
-    while time.time() - start < timeout:
-        msg = bus.recv(timeout)
-        if msg and msg.arbitration_id in expected_ids:
-            print(
-                f"[<] Response from {hex(msg.arbitration_id)}: {msg.data.hex()}")
+def recv_until(bus, deadline, predicate=None):
+    """
+    Blocks on 'bus' until a message accepted by 'predicate' arrives, or until 'deadline' passes
+
+    :param bus: Bus (or bus view) to receive from
+    :param deadline: Deadline on the time.monotonic() clock
+    :param predicate: Function returning True for the wanted message, or None to accept any message
+    :return: The accepted message, or None on timeout
+    """
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        msg = bus.recv(remaining)
+        if msg is None:
+            return None
+        if predicate is None or predicate(msg):
             return msg
-    return None
-
-
-def sniff_can(bus, duration=5):
-    print(f"[~] Sniffing traffic for {duration} seconds...")
-    iso_tp_detected = False
-    diagnostic_ids_seen = set()
-    seen_ids = set()
-
-    start = time.time()
-    while time.time() - start < duration:
-        msg = bus.recv(timeout=1)
-        if msg:
-            aid = msg.arbitration_id
-            seen_ids.add(aid)
-            data = msg.data
-
-            if aid >= 0x700 or aid in range(0x000, 0x800):
-                diagnostic_ids_seen.add(aid)
-
-            if len(data) > 0:
-                first_byte = data[0]
-                if first_byte & 0xF0 == 0x10:
-                    print("[!] ISO-TP First Frame")
-                    iso_tp_detected = True
-                elif first_byte & 0xF0 == 0x20:
-                    print("[!] ISO-TP Consecutive Frame")
-                    iso_tp_detected = True
-                elif first_byte == 0x30:
-                    print("[!] ISO-TP Flow Control")
-                    iso_tp_detected = True
-
-    return iso_tp_detected, diagnostic_ids_seen
 
 
 def is_valid_response(message, sent_service_id):
     return (len(message.data) >= 2 and message.data[1] == sent_service_id + constants.VALUE_TO_ADD_FOR_SUCCESSFUL_RESPONSE)
 
 
-def send_and_receive(tp: IsoTp, msg: list, send_arb_id: int, timeout: float = 0.1):
-    requested_service_id = msg[0]
-    msg = tp.get_frames_from_message(msg)
-    tp.transmit(msg, send_arb_id, None)
-    end_time = time.time() + timeout
-    while time.time() < end_time:
-        msg = tp.bus.recv(0)
-        if msg is None:
-            continue
-        if is_valid_response(msg, requested_service_id):
-            return msg
-    return None
+def send_and_receive(tp: IsoTp, msg: list, send_arb_id: int, timeout: float = None, latency=None, messages=None,
+                     p2_star_server=Iso14229_1.P2_STAR_SERVER):
+    """
+    Sends 'msg' to 'send_arb_id' and waits for the final response to it, see Iso14229_1.request()
+
+    :param tp: IsoTp used for sending and receiving
+    :param msg: Request payload
+    :param send_arb_id: Arbitration ID to send the request on
+    :param timeout: Seconds to wait, or None to derive the timeout from 'latency'
+    :param latency: LatencyTable fed with the measured round-trip time, or None
+    :param messages: Pre-built can.Message objects carrying 'msg' on 'send_arb_id', or None to use the cached ones
+    :param p2_star_server: P2* of the server in seconds, waited for after each response pending (NRC 0x78)
+    :return: Tuple of the response (PositiveResponse or NegativeResponse) and the arbitration ID it was
+             received on, or (None, None) on timeout
+    """
+    if timeout is None:
+        timeout = constants.DEFAULT_RESPONSE_TIMEOUT if latency is None else latency.timeout(
+            tp.arb_id_response)
+    if messages is None:
+        messages = tp.get_messages(msg, send_arb_id)
+    uds = Iso14229_1(tp, p2_star_server=p2_star_server)
+    sent_at = time.monotonic()
+    response = uds.request(msg, timeout, messages=messages)
+    if response is None:
+        return None, None
+    if uds.response_pending_count == 0 and latency is not None:
+        latency.add_sample(tp.last_response_id, time.monotonic() - sent_at)
+    return response, tp.last_response_id
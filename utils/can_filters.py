@@ -0,0 +1,82 @@
+from utils.constants import ARBITRATION_ID_MAX, ARBITRATION_ID_MAX_EXTENDED, DIAGNOSTIC_ID_RANGE, \
+    NORMAL_FIXED_ID_RANGE, RESPONSE_ID_RANGE
+
+
+def id_filter(can_id, can_mask, extended=None):
+    """
+    Returns a single filter in the format of python-can's set_filters(), which SocketCAN installs as a
+    kernel 'can_filter'
+
+    :param can_id: Arbitration ID to match
+    :param can_mask: Bits of the arbitration ID that have to match 'can_id'
+    :param extended: True for 29-bit IDs, False for 11-bit IDs, or None to derive it from 'can_id'
+    :return: Filter dict
+    """
+    if extended is None:
+        extended = can_id > ARBITRATION_ID_MAX
+    return {"can_id": can_id, "can_mask": can_mask, "extended": extended}
+
+
+def exact_id_filters(arbitration_ids):
+    """Returns one exact match filter per arbitration ID in 'arbitration_ids'"""
+    return [id_filter(arbitration_id, ARBITRATION_ID_MAX_EXTENDED) for arbitration_id in sorted(set(arbitration_ids))]
+
+
+def range_filters(first, last, extended=None):
+    """
+    Returns the smallest list of mask filters matching exactly the IDs 'first'..'last' (inclusive).
+    The range is split into aligned power of two blocks, each of which is one ID/mask pair.
+
+    :param first: First arbitration ID of the range
+    :param last: Last arbitration ID of the range
+    :param extended: True for 29-bit IDs, False for 11-bit IDs, or None to derive it from 'last'
+    :return: List of filter dicts
+    """
+    if extended is None:
+        extended = last > ARBITRATION_ID_MAX
+    full_mask = ARBITRATION_ID_MAX_EXTENDED if extended else ARBITRATION_ID_MAX
+    filters = []
+    while first <= last:
+        # Largest block starting at 'first' that is aligned and ends within the range
+        size = first & -first if first > 0 else full_mask + 1
+        while first + size - 1 > last:
+            size >>= 1
+        filters.append(id_filter(first, full_mask & ~(size - 1), extended))
+        first += size
+    return filters
+
+
+def id_set_filters(arbitration_ids):
+    """Returns the smallest list of range filters matching exactly the IDs in 'arbitration_ids'"""
+    filters = []
+    run_start = None
+    previous = None
+    for arbitration_id in sorted(set(arbitration_ids)):
+        if run_start is None:
+            run_start = arbitration_id
+        elif arbitration_id != previous + 1 or (previous <= ARBITRATION_ID_MAX < arbitration_id):
+            filters.extend(range_filters(run_start, previous))
+            run_start = arbitration_id
+        previous = arbitration_id
+    if run_start is not None:
+        filters.extend(range_filters(run_start, previous))
+    return filters
+
+
+def discovery_filters(response_ids=RESPONSE_ID_RANGE, known_ids=()):
+    """
+    Returns the filters of the ECU discovery phase: the possible response IDs, without the response
+    IDs of ECUs that have already been found
+
+    :param response_ids: Iterable of arbitration IDs that responses are expected on
+    :param known_ids: Response IDs of the ECUs found so far
+    :return: List of filter dicts
+    """
+    return id_set_filters(set(response_ids) - set(known_ids))
+
+
+def sniff_filters():
+    """Returns the filters of the sniffing phase: the 11-bit diagnostic range and 29-bit normal fixed addressing"""
+    return range_filters(DIAGNOSTIC_ID_RANGE.start, DIAGNOSTIC_ID_RANGE.stop - 1, extended=False) + \
+        range_filters(NORMAL_FIXED_ID_RANGE.start,
+                      NORMAL_FIXED_ID_RANGE.stop - 1, extended=True)
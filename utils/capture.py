@@ -0,0 +1,380 @@
+import array
+import bisect
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+
+import can
+
+# Fixed-size record capture format: a file header followed by one record per frame
+RECORD_EXTENSION = ".rec"
+RECORD_MAGIC = b"CANREC\x00\x01"
+# Magic, data bytes per record, reserved
+RECORD_FILE_HEADER = struct.Struct("<8sHH")
+# Timestamp, arbitration ID, flags, data length - followed by the data bytes of the record
+RECORD_HEADER = struct.Struct("<dIBB")
+RECORD_TIMESTAMP = struct.Struct("<d")
+
+RECORD_FLAG_EXTENDED = 0x01
+RECORD_FLAG_FD = 0x02
+RECORD_FLAG_BRS = 0x04
+RECORD_FLAG_ERROR = 0x08
+RECORD_FLAG_REMOTE = 0x10
+RECORD_FLAG_RX = 0x20
+
+# Frames handed from the receiving thread to the writer at once
+CAPTURE_BATCH_SIZE = 512
+# Longest time a received frame waits in a partial batch
+CAPTURE_FLUSH_INTERVAL = 0.1
+# Batches buffered per pipeline stage before the previous stage has to wait
+CAPTURE_QUEUE_BATCHES = 256
+# Records per entry of the timestamp index of a RecordReader
+CAPTURE_INDEX_STRIDE = 1024
+
+
+def record_struct(data_size):
+    """Returns the struct of one record holding up to 'data_size' data bytes"""
+    return struct.Struct(RECORD_HEADER.format + f"{data_size}s")
+
+
+def record_flags(message):
+    """Returns the record flags of can.Message 'message'"""
+    return (RECORD_FLAG_EXTENDED if message.is_extended_id else 0) | \
+        (RECORD_FLAG_FD if message.is_fd else 0) | \
+        (RECORD_FLAG_BRS if message.bitrate_switch else 0) | \
+        (RECORD_FLAG_ERROR if message.is_error_frame else 0) | \
+        (RECORD_FLAG_REMOTE if message.is_remote_frame else 0) | \
+        (RECORD_FLAG_RX if message.is_rx else 0)
+
+
+class RecordWriter:
+    """
+    Writes frames as fixed-size records: 14 header bytes plus 8 data bytes per frame (64 with 'fd').
+    Records of a batch are packed into one buffer and written with a single call.
+
+    :param path: Path of the capture file
+    :param fd: Reserve room for CAN FD frames of up to 64 bytes
+    """
+
+    def __init__(self, path, fd=False):
+        self.path = path
+        self.data_size = 64 if fd else 8
+        self.record = record_struct(self.data_size)
+        self.file = open(path, "wb")
+        self.file.write(RECORD_FILE_HEADER.pack(
+            RECORD_MAGIC, self.data_size, 0))
+
+    def write_batch(self, messages):
+        buffer = bytearray(self.record.size * len(messages))
+        offset = 0
+        for message in messages:
+            data = message.data
+            if len(data) > self.data_size:
+                raise ValueError(
+                    f"Frame of {len(data)} bytes does not fit a record of {self.data_size} bytes, capture with fd")
+            self.record.pack_into(buffer, offset, message.timestamp, message.arbitration_id,
+                                  record_flags(message), len(data), bytes(data))
+            offset += self.record.size
+        self.file.write(buffer)
+
+    def stop(self):
+        self.file.close()
+
+
+class RecordReader:
+    """
+    Memory-mapped capture written by RecordWriter. Records are read in place from the mapping, so a capture
+    of any size is opened instantly and analysed at CPU speed. A sparse index of every CAPTURE_INDEX_STRIDE-th
+    timestamp, built on first use, finds the record of a timestamp with a bisection and a short scan.
+
+    :param path: Path of the capture file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as file:
+            magic, self.data_size, _ = RECORD_FILE_HEADER.unpack(
+                file.read(RECORD_FILE_HEADER.size))
+            if magic != RECORD_MAGIC:
+                raise ValueError(f"{path} is not a record capture")
+            self.record = record_struct(self.data_size)
+            size = os.fstat(file.fileno()).st_size
+            self.count = (size - RECORD_FILE_HEADER.size) // self.record.size
+            self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if self.count else b""
+        self._index = None
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self.count:
+            self.mmap.close()
+
+    def __iter__(self):
+        return self.messages()
+
+    def offset(self, index):
+        """Returns the file offset of record 'index'"""
+        return RECORD_FILE_HEADER.size + index * self.record.size
+
+    def timestamp(self, index):
+        """Returns the timestamp of record 'index'"""
+        return RECORD_TIMESTAMP.unpack_from(self.mmap, self.offset(index))[0]
+
+    @property
+    def index(self):
+        """Timestamps of every CAPTURE_INDEX_STRIDE-th record"""
+        if self._index is None:
+            self._index = array.array("d", (self.timestamp(index)
+                                            for index in range(0, self.count, CAPTURE_INDEX_STRIDE)))
+        return self._index
+
+    def find(self, timestamp):
+        """
+        Returns the index of the first record at or after 'timestamp' (len(self) if there is none).
+        Records are expected in capture order, i.e. with non-decreasing timestamps.
+        """
+        block = bisect.bisect_left(self.index, timestamp)
+        index = max(0, block - 1) * CAPTURE_INDEX_STRIDE
+        while index < self.count and self.timestamp(index) < timestamp:
+            index += 1
+        return index
+
+    def records(self, start=None, end=None):
+        """
+        Yields the records between timestamps 'start' (inclusive) and 'end' (exclusive) as
+        (timestamp, arbitration ID, flags, length, data) tuples, where data is padded to the record size
+
+        :param start: First timestamp, or None to start at the beginning
+        :param end: Timestamp to stop at, or None to read to the end
+        """
+        first = 0 if start is None else self.find(start)
+        last = self.count if end is None else self.find(end)
+        unpack_from = self.record.unpack_from
+        for offset in range(self.offset(first), self.offset(last), self.record.size):
+            yield unpack_from(self.mmap, offset)
+
+    def messages(self, start=None, end=None):
+        """Yields the records between timestamps 'start' and 'end' as can.Message, see records()"""
+        for fields in self.records(start, end):
+            yield self.to_message(*fields)
+
+    @staticmethod
+    def to_message(timestamp, arbitration_id, flags, length, data):
+        return can.Message(
+            timestamp=timestamp,
+            arbitration_id=arbitration_id,
+            is_extended_id=bool(flags & RECORD_FLAG_EXTENDED),
+            is_fd=bool(flags & RECORD_FLAG_FD),
+            bitrate_switch=bool(flags & RECORD_FLAG_BRS),
+            is_error_frame=bool(flags & RECORD_FLAG_ERROR),
+            is_remote_frame=bool(flags & RECORD_FLAG_REMOTE),
+            is_rx=bool(flags & RECORD_FLAG_RX),
+            dlc=length,
+            data=data[:length]
+        )
+
+
+class LogWriter:
+    """
+    Writes frames with the python-can writer of the file extension (.asc, .blf, .csv, .log, .mf4, .trc, .txt)
+
+    :param path: Path of the capture file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.logger = can.Logger(path)
+
+    def write_batch(self, messages):
+        for message in messages:
+            self.logger.on_message_received(message)
+
+    def stop(self):
+        self.logger.stop()
+
+
+class DecodedWriter:
+    """
+    Decodes frames with a DBC database (cantools) and writes one 'ID=<id>, Data=<signals>' line per decoded frame.
+    Frames the database does not describe are skipped.
+
+    :param path: Path of the output file
+    :param dbc: cantools database
+    """
+
+    def __init__(self, path, dbc):
+        self.path = path
+        self.dbc = dbc
+        self.file = open(path, "w")
+        self.decoded = 0
+
+    def write_batch(self, messages):
+        lines = []
+        for message in messages:
+            try:
+                decoded = self.dbc.decode_message(
+                    message.arbitration_id, message.data)
+            except Exception:
+                continue
+            lines.append(f"ID={message.arbitration_id}, Data={decoded}\n")
+        self.file.writelines(lines)
+        self.decoded += len(lines)
+
+    def stop(self):
+        self.file.close()
+
+
+def open_writer(path, fd=False):
+    """Returns the capture writer for the extension of 'path': RecordWriter for .rec, LogWriter otherwise"""
+    if os.path.splitext(path)[1].lower() == RECORD_EXTENSION:
+        return RecordWriter(path, fd=fd)
+    return LogWriter(path)
+
+
+class CaptureStage(threading.Thread):
+    """
+    One stage of a capture pipeline: a thread taking batches of frames from a bounded queue, handing them to
+    its writer and passing them on to the next stage. A full queue makes the previous stage wait, so memory
+    stays flat and frames back up in the socket buffer instead of being dropped.
+
+    :param writer: Object with write_batch(messages) and stop()
+    :param next_stage: CaptureStage receiving the batches after this one, or None
+    """
+
+    def __init__(self, writer, next_stage=None):
+        super().__init__(daemon=True)
+        self.writer = writer
+        self.next_stage = next_stage
+        self.queue = queue.Queue(maxsize=CAPTURE_QUEUE_BATCHES)
+        self.frames = 0
+        self.stalls = 0
+        self.error = None
+
+    def put(self, batch):
+        try:
+            self.queue.put_nowait(batch)
+        except queue.Full:
+            self.stalls += 1
+            self.queue.put(batch)
+
+    def run(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                break
+            if self.error is None:
+                try:
+                    self.writer.write_batch(batch)
+                    self.frames += len(batch)
+                except Exception as e:
+                    # Keep draining, so the receiving thread never blocks on a failed stage
+                    self.error = e
+            if self.next_stage is not None:
+                self.next_stage.put(batch)
+        self.writer.stop()
+        if self.next_stage is not None:
+            self.next_stage.put(None)
+
+
+class CaptureStats:
+    """Counters of a finished capture"""
+
+    def __init__(self, received, written, decoded, stalls, elapsed):
+        self.received = received
+        self.written = written
+        self.decoded = decoded
+        self.stalls = stalls
+        self.elapsed = elapsed
+
+    @property
+    def frame_rate(self):
+        return self.received / self.elapsed if self.elapsed > 0 else 0.0
+
+
+class Capture:
+    """
+    Streaming capture: frames received from 'bus' are collected into batches, written by a writer thread and
+    optionally decoded by a separate decoder thread. Only the batches in flight are held in memory.
+
+    :param bus: Bus or BusView to receive from
+    :param output_file: Path of the raw capture (see open_writer()), or None to only decode
+    :param decoded_file: Path of the decoded output, or None to not decode
+    :param dbc: cantools database used for 'decoded_file'
+    :param fd: Capture CAN FD frames (size of the .rec records)
+    :param batch_size: Frames handed to the writer at once
+    """
+
+    def __init__(self, bus, output_file=None, decoded_file=None, dbc=None, fd=False,
+                 batch_size=CAPTURE_BATCH_SIZE):
+        if output_file is None and decoded_file is None:
+            raise ValueError("Capture needs an output file or a decoded file")
+        if decoded_file is not None and dbc is None:
+            raise ValueError("Decoding a capture needs a DBC database")
+        self.bus = bus
+        self.batch_size = batch_size
+        self.decoder = None if decoded_file is None else CaptureStage(
+            DecodedWriter(decoded_file, dbc))
+        self.writer = None if output_file is None else CaptureStage(
+            open_writer(output_file, fd=fd), next_stage=self.decoder)
+        self.received = 0
+
+    def run(self, duration=None, on_message=None):
+        """
+        Captures until 'duration' seconds have passed, or until interrupted (Ctrl+C) if it is None
+
+        :param duration: Capture duration in seconds, or None
+        :param on_message: Function called with every received frame in the receiving thread, or None
+        :return: CaptureStats
+        """
+        first_stage = self.writer or self.decoder
+        for stage in (self.writer, self.decoder):
+            if stage is not None:
+                stage.start()
+
+        start = time.monotonic()
+        end_time = None if duration is None else start + duration
+        batch = []
+        flush_at = start + CAPTURE_FLUSH_INTERVAL
+        try:
+            while end_time is None or time.monotonic() < end_time:
+                message = self.bus.recv(timeout=CAPTURE_FLUSH_INTERVAL)
+                if message is not None:
+                    batch.append(message)
+                    self.received += 1
+                    if on_message is not None:
+                        on_message(message)
+                if len(batch) >= self.batch_size or (batch and time.monotonic() >= flush_at):
+                    first_stage.put(batch)
+                    batch = []
+                    flush_at = time.monotonic() + CAPTURE_FLUSH_INTERVAL
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if batch:
+                first_stage.put(batch)
+            first_stage.put(None)
+            for stage in (self.writer, self.decoder):
+                if stage is not None:
+                    stage.join()
+        elapsed = time.monotonic() - start
+
+        for stage in (self.writer, self.decoder):
+            if stage is not None and stage.error is not None:
+                print(f"Capture stage failed: {stage.error}")
+        return CaptureStats(
+            self.received,
+            0 if self.writer is None else self.writer.frames,
+            0 if self.decoder is None else self.decoder.writer.decoded,
+            sum(stage.stalls for stage in (self.writer, self.decoder) if stage is not None),
+            elapsed
+        )
@@ -3,6 +3,14 @@ ARBITRATION_ID_MIN = 0x700
 ARBITRATION_ID_MAX = 0x7FF
 ARBITRATION_ID_MAX_EXTENDED = 0x1FFFFFFF
 
+# Response timeout used until round-trip times have been measured
+DEFAULT_RESPONSE_TIMEOUT = 0.1
+# Bounds of the adaptive response timeouts
+RESPONSE_TIMEOUT_FLOOR = 0.01
+RESPONSE_TIMEOUT_CEILING = 1.0
+# Seconds between TesterPresent requests keeping an ECU in a non-default session, well below S3 (5 s)
+TESTER_PRESENT_PERIOD = 2.0
+
 BYTE_MIN = 0x00
 BYTE_MAX = 0xFF
 
@@ -11,8 +19,22 @@ VALUE_TO_ADD_FOR_SUCCESSFUL_RESPONSE = 0x40  # original + 0x40
 NEGATIVE_RESPONSE_CODE = 0x7F
 
 UDS_BROADCAST_ID = 0x7DF
+# 29-bit normal fixed addressing (ISO 15765-2): 0x18DA<target><source> physical, 0x18DB<target><source> functional
+NORMAL_FIXED_PHYSICAL_BASE = 0x18DA0000
+NORMAL_FIXED_FUNCTIONAL_BASE = 0x18DB0000
+TESTER_ADDRESS = 0xF1
+FUNCTIONAL_TARGET_ADDRESS = 0x33
+UDS_BROADCAST_ID_EXTENDED = NORMAL_FIXED_FUNCTIONAL_BASE | (FUNCTIONAL_TARGET_ADDRESS << 8) | TESTER_ADDRESS  # 0x18DB33F1
+# Responses to the tester on 29-bit normal fixed addressing, 0x18DA<tester><target>
+NORMAL_FIXED_RESPONSE_ID_RANGE = range(NORMAL_FIXED_PHYSICAL_BASE | (TESTER_ADDRESS << 8),
+                                       (NORMAL_FIXED_PHYSICAL_BASE | (TESTER_ADDRESS << 8)) + 0x100)
 PHYSICAL_ID_RANGE = range(0x500, 0x7ff)
 RESPONSE_ID_RANGE = range(0x500, 0x7ff)
+# Conventional distance between physical request and response IDs (e.g. 0x7E0 -> 0x7E8)
+RESPONSE_ID_OFFSET = 0x08
+# IDs let through while sniffing: 11-bit diagnostic range and 29-bit normal fixed addressing (0x18DA/0x18DB)
+DIAGNOSTIC_ID_RANGE = range(0x600, 0x800)
+NORMAL_FIXED_ID_RANGE = range(0x18DA0000, 0x18DC0000)
 
 CAR_TYPE_MAPPING = {
     '5WA': 'Volkswagen AG (Volkswagen, Audi, Skoda, SEAT)',
@@ -58,6 +80,9 @@ DID_IDENTIFIERS = {
     0xF19E: "ODX file"
 }
 
+PART_NUMBER_DID = 0xF187
+VIN_DID = 0xF190
+
 SECURITY_ACCESS_SUBFUNCTIONS = {
     0x01: "Request Seed - Level 1",
     0x02: "Send Key - Level 1",
@@ -109,7 +134,6 @@ UDS_SERVICE_NAMES = {
 }
 
 NRC_FOR_AVAILABLE_SERVICE = {
-    0x7f: "Negative response",
     # The ECU is currently busy and cannot process the request at this time
     0x21: "Busy-repeat request",
     # The requested action cannot be performed due to certain conditions not being met
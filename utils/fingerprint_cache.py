@@ -0,0 +1,88 @@
+import json
+import sqlite3
+import time
+
+
+class FingerprintCache:
+    """
+    Persistent SQLite store of the ECUs of known vehicles, with the sessions and services discovered
+    on each ECU. Vehicles are keyed by the set of responding (client ID, server ID) pairs and can also
+    be looked up by VIN.
+    """
+
+    # Version of the stored ECU records, kept in the user_version of the database
+    # 1: sessions with their services, 2: session paths added
+    SCHEMA_VERSION = 2
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        if self.connection.execute("PRAGMA user_version").fetchone()[0] < self.SCHEMA_VERSION:
+            # Vehicles stored in an older layout are dropped and discovered again on their next scan
+            self.connection.execute("DROP TABLE IF EXISTS vehicles")
+            self.connection.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS vehicles ("
+            "fingerprint TEXT PRIMARY KEY, vin TEXT, ecus TEXT NOT NULL, updated REAL NOT NULL)")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS vehicles_vin ON vehicles (vin)")
+        self.connection.commit()
+
+    @staticmethod
+    def fingerprint(id_pairs):
+        """
+        Returns the cache key of a vehicle
+
+        :param id_pairs: Iterable of (client ID, server ID) pairs of the responding ECUs
+        :return: Key string, independent of the order of 'id_pairs'
+        """
+        return ",".join(f"{client_id:X}:{server_id:X}" for client_id, server_id in sorted(set(id_pairs)))
+
+    def store(self, ecus, vin=None):
+        """
+        Stores the sessions and services of 'ecus', replacing an earlier entry of the same vehicle
+
+        :param ecus: List of ECU objects
+        :param vin: VIN of the vehicle, if known
+        :return: None
+        """
+        records = [{
+            "client_id": ecu.client_id,
+            "server_id": ecu.server_id,
+            "sessions": {str(session.session_id): session.services for session in ecu.sessions},
+            "session_paths": {str(session.session_id): session.path for session in ecu.sessions}
+        } for ecu in ecus]
+        fingerprint = self.fingerprint(
+            (ecu.client_id, ecu.server_id) for ecu in ecus)
+        self.connection.execute(
+            "INSERT OR REPLACE INTO vehicles (fingerprint, vin, ecus, updated) VALUES (?, ?, ?, ?)",
+            (fingerprint, vin, json.dumps(records), time.time()))
+        self.connection.commit()
+
+    def lookup(self, id_pairs=None, vin=None):
+        """
+        Returns the stored ECU records of a vehicle, by VIN if given, otherwise by its ECU ID pairs
+
+        :param id_pairs: Iterable of (client ID, server ID) pairs of the responding ECUs
+        :param vin: VIN of the vehicle
+        :return: List of dicts with "client_id", "server_id", "sessions" ({session ID: [service IDs]}) and
+                 "session_paths" ({session ID: [session IDs switched to from the default session]}),
+                 or None if the vehicle is unknown
+        """
+        if vin is not None:
+            row = self.connection.execute(
+                "SELECT ecus FROM vehicles WHERE vin = ? ORDER BY updated DESC LIMIT 1", (vin,)).fetchone()
+        else:
+            row = self.connection.execute(
+                "SELECT ecus FROM vehicles WHERE fingerprint = ?", (self.fingerprint(id_pairs),)).fetchone()
+        if row is None:
+            return None
+        records = json.loads(row[0])
+        for record in records:
+            record["sessions"] = {int(session_id): services
+                                  for session_id, services in record["sessions"].items()}
+            record["session_paths"] = {int(session_id): path
+                                       for session_id, path in record["session_paths"].items()}
+        return records
+
+    def close(self):
+        self.connection.close()
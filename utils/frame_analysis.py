@@ -0,0 +1,251 @@
+import array
+
+import numpy as np
+
+from utils import constants
+from utils.iso15765_2 import IsoTp
+
+# Frame types counted by analyse_frames()
+FRAME_TYPES = ("SF", "FF", "CF", "FC", "other")
+SF, FF, CF, FC, OTHER = range(len(FRAME_TYPES))
+# Leading data bytes kept per frame: PCI, SF length / service ID, and the service ID of escape SFs and NRCs
+ANALYSED_BYTES = 4
+
+UDS_REQUEST_SERVICE_IDS = np.array(
+    [service_id for service_id in constants.UDS_SERVICE_NAMES if service_id != constants.NEGATIVE_RESPONSE_CODE])
+UDS_FUNCTIONAL_IDS = (constants.UDS_BROADCAST_ID, constants.UDS_BROADCAST_ID_EXTENDED)
+
+
+def is_diagnostic_id(arbitration_id):
+    """Returns True for IDs of the 11-bit diagnostic range and of 29-bit normal fixed addressing"""
+    return arbitration_id in constants.DIAGNOSTIC_ID_RANGE or arbitration_id in constants.NORMAL_FIXED_ID_RANGE
+
+
+class FrameBatch:
+    """
+    Column store of received frames (timestamp, ID, length, leading data bytes), appended to one frame at a time
+    and handed to analyse_frames() as NumPy arrays without copying
+    """
+
+    def __init__(self):
+        self.timestamps = array.array("d")
+        self.arbitration_ids = array.array("I")
+        self.lengths = array.array("B")
+        self.data = bytearray()
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def append(self, msg):
+        self.timestamps.append(msg.timestamp)
+        self.arbitration_ids.append(msg.arbitration_id)
+        self.lengths.append(len(msg.data))
+        leading = bytes(msg.data[:ANALYSED_BYTES])
+        self.data += leading
+        if len(leading) < ANALYSED_BYTES:
+            self.data += bytes(ANALYSED_BYTES - len(leading))
+
+    def analyse(self):
+        """Returns the TrafficSummary of the frames in the batch"""
+        return analyse_frames(
+            np.frombuffer(self.timestamps, dtype=np.float64),
+            np.frombuffer(self.arbitration_ids, dtype=np.uint32),
+            np.frombuffer(self.lengths, dtype=np.uint8),
+            np.frombuffer(bytes(self.data), dtype=np.uint8).reshape(-1, ANALYSED_BYTES)
+        )
+
+
+def analyse_capture(capture, start=None, end=None):
+    """
+    Returns the TrafficSummary of a memory-mapped .rec capture. The records are viewed as a NumPy structured
+    array on the mapping, so no frame is copied or converted.
+
+    :param capture: utils.capture.RecordReader
+    :param start: First timestamp to analyse, or None to start at the beginning
+    :param end: Timestamp to stop at, or None to analyse to the end
+    """
+    first = 0 if start is None else capture.find(start)
+    last = len(capture) if end is None else capture.find(end)
+    if last <= first:
+        return analyse_frames(np.empty(0), np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.uint8),
+                              np.empty((0, ANALYSED_BYTES), dtype=np.uint8))
+    record = np.dtype([("timestamp", "<f8"), ("arbitration_id", "<u4"), ("flags", "u1"), ("length", "u1"),
+                       ("data", "u1", (capture.data_size,))])
+    records = np.frombuffer(capture.mmap, dtype=record, count=last - first, offset=capture.offset(first))
+    return analyse_frames(records["timestamp"], records["arbitration_id"], records["length"],
+                          records["data"][:, :ANALYSED_BYTES])
+
+
+class IdStatistics:
+    """Frames of one arbitration ID: count per frame type and inter-frame timing"""
+
+    def __init__(self, arbitration_id, frames, type_counts, mean_period, min_period):
+        self.arbitration_id = arbitration_id
+        self.frames = frames
+        # Frame type (FRAME_TYPES) -> count
+        self.type_counts = type_counts
+        # Mean and minimum time between two frames of the ID, None for a single frame
+        self.mean_period = mean_period
+        self.min_period = min_period
+
+    @property
+    def iso_tp(self):
+        """
+        True if the ID carries segmented ISO-TP transfers: it has FF, CF or FC frames and every one of its frames
+        is a valid ISO-TP frame. Signals of periodic IDs look like PCI bytes now and then, but not in every frame.
+        """
+        counts = self.type_counts
+        return counts["other"] == 0 and counts["FF"] + counts["CF"] + counts["FC"] > 0
+
+
+class PairStatistics:
+    """UDS single frame requests on one ID answered on another"""
+
+    def __init__(self, request_id, response_id, count, mean_latency, functional):
+        self.request_id = request_id
+        self.response_id = response_id
+        self.count = count
+        self.mean_latency = mean_latency
+        self.functional = functional
+
+
+class TrafficSummary:
+    """Result of analyse_frames()"""
+
+    def __init__(self, frames, duration, frame_types, ids, pairs):
+        self.frames = frames
+        self.duration = duration
+        # Frame type (FRAME_TYPES) -> count over all IDs
+        self.frame_types = frame_types
+        # Arbitration ID -> IdStatistics
+        self.ids = ids
+        # (request ID, response ID) -> PairStatistics
+        self.pairs = pairs
+
+    @property
+    def iso_tp_ids(self):
+        return {arbitration_id for arbitration_id, stats in self.ids.items() if stats.iso_tp}
+
+    @property
+    def iso_tp_detected(self):
+        return len(self.iso_tp_ids) > 0
+
+    @property
+    def diagnostic_ids(self):
+        return {arbitration_id for arbitration_id in self.ids if is_diagnostic_id(arbitration_id)}
+
+    @property
+    def uds_functional(self):
+        return any(pair.functional for pair in self.pairs.values())
+
+    @property
+    def uds_physical(self):
+        return any(not pair.functional for pair in self.pairs.values())
+
+    def print(self):
+        print(f"[~] {self.frames} frames on {len(self.ids)} IDs in {self.duration:.1f} s: " +
+              ", ".join(f"{name} {count}" for name, count in self.frame_types.items()))
+        if self.iso_tp_ids:
+            print(f"[!] ISO-TP transfers on {', '.join(hex(aid) for aid in sorted(self.iso_tp_ids))}")
+        for pair in self.pairs.values():
+            print(f"[!] UDS {'functional' if pair.functional else 'physical'} request "
+                  f"{hex(pair.request_id)} -> {hex(pair.response_id)}: {pair.count} responses, "
+                  f"mean latency {pair.mean_latency * 1000:.1f} ms")
+
+
+def analyse_frames(timestamps, arbitration_ids, lengths, data):
+    """
+    Classifies frames by ISO-TP PCI type, counts them per ID, measures the inter-frame timing of every ID and
+    pairs UDS single frame requests with their responses - all with vector operations, so millions of frames
+    are analysed in about a second
+
+    :param timestamps: Receive timestamps, in capture order
+    :param arbitration_ids: Arbitration IDs
+    :param lengths: Data lengths
+    :param data: Array of shape (frames, ANALYSED_BYTES) with the leading data bytes, zero padded
+    :return: TrafficSummary
+    """
+    count = len(timestamps)
+    arbitration_ids = arbitration_ids.astype(np.int64)
+    lengths = lengths.astype(np.int64)
+    pci = data[:, 0].astype(np.int64)
+    byte1 = data[:, 1].astype(np.int64)
+
+    # ISO-TP frame type from the PCI byte, checked against the frame length
+    pci_type = np.where(lengths > 0, pci >> 4, -1)
+    sf_length = pci & 0x0F
+    classic_sf = (pci_type == 0) & (sf_length > 0) & (sf_length < lengths)
+    escape_sf = (pci == 0) & (lengths > IsoTp.MAX_FRAME_LENGTH) & (byte1 > 0) & (byte1 <= lengths - 2)
+    frame_type = np.full(count, OTHER)
+    frame_type[classic_sf | escape_sf] = SF
+    frame_type[(pci_type == 1) & (lengths >= IsoTp.MAX_FRAME_LENGTH)] = FF
+    frame_type[pci_type == 2] = CF
+    frame_type[(pci_type == 3) & (sf_length <= 2) & (lengths >= 3)] = FC
+    frame_types = dict(zip(FRAME_TYPES, np.bincount(frame_type, minlength=len(FRAME_TYPES)).tolist()))
+
+    # Per ID counts
+    unique_ids, id_index = np.unique(arbitration_ids, return_inverse=True)
+    id_count = len(unique_ids)
+    type_counts = np.zeros((id_count, len(FRAME_TYPES)), dtype=np.int64)
+    np.add.at(type_counts, (id_index, frame_type), 1)
+
+    # Inter-frame timing per ID - a stable sort by ID keeps each ID's frames in time order
+    order = np.argsort(id_index, kind="stable")
+    sorted_index = id_index[order]
+    periods = np.diff(timestamps[order])
+    same_id = sorted_index[1:] == sorted_index[:-1]
+    period_index = sorted_index[1:][same_id]
+    periods = periods[same_id]
+    period_counts = np.bincount(period_index, minlength=id_count)
+    period_sums = np.bincount(period_index, weights=periods, minlength=id_count)
+    min_periods = np.full(id_count, np.inf)
+    np.minimum.at(min_periods, period_index, periods)
+
+    ids = {}
+    for index, arbitration_id in enumerate(unique_ids.tolist()):
+        has_period = period_counts[index] > 0
+        ids[arbitration_id] = IdStatistics(
+            arbitration_id,
+            int(type_counts[index].sum()),
+            dict(zip(FRAME_TYPES, type_counts[index].tolist())),
+            float(period_sums[index] / period_counts[index]) if has_period else None,
+            float(min_periods[index]) if has_period else None
+        )
+
+    # UDS request/response pairs: each response (SF, or the FF of a long positive response) belongs to the
+    # last single frame request before it
+    is_sf = frame_type == SF
+    # Escape sequence FFs carry the service ID beyond the analysed bytes
+    is_ff = (frame_type == FF) & ((pci != 0x10) | (byte1 != 0))
+    service_id = np.where(escape_sf | is_ff, data[:, 2], byte1)
+    nrc_service_id = np.where(escape_sf, data[:, 3], data[:, 2])
+    requests = np.flatnonzero(is_sf & np.isin(service_id, UDS_REQUEST_SERVICE_IDS))
+    positive = np.isin(service_id, UDS_REQUEST_SERVICE_IDS + constants.VALUE_TO_ADD_FOR_SUCCESSFUL_RESPONSE)
+    responses = np.flatnonzero((is_sf & ((service_id == constants.NEGATIVE_RESPONSE_CODE) | positive)) |
+                               (is_ff & positive))
+    previous = np.searchsorted(requests, responses) - 1
+    has_request = previous >= 0
+    responses = responses[has_request]
+    request_of = requests[previous[has_request]]
+    answered_service_id = np.where(service_id[responses] == constants.NEGATIVE_RESPONSE_CODE,
+                                   nrc_service_id[responses],
+                                   service_id[responses] - constants.VALUE_TO_ADD_FOR_SUCCESSFUL_RESPONSE)
+    matched = (answered_service_id == service_id[request_of]) & \
+        (arbitration_ids[responses] != arbitration_ids[request_of])
+    responses = responses[matched]
+    request_of = request_of[matched]
+
+    pairs = {}
+    pair_keys = (arbitration_ids[request_of] << 32) | arbitration_ids[responses]
+    unique_pairs, pair_index, pair_counts = np.unique(
+        pair_keys, return_inverse=True, return_counts=True)
+    latency_sums = np.bincount(pair_index, weights=timestamps[responses] - timestamps[request_of],
+                               minlength=len(unique_pairs))
+    for key, pair_count, latency_sum in zip(unique_pairs.tolist(), pair_counts.tolist(), latency_sums.tolist()):
+        request_id, response_id = key >> 32, key & 0xFFFFFFFF
+        pairs[(request_id, response_id)] = PairStatistics(
+            request_id, response_id, pair_count, latency_sum / pair_count,
+            request_id in UDS_FUNCTIONAL_IDS)
+
+    duration = float(timestamps[-1] - timestamps[0]) if count > 1 else 0.0
+    return TrafficSummary(count, duration, frame_types, ids, pairs)
@@ -140,6 +140,10 @@ class Services(object):
             # 0x60-0x7E System supplier specific
             # 0x7F ISO SAE Reserved
 
+    class ReadDataByIdentifier(BaseService):
+
+        service_id = ServiceID.READ_DATA_BY_IDENTIFIER
+
     class SecurityAccess(BaseService):
 
         service_id = ServiceID.SECURITY_ACCESS
@@ -197,16 +201,141 @@ class Services(object):
             def get_send_key_for_request_seed(seed):
                 return seed + 1
 
+    class TesterPresent(BaseService):
+
+        service_id = ServiceID.TESTER_PRESENT
+
+        ZERO_SUB_FUNCTION = 0x00
+        # Set in the sub-function, the server does not send a positive response
+        SUPPRESS_POSITIVE_RESPONSE = 0x80
+
+
+class PositiveResponse(object):
+    """Positive response to a request of service 'service_id', 'data' being the bytes after the response SID"""
+    positive = True
+
+    def __init__(self, service_id, data):
+        self.service_id = service_id
+        self.data = data
+
+
+class NegativeResponse(object):
+    """Negative response (0x7F) to a request of service 'service_id' with negative response code 'nrc'"""
+    positive = False
+
+    def __init__(self, service_id, nrc):
+        self.service_id = service_id
+        self.nrc = nrc
+
 
 class Iso14229_1(object):
     P3_CLIENT = 5
+    # Default server timings in seconds, until a DiagnosticSessionControl response reports others
+    P2_SERVER = 0.05
+    P2_STAR_SERVER = 5.0
+    # Seconds without requests after which a server falls back from a non-default session to the default session
+    S3_SERVER = 5.0
+
+    NEGATIVE_RESPONSE_ID = 0x7F
 
-    def __init__(self, tp):
+    def __init__(self, tp, p2_server=P2_SERVER, p2_star_server=P2_STAR_SERVER):
         self.tp = tp
+        self.p2_server = p2_server
+        self.p2_star_server = p2_star_server
+        # Number of response pending (NRC 0x78) responses received for the last request
+        self.response_pending_count = 0
 
     def __enter__(self):
         return self
 
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def request(self, data, timeout=None, on_unrelated=None, messages=None):
+        """
+        Sends 'data' as a request and returns the final response to it. While the server answers with
+        response pending (NRC 0x78), waiting continues for P2* after each of them.
+
+        :param data: Request payload, starting with the service ID
+        :param timeout: Seconds to wait for the first response, or None to wait for P2
+        :param on_unrelated: Function called with parsed responses to other services, e.g. late responses
+                             to earlier requests, or None to drop them
+        :param messages: Pre-built can.Message objects carrying 'data', e.g. on another arbitration ID than the
+                         one of the IsoTp context, or None to build them
+        :return: PositiveResponse or NegativeResponse, or None on timeout
+        """
+        service_id = data[0]
+        self.response_pending_count = 0
+        if messages is None:
+            self.tp.send_request(data)
+        else:
+            self.tp.transmit_messages(messages, self.tp.arb_id_response)
+        deadline = time.monotonic() + (self.p2_server if timeout is None else timeout)
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            payload = self.tp.receive_message(remaining)
+            if payload is None:
+                return None
+            response = self.parse_response(payload)
+            if response is None:
+                continue
+            if response.service_id != service_id:
+                if on_unrelated is not None:
+                    on_unrelated(response)
+                continue
+            if self.is_response_pending(response, service_id):
+                # The server needs more time - the final response is due within P2*
+                self.response_pending_count += 1
+                deadline = time.monotonic() + self.p2_star_server
+                continue
+            if response.positive and service_id == ServiceID.DIAGNOSTIC_SESSION_CONTROL:
+                timings = self.parse_timings(response)
+                if timings is not None:
+                    self.p2_server, self.p2_star_server = timings
+            return response
+
+    @classmethod
+    def parse_response(cls, payload):
+        """
+        Parses a response payload
+
+        :param payload: Response payload, starting with the response SID
+        :return: PositiveResponse or NegativeResponse, or None if 'payload' is not a valid response
+        """
+        if len(payload) == 0:
+            return None
+        if payload[0] == cls.NEGATIVE_RESPONSE_ID:
+            if len(payload) < 3:
+                return None
+            return NegativeResponse(payload[1], payload[2])
+        if payload[0] < 0x40:
+            # Not a response SID
+            return None
+        return PositiveResponse(cls.get_service_request_id(payload[0]), payload[1:])
+
+    @staticmethod
+    def parse_timings(response):
+        """
+        Returns the server timings reported in a positive DiagnosticSessionControl response
+
+        :param response: PositiveResponse with data [session, P2 high, P2 low, P2* high, P2* low]
+        :return: Tuple of P2 and P2* in seconds, or None if the response does not contain them
+        """
+        if len(response.data) < 5:
+            return None
+        # P2 is given in 1 ms and P2* in 10 ms resolution
+        p2_server = ((response.data[1] << 8) | response.data[2]) / 1000
+        p2_star_server = ((response.data[3] << 8) | response.data[4]) * 10 / 1000
+        return p2_server, p2_star_server
+
+    @staticmethod
+    def is_response_pending(response, service_id):
+        """Returns True if 'response' is a response pending (NRC 0x78) response to 'service_id'"""
+        return response is not None and not response.positive and response.service_id == service_id \
+            and response.nrc == NegativeResponseCodes.REQUEST_CORRECTLY_RECEIVED_RESPONSE_PENDING
+
     @staticmethod
     def get_service_response_id(request_id):
         """
@@ -1,12 +1,16 @@
-from utils.constants import ARBITRATION_ID_MAX, ARBITRATION_ID_MAX_EXTENDED
+from utils.constants import ARBITRATION_ID_MAX
+from utils.bus_backends import get_backend
+from utils.can_filters import exact_id_filters
 import can
+import functools
 import time
 
 
 class IsoTp:
     """
     Implementation of ISO-15765-2, also known as ISO-TP. This is a multi-frame messaging protocol
-    over CAN, which allows message payloads of up to 4095 bytes.
+    over CAN, which allows message payloads of up to 4095 bytes. In CAN FD mode (ISO-15765-2:2016)
+    frames carry up to 64 bytes and escape sequence first frames allow payloads of up to 4 GiB.
     """
 
     MAX_SF_LENGTH = 7
@@ -17,6 +21,9 @@ class IsoTp:
     CF_PCI_LENGTH = 1
     FF_PCI_LENGTH = 2
     FC_PCI_LENGTH = 3
+    # Escape sequence PCI: SF 0x00 + 8-bit length, FF 0x10 0x00 + 32-bit length
+    SF_ESCAPE_PCI_LENGTH = 2
+    FF_ESCAPE_PCI_LENGTH = 6
 
     FC_FS_CTS = 0
     FC_FS_WAIT = 1
@@ -28,20 +35,45 @@ class IsoTp:
     FC_FRAME_ID = 3
 
     N_BS_TIMEOUT = 1.5
+    N_CR_TIMEOUT = 1.0
 
     MAX_FRAME_LENGTH = 8
     MAX_MESSAGE_LENGTH = 4095
+    MAX_FRAME_LENGTH_FD = 64
+    MAX_MESSAGE_LENGTH_FD = 0xFFFFFFFF
+    # Longest message received by default - the reassembly buffer is allocated from the FF length
+    MAX_RX_LENGTH = 0x100000
+    # Data lengths a CAN FD frame can have - shorter frames are padded up to the next one
+    FD_DATA_LENGTHS = (0, 1, 2, 3, 4, 5, 6, 7, 8, 12, 16, 20, 24, 32, 48, 64)
 
-    def __init__(self, arb_id_request, arb_id_response, bus=None, padding_value=0x00, channel=None):
+    # Number of distinct requests whose can.Message objects are kept by get_cached_messages()
+    MESSAGE_CACHE_SIZE = 1024
+
+    def __init__(self, arb_id_request, arb_id_response, bus=None, padding_value=0x00, channel=None, block_size=0,
+                 st_min=0, backend=None, fd=False, tx_dl=MAX_FRAME_LENGTH_FD, max_rx_length=MAX_RX_LENGTH):
         # Setting default bus to None rather than the actual bus prevents a CanError when
         # called with a virtual CAN bus, while the OS is lacking a working CAN interface
         if bus is None:
-            self.bus = can.Bus(channel=channel,
-                               interface="socketcan")
+            # Without a bus, open one on 'channel' through 'backend' (a BusBackend or its name)
+            self.bus = get_backend(backend).open(channel, fd=fd)
         else:
             self.bus = bus
+        # CAN FD mode: frames are sent as FD frames of up to 'tx_dl' (transmit data length) bytes
+        self.fd = fd
+        if fd and tx_dl not in self.FD_DATA_LENGTHS[8:]:
+            raise ValueError(
+                "IsoTp: FD transmit data length must be one of {0}, got '{1}'".format(self.FD_DATA_LENGTHS[8:], tx_dl))
+        self.tx_dl = tx_dl if fd else self.MAX_FRAME_LENGTH
+        # Longer messages are refused with an overflow flow control (FC) before anything is allocated
+        self.max_message_length = min(self.MAX_MESSAGE_LENGTH_FD if fd else self.MAX_MESSAGE_LENGTH, max_rx_length)
         self.arb_id_request = arb_id_request
         self.arb_id_response = arb_id_response
+        # Arbitration ID the last message was received on, telling the sender apart when 'arb_id_response' is None
+        self.last_response_id = None
+        # Block size (BS) and separation time minimum (STmin) requested in the flow control (FC) frames
+        # sent while receiving multi-frame messages
+        self.block_size = block_size
+        self.st_min = st_min
         # Controls optional padding of SF messages and the last CF frame in multi-frame messages
         # Disabled padding is _not_ part of ISO-15765-2, but might prove useful for testing against some targets
         self.padding_value = padding_value
@@ -85,13 +117,51 @@ class IsoTp:
         :param force_extended: Force extended arbitration ID
         :return: None
         """
+        self.bus.send(self.build_message(
+            data, arbitration_id, self.fd, force_extended))
+
+    @staticmethod
+    def build_message(data, arbitration_id, fd=False, force_extended=False):
+        """
+        Returns a can.Message carrying frame 'data' on 'arbitration_id'
+
+        :param data: Frame data
+        :param arbitration_id: Arbitration ID to use
+        :param fd: Build a CAN FD frame (with bitrate switch)
+        :param force_extended: Force extended arbitration ID
+        :return: can.Message
+        """
         is_extended = force_extended or arbitration_id > ARBITRATION_ID_MAX
-        msg = can.Message(
+        return can.Message(
             arbitration_id=arbitration_id,
             data=data,
-            is_extended_id=False
+            is_extended_id=is_extended,
+            is_fd=fd,
+            bitrate_switch=fd
         )
-        self.bus.send(msg)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=MESSAGE_CACHE_SIZE)
+    def get_cached_messages(message, arbitration_id, padding_value=0x00, tx_dl=MAX_FRAME_LENGTH, fd=False):
+        """
+        Returns the can.Message objects carrying 'message' on 'arbitration_id'. They are built once per
+        distinct request and then reused, so repeated requests (session control, tester present, DID reads)
+        are sent without segmenting or constructing anything. The buses copy or serialise what they send,
+        so the messages are never modified - callers must not modify them either.
+
+        :param message: Message to send, as bytes
+        :param arbitration_id: Arbitration ID to use
+        :param padding_value: See get_frames_from_message()
+        :param tx_dl: See get_frames_from_message()
+        :param fd: Build CAN FD frames
+        :return: Tuple of can.Message
+        """
+        return tuple(IsoTp.build_message(frame, arbitration_id, fd)
+                     for frame in IsoTp.get_frames_from_message(message, padding_value, tx_dl))
+
+    def get_messages(self, message, arbitration_id):
+        """Returns the (cached) can.Message objects carrying 'message' on 'arbitration_id' from this context"""
+        return self.get_cached_messages(bytes(message), arbitration_id, self.padding_value, self.tx_dl, self.fd)
 
     def decode_fc(self, frame):
         """
@@ -109,6 +179,117 @@ class IsoTp:
         else:
             return None, None, None
 
+    def send_flow_control(self, flow_status=FC_FS_CTS):
+        """
+        Sends a flow control (FC) frame on 'self.arb_id_request'
+
+        :param flow_status: Flow status (FS) to send
+        :return: None
+        """
+        frame = [(self.FC_FRAME_ID << 4) | flow_status,
+                 self.block_size, self.st_min]
+        # The FC frame keeps the classic length in FD mode as well
+        if self.padding_enabled:
+            frame.extend([self.padding_value] *
+                         (self.MAX_FRAME_LENGTH - len(frame)))
+        self.send_message(frame, self.arb_id_request)
+
+    def receive_message(self, timeout=1.0):
+        """
+        Receives a complete message on 'self.arb_id_response', sending flow control (FC) frames on
+        'self.arb_id_request' while a multi-frame message is being received
+
+        :param timeout: Seconds to wait for the single frame (SF) or first frame (FF) of the message
+        :return: Message payload as a bytearray, or None on timeout or reception error
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            msg = self._recv_response_frame(deadline)
+            if msg is None:
+                return None
+            frame = msg.data
+            frame_type = frame[0] >> 4
+            self.last_response_id = msg.arbitration_id
+            if frame_type == self.SF_FRAME_ID:
+                message_length = frame[0] & 0x0F
+                pci_length = self.SF_PCI_LENGTH
+                if message_length == 0 and len(frame) > self.MAX_FRAME_LENGTH:
+                    # Escape sequence SF of a CAN FD frame
+                    message_length = frame[1]
+                    pci_length = self.SF_ESCAPE_PCI_LENGTH
+                if 0 < message_length <= len(frame) - pci_length:
+                    return bytearray(frame[pci_length:pci_length + message_length])
+            elif frame_type == self.FF_FRAME_ID:
+                return self._receive_multi_frame_message(frame)
+            # Stray consecutive (CF) and flow control (FC) frames are ignored
+
+    def _receive_multi_frame_message(self, first_frame):
+        """
+        Receives the consecutive frames (CF) following 'first_frame'
+
+        :param first_frame: Data of the first frame (FF)
+        :return: Message payload as a bytearray, or None on N_Cr timeout or sequence number error
+        """
+        message_length = ((first_frame[0] & 0x0F) << 8) | first_frame[1]
+        pci_length = self.FF_PCI_LENGTH
+        if message_length == 0 and len(first_frame) >= self.FF_ESCAPE_PCI_LENGTH:
+            # Escape sequence FF of a message longer than 4095 bytes
+            message_length = int.from_bytes(
+                first_frame[2:self.FF_ESCAPE_PCI_LENGTH], "big")
+            pci_length = self.FF_ESCAPE_PCI_LENGTH
+        if message_length > self.max_message_length:
+            self.send_flow_control(self.FC_FS_OVFLW)
+            return None
+        # Reassemble in place into a buffer sized from the FF length
+        message = bytearray(message_length)
+        view = memoryview(message)
+        # The FF sets the data length of the following CFs (8 bytes classic, up to 64 bytes FD)
+        bytes_received = min(len(first_frame) - pci_length, message_length)
+        view[:bytes_received] = first_frame[pci_length:
+                                            pci_length + bytes_received]
+        sn = 0
+        while bytes_received < message_length:
+            self.send_flow_control()
+            frames_left_in_block = self.block_size
+            while bytes_received < message_length:
+                msg = self._recv_response_frame(
+                    time.monotonic() + self.N_CR_TIMEOUT)
+                if msg is None:
+                    # N_Cr timeout
+                    return None
+                frame = msg.data
+                if frame[0] >> 4 != self.CF_FRAME_ID:
+                    continue
+                sn = (sn + 1) % 16
+                if frame[0] & 0x0F != sn:
+                    # Wrong sequence number (SN) - abort reception
+                    return None
+                bytes_to_copy = min(message_length - bytes_received,
+                                    len(frame) - self.CF_PCI_LENGTH)
+                view[bytes_received:bytes_received + bytes_to_copy] = frame[self.CF_PCI_LENGTH:
+                                                                            self.CF_PCI_LENGTH + bytes_to_copy]
+                bytes_received += bytes_to_copy
+                if self.block_size != 0:
+                    frames_left_in_block -= 1
+                    if frames_left_in_block == 0:
+                        # Block complete - send next flow control (FC)
+                        break
+        return message
+
+    def _recv_response_frame(self, deadline):
+        """
+        Returns the next non-empty frame on 'self.arb_id_response' received before 'deadline', or None. Frames
+        already buffered are returned even once 'deadline' has passed.
+        """
+        while True:
+            msg = self.bus.recv(max(0.0, deadline - time.monotonic()))
+            if msg is None:
+                return None
+            if self.arb_id_response is not None and msg.arbitration_id != self.arb_id_response:
+                continue
+            if len(msg.data) > 0:
+                return msg
+
     def send_request(self, message):
         """
         Wrapper for sending 'message' as a request
@@ -116,9 +297,8 @@ class IsoTp:
         :param message: The message to send
         :return: None
         """
-        frames = self.get_frames_from_message(
-            message, padding_value=self.padding_value)
-        self.transmit(frames, self.arb_id_request, self.arb_id_response)
+        self.transmit_messages(self.get_messages(
+            message, self.arb_id_request), self.arb_id_response)
 
     def transmit(self, frames, arbitration_id, arbitration_id_flow_control):
         """
@@ -129,38 +309,55 @@ class IsoTp:
         :param arbitration_id_flow_control: The arbitration ID used for receiving flow control (FC)
         :return: None
         """
-        if len(frames) == 0:
+        self.transmit_messages([self.build_message(frame, arbitration_id, self.fd) for frame in frames],
+                               arbitration_id_flow_control)
+
+    def transmit_messages(self, messages, arbitration_id_flow_control):
+        """
+        Transmits the frames of a segmented message in order on the bus, according to ISO-15765-2
+
+        :param messages: Sequence of can.Message, e.g. from get_messages()
+        :param arbitration_id_flow_control: The arbitration ID used for receiving flow control (FC)
+        :return: None
+        """
+        if len(messages) == 0:
             # No data to send
             return None
-        elif len(frames) == 1:
+        elif len(messages) == 1:
             # Single frame
-            self.send_message(frames[0], arbitration_id)
-        elif len(frames) > 1:
+            self.bus.send(messages[0])
+        elif len(messages) > 1:
             # Multiple frames
             frame_index = 0
             # Send first frame (FF)
-            self.send_message(frames[frame_index], arbitration_id)
-            number_of_frames_left_to_send = len(frames) - 1
+            self.bus.send(messages[frame_index])
+            number_of_frames_left_to_send = len(messages) - 1
             number_of_frames_left_to_send_in_block = 0
             frame_index += 1
             st_min = 0
             while number_of_frames_left_to_send > 0:
                 receiver_is_ready = False
+                # N_Bs runs from the last frame sent, not from the last frame received
+                deadline = time.monotonic() + self.N_BS_TIMEOUT
                 while not receiver_is_ready:
                     # Wait for receiver to send flow control (FC)
-                    msg = self.bus.recv(self.N_BS_TIMEOUT)
+                    msg = self.bus.recv(
+                        max(0.0, deadline - time.monotonic()))
                     if msg is None:
                         # Quit on timeout
                         return None
                     # Verify that msg uses the expected arbitration ID
                     elif msg.arbitration_id != arbitration_id_flow_control:
+                        if time.monotonic() >= deadline:
+                            return None
                         continue
                     fc_frame = msg.data
 
                     # Decode Flow Status (FS) from FC message
                     fs, block_size, st_min = self.decode_fc(fc_frame)
                     if fs == self.FC_FS_WAIT:
-                        # Flow status (FS) wait (WT)
+                        # Flow status (FS) wait (WT) - N_Bs starts again
+                        deadline = time.monotonic() + self.N_BS_TIMEOUT
                         continue
                     elif fs == self.FC_FS_CTS:
                         # Continue to send (CTS)
@@ -181,7 +378,7 @@ class IsoTp:
                         return None
                 while number_of_frames_left_to_send_in_block > 0:
                     # Send more frames, until it is time to wait for flow control (FC) again
-                    self.send_message(frames[frame_index], arbitration_id)
+                    self.bus.send(messages[frame_index])
                     frame_index += 1
                     number_of_frames_left_to_send_in_block -= 1
                     number_of_frames_left_to_send -= 1
@@ -189,12 +386,15 @@ class IsoTp:
                         time.sleep(st_min / 1000)
 
     @staticmethod
-    def get_frames_from_message(message, padding_value=0x00):
+    def get_frames_from_message(message, padding_value=0x00, tx_dl=MAX_FRAME_LENGTH):
         """
-        Returns a copy of 'message' split into frames,
-        :param message: Message to split
+        Returns 'message' split into frames. The frames are laid out in one preallocated buffer, which is
+        filled with the padding value and into which the PCI bytes and the payload slices are copied once.
+
+        :param message: Message to split (bytes, bytearray, memoryview or a list of integers)
         :param padding_value: Integer value used to pad messages, or None to disable padding (not part of ISO-15765-3)
-        :return: List of frames
+        :param tx_dl: Transmit data length - 8 for classic CAN, up to 64 for CAN FD
+        :return: List of frames, as memoryview slices of the shared buffer
         """
         if padding_value is None:
             padding_enabled = False
@@ -202,56 +402,68 @@ class IsoTp:
         else:
             padding_enabled = True
 
-        frame_list = []
-        message_length = len(message)
-        if message_length > IsoTp.MAX_MESSAGE_LENGTH:
+        payload = memoryview(message if isinstance(message, (bytes, bytearray, memoryview)) else bytes(message))
+        message_length = len(payload)
+        fd = tx_dl > IsoTp.MAX_FRAME_LENGTH
+        max_message_length = IsoTp.MAX_MESSAGE_LENGTH_FD if fd else IsoTp.MAX_MESSAGE_LENGTH
+        if message_length > max_message_length:
             error_msg = "Message too long for ISO-TP. Max allowed length is {0} bytes, received {1} bytes".format(
-                IsoTp.MAX_MESSAGE_LENGTH, message_length)
+                max_message_length, message_length)
             raise ValueError(error_msg)
+
+        # Layout of the frames: (PCI bytes, payload start, payload end, frame length)
+        layout = []
         if message_length <= IsoTp.MAX_SF_LENGTH:
             # Single frame (SF) message
-            if padding_enabled:
-                frame = [padding_value] * IsoTp.MAX_FRAME_LENGTH
-            else:
-                frame = [padding_value] * (message_length + 1)
-            frame[0] = (IsoTp.SF_FRAME_ID << 4) | message_length
-            for i in range(0, message_length):
-                frame[1 + i] = message[i]
-            frame_list.append(frame)
+            layout.append((bytes([(IsoTp.SF_FRAME_ID << 4) | message_length]), 0, message_length,
+                           IsoTp._padded_length(1 + message_length, padding_enabled)))
+        elif fd and message_length <= tx_dl - IsoTp.SF_ESCAPE_PCI_LENGTH:
+            # Escape sequence single frame (SF) of a CAN FD frame
+            layout.append((bytes([IsoTp.SF_FRAME_ID << 4, message_length]), 0, message_length,
+                           IsoTp._padded_length(IsoTp.SF_ESCAPE_PCI_LENGTH + message_length, padding_enabled)))
         else:
             # Multiple frame message
-            bytes_left_to_copy = message_length
-            # Create first frame (FF)
-            frame = [padding_value] * IsoTp.MAX_FRAME_LENGTH
-            frame[0] = (IsoTp.FF_FRAME_ID << 4) | (message_length >> 8)
-            frame[1] = message_length & 0xFF
-            for i in range(0, IsoTp.MAX_FF_LENGTH):
-                frame[2 + i] = message[i]
-            frame_list.append(frame)
-            # Create consecutive frames (CF)
-            bytes_copied = IsoTp.MAX_FF_LENGTH
-            bytes_left_to_copy -= bytes_copied
+            # First frame (FF), which always has the full transmit data length
+            if message_length <= IsoTp.MAX_MESSAGE_LENGTH:
+                pci = bytes([(IsoTp.FF_FRAME_ID << 4) | (message_length >> 8), message_length & 0xFF])
+            else:
+                # Escape sequence FF with a 32-bit length
+                pci = bytes([IsoTp.FF_FRAME_ID << 4, 0x00]) + message_length.to_bytes(4, "big")
+            bytes_copied = tx_dl - len(pci)
+            layout.append((pci, 0, bytes_copied, tx_dl))
+            # Consecutive frames (CF) - only the last one can be shorter than the transmit data length
+            cf_length = tx_dl - IsoTp.CF_PCI_LENGTH
             sn = 0
-            while bytes_left_to_copy > 0:
+            while bytes_copied < message_length:
                 sn = (sn + 1) % 16
-                if not padding_enabled and bytes_left_to_copy < 7:
-                    # Skip padding on last CF
-                    frame = [padding_value] * (bytes_left_to_copy + 1)
-                else:
-                    frame = [padding_value] * IsoTp.MAX_FRAME_LENGTH
-                frame[0] = (IsoTp.CF_FRAME_ID << 4) | sn
-                # Fill current CF
-                bytes_to_copy_to_current_cf = min(
-                    IsoTp.MAX_CF_LENGTH, bytes_left_to_copy)
-                for i in range(bytes_to_copy_to_current_cf):
-                    frame[1 + i] = message[bytes_copied]
-                    bytes_left_to_copy = bytes_left_to_copy - 1
-                    bytes_copied = bytes_copied + 1
-                frame_list.append(frame)
+                end = min(bytes_copied + cf_length, message_length)
+                frame_length = tx_dl if end - bytes_copied == cf_length else \
+                    IsoTp._padded_length(IsoTp.CF_PCI_LENGTH + end - bytes_copied, padding_enabled)
+                layout.append((bytes([(IsoTp.CF_FRAME_ID << 4) | sn]), bytes_copied, end, frame_length))
+                bytes_copied = end
+
+        buffer = bytearray([padding_value]) * sum(frame_length for _, _, _, frame_length in layout)
+        view = memoryview(buffer)
+        frame_list = []
+        offset = 0
+        for pci, start, end, frame_length in layout:
+            data_offset = offset + len(pci)
+            buffer[offset:data_offset] = pci
+            buffer[data_offset:data_offset + end - start] = payload[start:end]
+            frame_list.append(view[offset:offset + frame_length])
+            offset += frame_length
         return frame_list
 
+    @staticmethod
+    def _padded_length(frame_length, padding_enabled):
+        """
+        Returns the length of a frame of 'frame_length' bytes after padding: 8 bytes if padding is enabled,
+        and beyond 8 bytes always the next valid CAN FD data length
+        """
+        if frame_length <= IsoTp.MAX_FRAME_LENGTH:
+            return IsoTp.MAX_FRAME_LENGTH if padding_enabled else frame_length
+        return next(length for length in IsoTp.FD_DATA_LENGTHS if length >= frame_length)
+
     def set_filter_single_arbitration_id(self, arbitration_id):
         """Set a filter to only receive incoming messages on 'arbitration_id'"""
-        arbitration_id_filter = [
-            {"can_id": arbitration_id, "can_mask": ARBITRATION_ID_MAX_EXTENDED}]
-        self._set_filters(arbitration_id_filter)
+        self._set_filters(exact_id_filters([arbitration_id]))
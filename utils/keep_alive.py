@@ -0,0 +1,157 @@
+import math
+import threading
+import time
+
+from utils.constants import TESTER_PRESENT_PERIOD
+from utils.iso14229_1 import Services
+from utils.iso15765_2 import IsoTp
+
+# Resolution of the keep-alive timers in seconds
+KEEP_ALIVE_TICK = 0.1
+KEEP_ALIVE_SLOTS = 64
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel: timers sit in 'slots' buckets of 'tick' seconds, so scheduling, rescheduling and
+    cancelling a timer cost O(1) however many timers are running. A timer fires on the first tick at or after
+    its due time; timers further out than one revolution wait in their bucket until their tick comes round.
+    """
+
+    def __init__(self, tick=KEEP_ALIVE_TICK, slots=KEEP_ALIVE_SLOTS):
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        # Key -> tick the timer fires at
+        self.due = {}
+        self.start = time.monotonic()
+        # Ticks the wheel has advanced
+        self.current = 0
+
+    def __len__(self):
+        return len(self.due)
+
+    def __contains__(self, key):
+        return key in self.due
+
+    def schedule(self, key, delay, now=None):
+        """Starts the timer 'key' to fire 'delay' seconds from 'now', replacing a running timer of the same key"""
+        if now is None:
+            now = time.monotonic()
+        self.cancel(key)
+        due = max(self.current + 1, math.ceil((now - self.start + delay) / self.tick))
+        self.due[key] = due
+        self.slots[due % len(self.slots)].add(key)
+
+    def cancel(self, key):
+        due = self.due.pop(key, None)
+        if due is not None:
+            self.slots[due % len(self.slots)].discard(key)
+
+    def advance(self, now=None):
+        """
+        Moves the wheel to 'now'
+
+        :return: Keys of the timers that fired, in firing order
+        """
+        if now is None:
+            now = time.monotonic()
+        fired = []
+        target = int((now - self.start) / self.tick)
+        while self.current < target:
+            self.current += 1
+            slot = self.slots[self.current % len(self.slots)]
+            for key in [key for key in slot if self.due[key] <= self.current]:
+                slot.discard(key)
+                del self.due[key]
+                fired.append(key)
+        return fired
+
+    def next_tick(self):
+        """Returns the time.monotonic() time of the next tick"""
+        return self.start + (self.current + 1) * self.tick
+
+
+class KeepAliveScheduler:
+    """
+    Keeps ECUs in their non-default sessions: every ECU held by hold() is sent a TesterPresent with the
+    positive response suppressed (0x3E 0x80) once it has not been sent any request for 'period' seconds, so
+    its S3 timer never expires. Requests sent to the ECU postpone the TesterPresent (touch()), so it is only
+    sent to idle ECUs and never interleaves with a transfer. One thread and one TimerWheel serve all ECUs.
+
+    :param bus: Bus the TesterPresent requests are sent on
+    :param period: Seconds between the last request to an ECU and its TesterPresent
+    :param fd: Send CAN FD frames
+    """
+
+    REQUEST = bytes([Services.TesterPresent.service_id,
+                     Services.TesterPresent.ZERO_SUB_FUNCTION | Services.TesterPresent.SUPPRESS_POSITIVE_RESPONSE])
+
+    def __init__(self, bus, period=TESTER_PRESENT_PERIOD, fd=False):
+        self.bus = bus
+        self.period = period
+        self.fd = fd
+        self.wheel = TimerWheel()
+        # Request ID -> session the ECU is held in
+        self.sessions = {}
+        # Number of TesterPresent requests sent
+        self.sent = 0
+        self.condition = threading.Condition()
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="keep-alive", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+        self.thread = None
+
+    def hold(self, arbitration_id, session_id):
+        """
+        Keeps the ECU requested on 'arbitration_id' in session 'session_id', or stops keeping it alive when
+        'session_id' is the default session, which needs no keep-alive
+        """
+        if session_id == Services.DiagnosticSessionControl.DiagnosticSessionType.DEFAULT_SESSION:
+            self.release(arbitration_id)
+            return
+        with self.condition:
+            self.sessions[arbitration_id] = session_id
+            self.wheel.schedule(arbitration_id, self.period)
+            self.condition.notify()
+        self.start()
+
+    def release(self, arbitration_id):
+        with self.condition:
+            self.sessions.pop(arbitration_id, None)
+            self.wheel.cancel(arbitration_id)
+
+    def touch(self, arbitration_id):
+        """Postpones the TesterPresent of the ECU after a request sent to it"""
+        with self.condition:
+            if arbitration_id in self.wheel:
+                self.wheel.schedule(arbitration_id, self.period)
+
+    def is_held(self, arbitration_id):
+        return arbitration_id in self.sessions
+
+    def _run(self):
+        with self.condition:
+            while self.running:
+                # Without timers the thread sleeps until hold() or stop()
+                self.condition.wait(max(0.0, self.wheel.next_tick() - time.monotonic()) if self.wheel else None)
+                if not self.running:
+                    break
+                # Sent under the lock, so touch() cannot let a request start while a TesterPresent goes out
+                for arbitration_id in self.wheel.advance():
+                    self.bus.send(IsoTp.get_cached_messages(self.REQUEST, arbitration_id, fd=self.fd)[0])
+                    self.sent += 1
+                    self.wheel.schedule(arbitration_id, self.period)
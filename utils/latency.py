@@ -0,0 +1,92 @@
+from utils.constants import DEFAULT_RESPONSE_TIMEOUT, RESPONSE_TIMEOUT_CEILING, RESPONSE_TIMEOUT_FLOOR
+from utils.iso14229_1 import Iso14229_1
+
+
+class LatencyEstimator:
+    """
+    Smoothed round-trip time estimator, as used for TCP's retransmission timeout (RFC 6298).
+    The timeout is SRTT + K * RTTVAR, kept between 'floor' and 'ceiling' seconds.
+    """
+
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    K = 4
+
+    def __init__(self, initial_timeout=DEFAULT_RESPONSE_TIMEOUT, floor=RESPONSE_TIMEOUT_FLOOR,
+                 ceiling=RESPONSE_TIMEOUT_CEILING):
+        self.initial_timeout = initial_timeout
+        self.floor = floor
+        self.ceiling = ceiling
+        self.srtt = None
+        self.rttvar = None
+        self.samples = 0
+
+    def add_sample(self, rtt):
+        """
+        Updates the estimate with a measured round-trip time
+
+        :param rtt: Seconds between sending a request and receiving its response
+        :return: None
+        """
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + \
+                self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        self.samples += 1
+
+    def timeout(self):
+        """Returns the number of seconds to wait for a response"""
+        if self.srtt is None:
+            timeout = self.initial_timeout
+        else:
+            timeout = self.srtt + self.K * self.rttvar
+        return min(self.ceiling, max(self.floor, timeout))
+
+
+class LatencyTable:
+    """
+    Latency estimators of the servers on one channel, keyed by server (response) ID. Samples also
+    feed a channel-wide estimator, which gives the timeout for servers without samples of their own
+    and for requests to unknown servers, e.g. while scanning for ECUs.
+    """
+
+    def __init__(self, channel, initial_timeout=DEFAULT_RESPONSE_TIMEOUT, floor=RESPONSE_TIMEOUT_FLOOR,
+                 ceiling=RESPONSE_TIMEOUT_CEILING, unknown_server_floor=Iso14229_1.P2_SERVER):
+        self.channel = channel
+        self.initial_timeout = initial_timeout
+        self.floor = floor
+        self.ceiling = ceiling
+        # Least timeout for servers without samples of their own. The channel-wide estimate is learned from the
+        # servers that answered so far, usually the fast ones, while any server may take up to P2 to respond.
+        self.unknown_server_floor = unknown_server_floor
+        self.channel_estimator = self._new_estimator()
+        self.estimators = {}
+
+    def _new_estimator(self):
+        return LatencyEstimator(self.initial_timeout, self.floor, self.ceiling)
+
+    def add_sample(self, server_id, rtt):
+        """
+        Records a round-trip time measured on 'server_id'
+
+        :param server_id: Arbitration ID the response was received on
+        :param rtt: Seconds between sending the request and receiving the response
+        :return: None
+        """
+        self.channel_estimator.add_sample(rtt)
+        if server_id not in self.estimators:
+            self.estimators[server_id] = self._new_estimator()
+        self.estimators[server_id].add_sample(rtt)
+
+    def timeout(self, server_id=None):
+        """
+        Returns the number of seconds to wait for a response from 'server_id' (None for an unknown server). Only
+        servers with samples of their own get the adaptive estimate, the others at least 'unknown_server_floor'.
+        """
+        estimator = self.estimators.get(server_id)
+        if estimator is not None:
+            return estimator.timeout()
+        return min(self.ceiling, max(self.unknown_server_floor, self.channel_estimator.timeout()))
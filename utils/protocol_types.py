@@ -1,8 +1,13 @@
+import time
+from collections import deque
 from enum import Enum
-from errno import ETIMEDOUT
 
 from utils import constants
-from utils.can_actions import listen_for_response, send_request
+from utils.can_actions import send_request
+from utils.can_filters import discovery_filters, sniff_filters
+from utils.capture import RecordReader
+from utils.frame_analysis import FrameBatch, analyse_capture
+from utils.iso14229_1 import Iso14229_1, ServiceID
 
 
 class PossibleProtocol(Enum):
@@ -12,25 +17,216 @@ class PossibleProtocol(Enum):
     UNKNOWN = "Unknown or non-diagnostic protocol"
 
 
-def probe_uds_functional(bus):
-    print("\n[+] Probing UDS functional broadcast...")
-    request = [0x02, 0x10, 0x01] + [0x00] * 5
-    send_request(bus, constants.UDS_BROADCAST_ID, request)
-    return listen_for_response(bus, constants.RESPONSE_ID_RANGE, timeout=ETIMEDOUT) is not None
+# DiagnosticSessionControl (default session) single frame sent by the probes
+PROBE_REQUEST = [0x02, ServiceID.DIAGNOSTIC_SESSION_CONTROL, 0x01] + [0x00] * 5
 
 
-def probe_uds_physical(bus):
-    print("\n[+] Probing UDS physical addressing (0x500–0x7FF)...")
-    request = [0x02, 0x10, 0x01] + [0x00] * 5
-    for index, aid in enumerate(constants.PHYSICAL_ID_RANGE, start=1):
-        print(
-            f"\r[~] Probing AID {hex(aid)} ({index}/{len(constants.PHYSICAL_ID_RANGE)})...", end="")
-        send_request(bus, aid, request)
-        if listen_for_response(bus, [aid], timeout=0.3):
-            print(f"\r[+] Response from {hex(aid)}")
+def is_probe_response(msg):
+    """Returns True if 'msg' is a single frame positive or negative response to PROBE_REQUEST"""
+    data = msg.data
+    if len(data) < 3 or not 2 <= data[0] <= 7:
+        return False
+    service_id = ServiceID.DIAGNOSTIC_SESSION_CONTROL
+    return data[1] == service_id + constants.VALUE_TO_ADD_FOR_SUCCESSFUL_RESPONSE or \
+        (data[1] == constants.NEGATIVE_RESPONSE_CODE and data[2] == service_id)
+
+
+def physical_probe_order(physical_ids=constants.PHYSICAL_ID_RANGE):
+    """Returns 'physical_ids' with the conventional OBD request IDs (0x7E0-0x7E7) first, then from high to low"""
+    conventional = [aid for aid in range(0x7E0, 0x7E8) if aid in physical_ids]
+    return conventional + [aid for aid in reversed(physical_ids) if aid not in conventional]
+
+
+class InferenceResult:
+    """Outcome of ProtocolInference.run()"""
+
+    def __init__(self, protocol, confidence, decision_time, scores, summary, functional_responses,
+                 physical_responses, probed_ids):
+        self.protocol = protocol
+        self.confidence = confidence
+        # Seconds from the start of the inference to the decision
+        self.decision_time = decision_time
+        # PossibleProtocol -> confidence at the time of the decision
+        self.scores = scores
+        # utils.frame_analysis.TrafficSummary of the sniffed traffic
+        self.summary = summary
+        # Response IDs that answered the functional probe
+        self.functional_responses = functional_responses
+        # Physical request ID -> response ID
+        self.physical_responses = physical_responses
+        self.probed_ids = probed_ids
+
+
+class ProtocolInference:
+    """
+    Incremental protocol inference. Sniffing, the functional probes (11-bit 0x7DF and 29-bit 0x18DB33F1) and a
+    windowed sweep of 11-bit physical probes run at the same time on one bus view; every ANALYSIS_INTERVAL (and on every probe response) the evidence is
+    re-scored, and the inference stops as soon as one protocol reaches 'threshold' confidence or 'max_duration'
+    has passed.
+
+    Confidence model:
+    UDS: 1 - product of (1 - weight) over the responses to own probes and the request/response pairs of
+    other testers.
+    ISO-TP: 1 - 0.5 ** (segmented frames on IDs that only carry ISO-TP frames).
+    No UDS: coverage of the probes (finished physical probes / all of them) times (1 - UDS confidence).
+    LIKELY_ISOTP (ISO-TP and diagnostic IDs seen), PROPRIETARY_ISOTP (ISO-TP without diagnostic IDs) and UNKNOWN
+    share the no UDS confidence according to the ISO-TP confidence, as in conclude_protocol().
+
+    :param bus: Bus or BusView - its filters are replaced by sniff and response filters during run()
+    :param latency: LatencyTable giving the probe timeouts, or None for DEFAULT_RESPONSE_TIMEOUT
+    :param threshold: Confidence at which the inference stops
+    :param max_duration: Seconds after which the most likely protocol is reported whatever its confidence
+    :param window: Physical probes kept in flight
+    :param physical_ids: Request IDs of the physical probes
+    """
+
+    PROBE_RESPONSE_WEIGHT = 0.99
+    PASSIVE_PAIR_WEIGHT = 0.9
+    SEGMENTED_FRAME_WEIGHT = 0.5
+    ANALYSIS_INTERVAL = 0.25
+
+    def __init__(self, bus, latency=None, threshold=0.95, max_duration=10.0, window=16,
+                 physical_ids=constants.PHYSICAL_ID_RANGE):
+        self.bus = bus
+        self.latency = latency
+        self.threshold = threshold
+        self.max_duration = max_duration
+        self.window = window
+        self.physical_ids = physical_ids
+        self.frames = FrameBatch()
+        self.summary = self.frames.analyse()
+        self.functional_responses = set()
+        self.physical_responses = {}
+        self.probed_ids = 0
+
+    def _timeout(self):
+        return constants.DEFAULT_RESPONSE_TIMEOUT if self.latency is None else self.latency.timeout()
+
+    def scores(self):
+        """Returns the confidence of every PossibleProtocol given the evidence so far"""
+        summary = self.summary
+        no_uds_evidence = (1 - self.PROBE_RESPONSE_WEIGHT) ** (len(self.functional_responses) +
+                                                               len(self.physical_responses))
+        no_uds_evidence *= (1 - self.PASSIVE_PAIR_WEIGHT) ** sum(
+            pair.count for pair in summary.pairs.values())
+        uds = 1 - no_uds_evidence
+        segmented_frames = sum(summary.ids[aid].type_counts[frame_type]
+                               for aid in summary.iso_tp_ids for frame_type in ("FF", "CF", "FC"))
+        iso_tp = 1 - self.SEGMENTED_FRAME_WEIGHT ** segmented_frames
+        coverage = self.probed_ids / len(self.physical_ids) if len(self.physical_ids) else 1.0
+        no_uds = coverage * (1 - uds)
+        likely = bool(summary.diagnostic_ids)
+        return {
+            PossibleProtocol.UDS: uds,
+            PossibleProtocol.LIKELY_ISOTP: no_uds * iso_tp if likely else 0.0,
+            PossibleProtocol.PROPRIETARY_ISOTP: 0.0 if likely else no_uds * iso_tp,
+            PossibleProtocol.UNKNOWN: no_uds * (1 - iso_tp),
+        }
+
+    def run(self):
+        """
+        Runs the inference until a decision is reached
+
+        :return: InferenceResult
+        """
+        self.bus.set_filters(sniff_filters() + discovery_filters())
+        start = time.monotonic()
+        deadline = start + self.max_duration
+        send_request(self.bus, constants.UDS_BROADCAST_ID, PROBE_REQUEST)
+        send_request(self.bus, constants.UDS_BROADCAST_ID_EXTENDED, PROBE_REQUEST)
+        # Physical probes start once the functional responses are in, so responses are attributed to the right probe
+        functional_deadline = start + Iso14229_1.P2_SERVER + self._timeout()
+        pending = deque(physical_probe_order(self.physical_ids))
+        in_flight = deque()  # (deadline, request ID) in send order
+        next_analysis = start + self.ANALYSIS_INTERVAL
+
+        while True:
+            now = time.monotonic()
+            if now >= functional_deadline:
+                while in_flight and in_flight[0][0] <= now:
+                    in_flight.popleft()
+                    self.probed_ids += 1
+                while pending and len(in_flight) < self.window:
+                    aid = pending.popleft()
+                    send_request(self.bus, aid, PROBE_REQUEST)
+                    in_flight.append((now + self._timeout(), aid))
+
+            wake_up = min(next_analysis, deadline)
+            if now < functional_deadline:
+                wake_up = min(wake_up, functional_deadline)
+            if in_flight:
+                wake_up = min(wake_up, in_flight[0][0])
+            msg = self.bus.recv(max(0.0, wake_up - time.monotonic()))
+            rescore = False
+            if msg is not None:
+                self.frames.append(msg)
+                rescore = self._record_probe_response(msg, functional_deadline, in_flight)
+
+            now = time.monotonic()
+            probes_done = not pending and not in_flight and now >= functional_deadline
+            if rescore or probes_done or now >= next_analysis:
+                self.summary = self.frames.analyse()
+                next_analysis = now + self.ANALYSIS_INTERVAL
+                scores = self.scores()
+                protocol = max(scores, key=scores.get)
+                if scores[protocol] >= self.threshold or probes_done or now >= deadline:
+                    # Responses still due to the probes sent must not reach the next user of the bus, but are
+                    # recorded all the same
+                    quiet_at = max([functional_deadline] + [probe_deadline for probe_deadline, _ in in_flight])
+                    while time.monotonic() < quiet_at:
+                        msg = self.bus.recv(max(0.0, quiet_at - time.monotonic()))
+                        if msg is not None:
+                            self._record_probe_response(msg, functional_deadline, in_flight)
+                    return InferenceResult(protocol, scores[protocol], now - start, scores, self.summary,
+                                           self.functional_responses, self.physical_responses, self.probed_ids)
+
+    def _record_probe_response(self, msg, functional_deadline, in_flight):
+        """
+        Records 'msg' in functional_responses or physical_responses if it answers a probe
+
+        :param msg: Received can.Message
+        :param functional_deadline: time.monotonic() time until which responses answer the functional probe
+        :param in_flight: Physical probes in flight, (deadline, request ID) in send order
+        :return: True if 'msg' is a probe response
+        """
+        if not is_probe_response(msg):
+            return False
+        if msg.is_extended_id:
+            # Only the 29-bit functional probe is answered on 0x18DA<tester><target>, so late replies count as well
+            if msg.arbitration_id not in constants.NORMAL_FIXED_RESPONSE_ID_RANGE:
+                return False
+            self.functional_responses.add(msg.arbitration_id)
             return True
-    print("\r[✗] No response detected in physical addressing range.")
-    return False
+        if msg.arbitration_id not in constants.RESPONSE_ID_RANGE:
+            return False
+        if time.monotonic() < functional_deadline:
+            self.functional_responses.add(msg.arbitration_id)
+        elif in_flight:
+            # Attributed like the pipelined ECU sweep: conventional request ID, else the newest probe
+            request_id = msg.arbitration_id - constants.RESPONSE_ID_OFFSET
+            if request_id not in [aid for _, aid in in_flight]:
+                request_id = in_flight[-1][1]
+            self.physical_responses[request_id] = msg.arbitration_id
+        return True
+
+
+def infer_protocol_offline(path, start=None, end=None):
+    """
+    Infers the protocol from a .rec capture (see utils.capture) instead of the live bus. The capture is
+    memory-mapped and analysed at CPU speed; UDS responses are taken from the request/response pairs recorded
+    in it, as nothing can be probed. The records are analysed in place as NumPy arrays.
+
+    :param path: Path of the capture
+    :param start: First timestamp to analyse, or None to start at the beginning
+    :param end: Timestamp to stop at, or None to analyse to the end
+    :return: PossibleProtocol
+    """
+    with RecordReader(path) as capture:
+        print(f"[~] Analysing {path} ({len(capture)} frames)...")
+        summary = analyse_capture(capture, start, end)
+    summary.print()
+    return conclude_protocol(summary.iso_tp_detected, summary.uds_functional, summary.uds_physical,
+                             summary.diagnostic_ids)
 
 
 def conclude_protocol(iso_tp, uds_func_resp, uds_phys_resp, diag_ids):
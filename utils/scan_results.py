@@ -0,0 +1,117 @@
+import time
+
+
+class EcuRecord:
+    """ECU found by an ECU scan"""
+
+    def __init__(self, ecu, timestamp):
+        self.ecu = ecu
+        self.timestamp = timestamp
+
+
+class SessionRecord:
+    """
+    Session 'session_id' of an ECU entered from session 'source' (None: the session the ECU was in). 'first' is
+    True for the transition the session was found with.
+    """
+
+    def __init__(self, ecu, source, session_id, first, timestamp):
+        self.ecu = ecu
+        self.source = source
+        self.session_id = session_id
+        self.first = first
+        self.timestamp = timestamp
+
+
+class ServiceRecord:
+    """Service found available in a session of an ECU"""
+
+    def __init__(self, ecu, session_id, service_id, timestamp):
+        self.ecu = ecu
+        self.session_id = session_id
+        self.service_id = service_id
+        self.timestamp = timestamp
+
+
+class ScanResult:
+    """Data read from a DID of an ECU in a given session"""
+
+    def __init__(self, ecu, session_id, did, data, timestamp):
+        self.ecu = ecu
+        self.session_id = session_id
+        self.did = did
+        self.data = data
+        self.timestamp = timestamp
+
+
+class ScanResultStore:
+    """
+    Per-run store of DID read results, keyed by (ECU, session, DID) and indexed by DID.
+    Results older than 'ttl' seconds are treated as missing; a ttl of None keeps them for the whole run.
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self._results = {}
+        # DID -> {(ECU key, session ID): ScanResult}
+        self._by_did = {}
+
+    @staticmethod
+    def ecu_key(ecu):
+        return ecu.client_id, ecu.server_id
+
+    def put(self, ecu, session_id, did, data):
+        """
+        Stores 'data' read from 'did' of 'ecu' in 'session_id'. None marks a DID the ECU did not return.
+
+        :return: The stored ScanResult
+        """
+        result = ScanResult(ecu, session_id, did, data, time.monotonic())
+        key = (self.ecu_key(ecu), session_id)
+        self._results[key + (did,)] = result
+        self._by_did.setdefault(did, {})[key] = result
+        return result
+
+    def get(self, ecu, session_id, did):
+        """Returns the ScanResult for ('ecu', 'session_id', 'did'), or None if it is missing or expired"""
+        result = self._results.get((self.ecu_key(ecu), session_id, did))
+        if result is None or self._is_expired(result):
+            return None
+        return result
+
+    def get_data(self, ecu, session_id, did):
+        """Returns the data stored for ('ecu', 'session_id', 'did'), or None if it is missing or expired"""
+        result = self.get(ecu, session_id, did)
+        return None if result is None else result.data
+
+    def by_did(self, did):
+        """Returns the unexpired results of 'did' across all ECUs and sessions"""
+        return [result for result in self._by_did.get(did, {}).values()
+                if not self._is_expired(result)]
+
+    def invalidate(self, ecu=None, session_id=None, did=None):
+        """
+        Removes the results matching all given arguments - without arguments the store is emptied
+
+        :param ecu: Only remove results of this ECU
+        :param session_id: Only remove results read in this session
+        :param did: Only remove results of this DID
+        :return: None
+        """
+        ecu_key = None if ecu is None else self.ecu_key(ecu)
+        for key in list(self._results):
+            key_ecu, key_session_id, key_did = key
+            if ecu_key is not None and key_ecu != ecu_key:
+                continue
+            if session_id is not None and key_session_id != session_id:
+                continue
+            if did is not None and key_did != did:
+                continue
+            del self._results[key]
+            del self._by_did[key_did][(key_ecu, key_session_id)]
+
+    def _is_expired(self, result):
+        return self.ttl is not None and time.monotonic() - result.timestamp > self.ttl
+
+    def __len__(self):
+        return len(self._results)